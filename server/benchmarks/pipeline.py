@@ -0,0 +1,393 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+""" Throughput benchmark of the dump pipeline
+
+Measures the stages of the pipeline separately (dump, encrypt, push, list,
+download) and end to end, on dumps generated by the synthetic database
+commander, against the local storage, a S3 stand-in (moto server) and the
+dedup storage. Every stage runs in its own process so its peak RSS is its
+own.
+
+The results are written as JSON, to compare runs between versions::
+
+    python benchmarks/pipeline.py --size-mb 256 --output new.json
+    python benchmarks/pipeline.py --size-mb 256 --compare old.json
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from dumpbagserver.bagger import Bagger
+from dumpbagserver.database import DatabaseCommander, SyntheticOptions
+from dumpbagserver.dedup import DedupOptions
+from dumpbagserver.encryption import (
+    EncryptionCommander, GPGKeysOptions, NoOpEncryptionOptions,
+)
+from dumpbagserver.storage import (
+    LocalOptions, S3ClientOptions, StorageCommander, _s3_client,
+)
+from dumpbagserver.stream import CHUNK_SIZE
+
+RECIPIENT = 'benchmark@dumpbag.invalid'
+BUCKET = 'dumpbag-benchmark'
+DUMP = 'db1-bench.pg'
+STORAGES = ('local', 's3-client', 'dedup')
+STAGES = ('dump', 'encrypt', 'push', 'list', 'download', 'end_to_end')
+
+
+def _consume(stream):
+    for __ in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        pass
+
+
+def _dump_stream(ctx):
+    commander = DatabaseCommander.new_commander(ctx['database'])
+    return commander.exec_dump_stream('db1')
+
+
+def stage_dump(ctx):
+    start = time.time()
+    with _dump_stream(ctx) as dump:
+        _consume(dump)
+    return {'seconds': time.time() - start, 'bytes': ctx['database'].size}
+
+
+def stage_encrypt(ctx):
+    encrypter = EncryptionCommander.new_commander(ctx['encryption'])
+    start = time.time()
+    with _dump_stream(ctx) as dump:
+        with encrypter.encrypt_stream(dump) as encrypted:
+            _consume(encrypted)
+    return {'seconds': time.time() - start, 'bytes': ctx['database'].size}
+
+
+def stage_push(ctx):
+    storage = StorageCommander.new_commander(ctx['storage'])
+    start = time.time()
+    with _dump_stream(ctx) as dump:
+        storage.push_stream('db1', dump, DUMP)
+    return {'seconds': time.time() - start, 'bytes': ctx['database'].size}
+
+
+def stage_list(ctx):
+    storage = StorageCommander.new_commander(ctx['storage'])
+    small = SyntheticOptions(1024)
+    commander = DatabaseCommander.new_commander(small)
+    for idx in range(ctx['list_dumps']):
+        dbname = 'list%d' % (idx % 10,)
+        with commander.exec_dump_stream(dbname) as dump:
+            storage.push_stream(dbname, dump, '%s-%05d.pg' % (dbname, idx))
+    start = time.time()
+    for __ in range(ctx['list_repeat']):
+        storage.list_by_db()
+    return {
+        'seconds': time.time() - start,
+        'operations': ctx['list_repeat'],
+        'dumps': ctx['list_dumps'],
+    }
+
+
+def stage_download(ctx):
+    storage = StorageCommander.new_commander(ctx['storage'])
+    start = time.time()
+    for __ in storage.read_dump('db1', DUMP):
+        pass
+    return {'seconds': time.time() - start, 'bytes': ctx['database'].size}
+
+
+class BenchmarkConfig():
+    """ Configuration of the Bagger run end to end """
+
+    only_databases = []
+    exclude_databases = []
+    streaming = True
+    listing_cache_ttl = 0
+    dump_concurrency = 1
+    metrics = True
+    # the bytes of the streamed stages are not counted by default
+    metrics_bytes = False
+    # the dumps are not recorded in a catalog
+    catalog = False
+    dump_validation = None
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def database_options(self):
+        return self.ctx['database']
+
+    def storage_options(self):
+        return self.ctx['storage']
+
+    def encryption_options(self):
+        return self.ctx['encryption']
+
+
+def stage_end_to_end(ctx):
+    bagger = Bagger(BenchmarkConfig(ctx))
+    start = time.time()
+    bagger.bag_one_database('db1')
+    return {'seconds': time.time() - start, 'bytes': ctx['database'].size}
+
+
+def _reset_peak_rss():
+    # the peak RSS of a new process starts at the one of its parent, it
+    # can be reset on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024., 1)
+    except OSError:
+        pass
+    # kilobytes on Linux
+    return round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 1
+    )
+
+
+def _run_stage(stage, ctx, queue):
+    _reset_peak_rss()
+    try:
+        result = globals()['stage_%s' % (stage,)](ctx)
+    except Exception as err:
+        queue.put({'error': '%s: %s' % (type(err).__name__, err)})
+        return
+    # the commands of the pipeline (gpg, aws) are not counted
+    result['peak_rss_mb'] = _peak_rss_mb()
+    queue.put(result)
+
+
+def run_stage(stage, storage, ctx):
+    """ Run a stage in a new process and return its result """
+    mp = multiprocessing.get_context('spawn')
+    queue = mp.Queue()
+    process = mp.Process(target=_run_stage, args=(stage, ctx, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    result.update({'stage': stage, 'storage': storage})
+    if 'bytes' in result and result['seconds']:
+        result['mb_per_s'] = round(
+            result['bytes'] / 1024. ** 2 / result['seconds'], 1
+        )
+    if 'operations' in result and result['seconds']:
+        result['operations_per_s'] = round(
+            result['operations'] / result['seconds'], 1
+        )
+    result['seconds'] = round(result.get('seconds', 0), 3)
+    return result
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@contextmanager
+def s3_server():
+    """ Yield the options of a bucket of a local moto server """
+    from moto.server import ThreadedMotoServer
+    port = _free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    try:
+        options = S3ClientOptions(
+            BUCKET, 'benchmark', 'benchmark',
+            endpoint_url='http://127.0.0.1:%d' % (port,),
+            region='us-east-1',
+        )
+        _s3_client(options).create_bucket(Bucket=BUCKET)
+        yield options
+    finally:
+        server.stop()
+
+
+@contextmanager
+def gpg_home(tmpdir):
+    """ Temporary keyring with a key for the benchmark, None without gpg """
+    if not shutil.which('gpg'):
+        yield None
+        return
+    home = os.path.join(tmpdir, 'gnupg')
+    os.mkdir(home, 0o700)
+    previous = os.environ.get('GNUPGHOME')
+    os.environ['GNUPGHOME'] = home
+    try:
+        subprocess.check_call(
+            ['gpg', '--batch', '--quiet', '--passphrase', '',
+             '--quick-gen-key', RECIPIENT, 'future-default', 'default',
+             'never'],
+            stderr=subprocess.DEVNULL,
+        )
+        yield GPGKeysOptions([RECIPIENT])
+    finally:
+        if previous is None:
+            os.environ.pop('GNUPGHOME')
+        else:
+            os.environ['GNUPGHOME'] = previous
+
+
+def _storage_options(storage, tmpdir, s3_options, encryption):
+    if storage == 'local':
+        return LocalOptions(os.path.join(tmpdir, 'local'))
+    elif storage == 's3-client':
+        return s3_options
+    elif storage == 'dedup':
+        passphrase_file = os.path.join(tmpdir, 'passphrase')
+        if not os.path.exists(passphrase_file):
+            with open(passphrase_file, 'w') as f:
+                f.write('benchmark')
+        return DedupOptions(
+            LocalOptions(os.path.join(tmpdir, 'dedup')), encryption,
+            passphrase_file,
+        )
+    raise ValueError('unknown storage %s' % (storage,))
+
+
+def run(args):
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='dumpbag-benchmark-')
+    try:
+        with gpg_home(tmpdir) as gpg_options:
+            encryption = gpg_options or NoOpEncryptionOptions()
+            encryption_kind = 'gpg' if gpg_options else 'none'
+            with s3_server() as s3_options:
+                ctx = {
+                    'database': SyntheticOptions(
+                        args.size_mb * 1024 ** 2, entropy=args.entropy
+                    ),
+                    'encryption': encryption,
+                    'list_dumps': args.list_dumps,
+                    'list_repeat': args.list_repeat,
+                }
+                for stage in ('dump', 'encrypt'):
+                    if stage in args.stages:
+                        results.append(run_stage(stage, None, ctx))
+                for storage in args.storages:
+                    ctx['storage'] = _storage_options(
+                        storage, tmpdir, s3_options, encryption
+                    )
+                    for stage in ('push', 'download', 'list', 'end_to_end'):
+                        if stage in args.stages:
+                            results.append(run_stage(stage, storage, ctx))
+    finally:
+        shutil.rmtree(tmpdir)
+    return {
+        'version': _version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {
+            'size_mb': args.size_mb,
+            'entropy': args.entropy,
+            'encryption': encryption_kind,
+            'list_dumps': args.list_dumps,
+            'list_repeat': args.list_repeat,
+        },
+        'results': results,
+    }
+
+
+def _version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metric(result):
+    return result.get('mb_per_s') or result.get('operations_per_s')
+
+
+def print_results(report, baseline=None, out=sys.stderr):
+    previous = {}
+    if baseline:
+        previous = {
+            (result['stage'], result['storage']): result
+            for result in baseline['results']
+        }
+    for result in report['results']:
+        line = '%-10s %-10s' % (result['stage'], result['storage'] or '')
+        if 'error' in result:
+            out.write('%s error: %s\n' % (line, result['error']))
+            continue
+        unit = 'MB/s' if 'mb_per_s' in result else 'ops/s'
+        line += ' %10.1f %-5s rss %7.1f MB' % (
+            _metric(result), unit, result['peak_rss_mb']
+        )
+        old = previous.get((result['stage'], result['storage']))
+        if old and _metric(old):
+            line += '  %+.1f%% vs %s' % (
+                (_metric(result) / _metric(old) - 1) * 100,
+                baseline.get('version'),
+            )
+        out.write(line + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=int, default=128,
+                        help='size of the dump')
+    parser.add_argument('--entropy', type=float, default=0.5,
+                        help='proportion of incompressible bytes (0 to 1)')
+    parser.add_argument('--storages', default=','.join(STORAGES),
+                        help='storages to benchmark')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='stages to benchmark')
+    parser.add_argument('--list-dumps', type=int, default=500,
+                        help='number of dumps in the storage for "list"')
+    parser.add_argument('--list-repeat', type=int, default=20,
+                        help='number of listings for "list"')
+    parser.add_argument('--output', help='JSON file of the results, '
+                                         'default is stdout')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    args = parser.parse_args()
+    args.storages = args.storages.split(',')
+    args.stages = args.stages.split(',')
+
+    report = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(report, baseline=baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
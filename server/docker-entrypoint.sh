@@ -18,4 +18,10 @@ if [ ! -z "$GPG_RECIPIENTS_FROM_URL" ]; then
   export BAG_GPG_RECIPIENTS
 fi
 
+if [ ! -z "$PROMETHEUS_MULTIPROC_DIR" ]; then
+  # metrics of the uwsgi processes, they must not survive a restart
+  rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+  mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 exec "$@"
@@ -18,3 +18,9 @@ app_config = config.DumpBagConfig()
 
 # views have to be imported after the application object is created.
 import dumpbagserver.views  # noqa
+from .jobs import job_runner  # noqa
+from .scheduler import job_scheduler  # noqa
+
+# start the workers for the queued dumps and the scheduler, if activated
+job_runner(app_config)
+job_scheduler(app_config)
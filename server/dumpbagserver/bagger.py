@@ -1,16 +1,71 @@
 import errno
+import logging
+import os
 import shutil
 import tempfile
+import threading
 import time
 
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from string import Template
 
 from flask import url_for
 
+from . import metrics
+from .cache import LRUCache, listing_cache
+from .catalog import dump_catalog, dump_timestamp
 from .database import DatabaseCommander, Database
+from .exception import DumpBagError, DumpingError, DumpNotExistError
 from .storage import StorageCommander
+from .stream import HashingStream
 from .encryption import EncryptionCommander
+from .validation import VALIDATION_FAILED, DumpValidator
+
+_logger = logging.getLogger(__name__)
+
+# rendered download commands, by configuration and URL of the dump
+_download_commands = LRUCache(4096)
+
+
+class BagReport():
+    """ Summary of the dumps of several databases
+
+    Filled concurrently by the workers of :meth:`Bagger.bag_all_databases`.
+    """
+
+    def __init__(self):
+        self.succeeded = {}
+        self.failed = {}
+        self.skipped = {}
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def add_success(self, dbname, filename, duration):
+        with self._lock:
+            self.succeeded[dbname] = filename
+            self.durations[dbname] = duration
+
+    def add_skip(self, dbname, filename):
+        with self._lock:
+            self.skipped[dbname] = filename
+
+    def add_failure(self, dbname, error, duration):
+        with self._lock:
+            self.failed[dbname] = '%s: %s' % (type(error).__name__, error)
+            self.durations[dbname] = duration
+
+    def to_dict(self):
+        return {
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'durations': self.durations,
+        }
 
 
 class Bagger():
@@ -31,12 +86,55 @@ class Bagger():
         self.encrypter = EncryptionCommander.new_commander(
             self.config.encryption_options()
         )
+        self.listing = None
+        if self.config.listing_cache_ttl:
+            self.listing = listing_cache(
+                self.storage, self.config.listing_cache_ttl
+            )
+        self.catalog = dump_catalog(self.config, self.storage)
 
     def list_databases(self):
         return self.db.list_databases()
 
+    def database_sizes(self):
+        return self.db.database_sizes()
+
+    def dump_order(self, durations=None):
+        """ Return the databases, the longest to dump first
+
+        Running the longest dumps first gives the shortest total time
+        when several databases are dumped at the same time. The durations
+        of the previous dumps are used when they are known, the other
+        ones are estimated from the size of the database.
+
+        :param durations: dict {dbname: seconds} of the previous dumps
+        """
+        sizes = self.database_sizes()
+        durations = {
+            dbname: duration for dbname, duration in (durations or {}).items()
+            if dbname in sizes
+        }
+        # seconds per byte of the dumps whose database size is known
+        measured = [dbname for dbname in durations if sizes[dbname]]
+        if measured:
+            rate = (sum(durations[dbname] for dbname in measured) /
+                    sum(sizes[dbname] for dbname in measured))
+        elif any(sizes.values()):
+            # durations and sizes cannot be compared, only use the sizes
+            durations, rate = {}, 1
+        else:
+            rate = 0
+
+        def estimate(dbname):
+            if dbname in durations:
+                return durations[dbname]
+            return (sizes[dbname] or 0) * rate
+
+        # sorted() is stable: same order as the server for equal estimates
+        return sorted(sizes, key=estimate, reverse=True)
+
     def has_dump_for_today(self, dbname):
-        dumps = self.storage.list_by_db().get(dbname, [])
+        dumps = self.list_dumps(dbname=dbname).get(dbname, [])
         start = '%s-%s' % (dbname, time.strftime("%Y%m%d"))
         return any(filename.startswith(start) for filename in dumps)
 
@@ -53,21 +151,364 @@ class Bagger():
                     raise
 
     def bag_one_database(self, dbname):
-        with self.temporary_working_dir() as tmpdir:
-            filename = self.db.create_dump_file(tmpdir, dbname)
-            filename = self.encrypter.encrypt(tmpdir, filename)
-            self.storage.push_to_storage(dbname, tmpdir, filename)
+        start = time.time()
+        try:
+            with metrics.dump_metrics(dbname):
+                if self.config.streaming or self.storage.handles_encryption:
+                    bagged = self._bag_one_database_streaming(dbname)
+                else:
+                    bagged = self._bag_one_database_file(dbname)
+                filename, checksum, validation = bagged
+                if checksum:
+                    self.storage.push_checksum(dbname, filename, checksum)
+        finally:
+            if self.listing:
+                self.listing.invalidate(dbname)
+        if validation is not None:
+            status, error = validation
+            metrics.DUMP_VALIDATIONS.labels(dbname, status).inc()
+            if status == VALIDATION_FAILED:
+                # the dump is kept, flagged in the catalog
+                _logger.error('dump %s failed its validation:\n%s',
+                              filename, error)
+        if self.catalog is not None:
+            self._record_dump(dbname, filename, time.time() - start,
+                              checksum, validation)
         return filename
 
-    def bag_all_databases(self):
-        for dbname in self.list_databases():
-            self.bag_one_database(dbname)
+    def _record_dump(self, dbname, filename, duration, checksum,
+                     validation=None):
+        # the dump is in the storage, a failure to record it is repaired
+        # by the next reconciliation of the catalog
+        try:
+            try:
+                stat = self.storage.stat_dump(dbname, filename)
+            except DumpNotExistError:
+                stat = None
+            self.catalog.record(
+                dbname, filename,
+                size=stat.size if stat else None,
+                duration=duration,
+                checksum=checksum,
+                recipients=self.encrypter.recipients(),
+                validation=validation[0] if validation else None,
+                validation_error=validation[1] if validation else None,
+            )
+        except Exception:
+            _logger.exception('could not record dump %s in the catalog',
+                              filename)
+
+    @contextmanager
+    def _validator(self, dbname, source=None):
+        """ Validate a dump while it is pushed (BAG_DUMP_VALIDATION)
+
+        Context manager yielding a :class:`DumpValidator`, None when the
+        dumps are not validated. A failure to prepare the validation does
+        not stop the dump, which is flagged instead.
+
+        :param source: file object of the dump, fed with
+                       :meth:`DumpValidator.tee` when not given
+        """
+        mode = self.config.dump_validation
+        if not mode:
+            yield None
+            return
+        with ExitStack() as stack:
+            try:
+                pipeline = stack.enter_context(
+                    self.db.commander.validation_pipeline(dbname, mode)
+                )
+            except DumpingError as err:
+                validator = DumpValidator(None, error=str(err))
+            else:
+                commands, env = pipeline or (None, None)
+                validator = DumpValidator(commands, env=env, source=source)
+            try:
+                yield validator
+            finally:
+                validator.close()
+
+    def _bag_one_database_file(self, dbname):
+        """ Dump in a temporary file, encrypted and pushed from the disk
+
+        The validation of the dump reads the file of the dump while it is
+        encrypted and pushed.
+
+        :return: tuple (filename, sha256, validation)
+        """
+        validation = None
+        with self.temporary_working_dir() as tmpdir:
+            with metrics.stage_metrics(dbname, 'dump') as stage:
+                filename = self.db.create_dump_file(tmpdir, dbname)
+                stage.path = os.path.join(tmpdir, filename)
+            with open(os.path.join(tmpdir, filename), 'rb') as dump:
+                with self._validator(dbname, source=dump) as validator:
+                    with metrics.stage_metrics(dbname, 'encrypt') as stage:
+                        filename = self.encrypter.encrypt(tmpdir, filename)
+                        stage.path = os.path.join(tmpdir, filename)
+                    path = os.path.join(tmpdir, filename)
+                    with open(path, 'rb') as encrypted, \
+                            metrics.stage_metrics(dbname, 'push'):
+                        # hashed while pushed, not read again from the disk
+                        encrypted = HashingStream(encrypted)
+                        self.storage.push_stream(
+                            dbname, encrypted, filename,
+                            size=os.path.getsize(path),
+                        )
+                    checksum = encrypted.hexdigest()
+                    if validator is not None:
+                        validation = validator.result()
+        return filename, checksum, validation
+
+    def _bag_one_database_streaming(self, dbname):
+        """ Pipe the dump through the encryption to the storage
+
+        Nothing is written on the local disk. As the stages run
+        concurrently, an upstream failure (e.g. pg_dump) is only known
+        once the storage has received everything: in such case the
+        incomplete dump is removed from the storage.
+
+        The sha256 of the dump is computed while it is pushed. None when
+        the storage encrypts the dumps, as they are then encrypted again
+        at each download. The validation of the dump is fed with a copy
+        of the stream of the dump.
+
+        :return: tuple (filename, sha256, validation)
+        """
+        filename = None
+        checksum = None
+        validation = None
+        pushed = False
+        start = time.time()
+        try:
+            with self.db.create_dump_stream(dbname) as (filename, dump), \
+                    self._validator(dbname) as validator:
+                filename = self.encrypter.encrypted_filename(filename)
+                if self.config.metrics_bytes:
+                    dump = metrics.MeteredStream(dump, dbname, 'dump', start)
+                if validator is not None:
+                    dump = validator.tee(dump)
+                if self.storage.handles_encryption:
+                    with metrics.stage_metrics(dbname, 'push'):
+                        self.storage.push_stream(dbname, dump, filename)
+                    pushed = True
+                else:
+                    with self.encrypter.encrypt_stream(dump) as encrypted:
+                        if self.config.metrics_bytes:
+                            encrypted = metrics.MeteredStream(
+                                encrypted, dbname, 'encrypt', start
+                            )
+                        encrypted = HashingStream(encrypted)
+                        with metrics.stage_metrics(dbname, 'push'):
+                            self.storage.push_stream(
+                                dbname, encrypted, filename
+                            )
+                        pushed = True
+                        checksum = encrypted.hexdigest()
+                if validator is not None:
+                    validation = validator.result()
+        except DumpBagError:
+            if pushed:
+                self.storage.delete_dump(dbname, filename)
+            raise
+        return filename, checksum, validation
+
+    def bag_if_changed(self, dbname, markers, activity=None):
+        """ Bag a database unless it has not been written since its dump
+
+        The last dump is kept when the activity marker of the database is
+        the same as before this dump and the dump is still in the storage.
+
+        :param markers: :class:`~dumpbagserver.changes.ActivityMarkers`
+        :param activity: markers of the databases, read when not given
+        :return: tuple (filename, skipped)
+        """
+        if activity is None:
+            activity = self.db.commander.activity_markers()
+        # read before the dump, a write during the dump is seen next time
+        marker = activity.get(dbname)
+        last = markers.get(dbname)
+        if (marker is not None and last and last['marker'] == marker and
+                last['filename'] in self.list_dumps(dbname=dbname).get(
+                    dbname, [])):
+            _logger.info('database %s has not changed since %s, skipped',
+                         dbname, last['filename'])
+            markers.record_skip(dbname)
+            metrics.DUMPS_SKIPPED.labels(dbname).inc()
+            return last['filename'], True
+        filename = self.bag_one_database(dbname)
+        if marker is not None:
+            markers.record_dump(dbname, marker, filename)
+        return filename, False
+
+    def _bag_for_report(self, dbname, report, markers=None, activity=None):
+        start = time.time()
+        try:
+            if markers is not None:
+                filename, skipped = self.bag_if_changed(
+                    dbname, markers, activity=activity
+                )
+            else:
+                filename, skipped = self.bag_one_database(dbname), False
+        except Exception as err:
+            _logger.exception('could not bag database %s', dbname)
+            report.add_failure(dbname, err, time.time() - start)
+        else:
+            if skipped:
+                report.add_skip(dbname, filename)
+            else:
+                report.add_success(dbname, filename, time.time() - start)
+
+    def bag_all_databases(self, concurrency=None, durations=None,
+                          markers=None):
+        """ Bag all the databases, several at a time
+
+        A failure does not stop the other dumps. The longest dumps are
+        started first (see :meth:`dump_order`).
+
+        :param concurrency: number of databases bagged at the same time,
+                            by default the one of the configuration
+        :param durations: dict {dbname: seconds} of the previous dumps
+        :param markers: :class:`~dumpbagserver.changes.ActivityMarkers`,
+                        to skip the databases which have not changed
+        :return: a :class:`BagReport`
+        """
+        if concurrency is None:
+            concurrency = self.config.dump_concurrency
+        report = BagReport()
+        databases = self.dump_order(durations=durations)
+        activity = None
+        if markers is not None:
+            activity = self.db.commander.activity_markers()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for dbname in databases:
+                executor.submit(self._bag_for_report, dbname, report,
+                                markers=markers, activity=activity)
+        _logger.info(
+            'bagged %d databases, %d skipped, %d failed',
+            len(report.succeeded), len(report.skipped), len(report.failed),
+        )
+        return report
+
+    def apply_retention(self, retention, dry_run=False):
+        """ Remove the dumps which are not kept by the retention policies
+
+        The keep set of each database is worked out from the listing, then
+        all the dumps to remove are deleted at once by the storage (see
+        :meth:`StorageCommander.delete_dumps`).
+
+        :param retention: a :class:`~dumpbagserver.retention.Retention`
+        :param dry_run: only report the dumps which would be removed
+        :return: dict with the dumps kept and removed by database
+        """
+        plan = retention.plan(self.list_dumps())
+        dumps = [
+            (dbname, filename) for dbname in sorted(plan)
+            for filename in plan[dbname]['delete']
+        ]
+        if dumps and not dry_run:
+            try:
+                self.storage.delete_dumps(dumps)
+            finally:
+                # some dumps may be removed even if others failed
+                if self.listing:
+                    self.listing.invalidate()
+            if self.catalog is not None:
+                self.catalog.forget_dumps(dumps)
+            for dbname in plan:
+                if plan[dbname]['delete']:
+                    metrics.DUMPS_REMOVED.labels(dbname).inc(
+                        len(plan[dbname]['delete'])
+                    )
+        _logger.info('%s %d dumps of %d databases',
+                     'would remove' if dry_run else 'removed',
+                     len(dumps), len(plan))
+        return {
+            'dry_run': dry_run,
+            'kept': sum(len(item['keep']) for item in plan.values()),
+            'removed': len(dumps),
+            'databases': {
+                dbname: dict(item, policy=retention.policy(dbname).to_dict())
+                for dbname, item in plan.items()
+            },
+        }
+
+    def _use_catalog(self):
+        return self.catalog is not None and self.catalog.ready
 
     def list_dumps(self, dbname=None):
-        return self.storage.list_by_db(dbname=dbname)
+        with metrics.LISTING_DURATION.time():
+            if self._use_catalog():
+                return self.catalog.list_by_db(dbname=dbname)
+            if self.listing:
+                return self.listing.list_by_db(dbname=dbname)
+            return self.storage.list_by_db(dbname=dbname)
+
+    def list_page(self, dbname=None, cursor=None, start_after=None,
+                  limit=1000, search=None, since=None, until=None,
+                  min_size=None, max_size=None):
+        """ Return a :class:`DumpPage` of the dumps matching the filters
+
+        Searched in the catalog when there is one. Otherwise, the filters
+        are applied on a page of the storage, which can then contain less
+        than ``limit`` dumps, and the dumps whose size is unknown do not
+        match the filters on the size.
 
-    def read_dump(self, db, filename):
-        return self.storage.read_dump(db, filename)
+        :param search: text contained in the name of the dumps
+        :param since: minimum timestamp of the dumps
+        :param until: maximum timestamp of the dumps
+        :param min_size: minimum size of the dumps in bytes
+        :param max_size: maximum size of the dumps in bytes
+        """
+        with metrics.LISTING_DURATION.time():
+            if self._use_catalog():
+                return self.catalog.search(
+                    dbname=dbname, after=cursor or start_after, limit=limit,
+                    search=search, since=since, until=until,
+                    min_size=min_size, max_size=max_size,
+                )
+            page = self.storage.list_page(
+                dbname=dbname, cursor=cursor, start_after=start_after,
+                limit=limit,
+            )
+        if not any(value is not None for value in
+                   (search, since, until, min_size, max_size)):
+            return page
+
+        def matches(dump):
+            filename = dump[1]
+            if search and search.lower() not in filename.lower():
+                return False
+            if since is not None or until is not None:
+                date = dump_timestamp(filename)
+                if (date is None or (since is not None and date < since) or
+                        (until is not None and date > until)):
+                    return False
+            if min_size is not None or max_size is not None:
+                size = page.sizes.get('%s/%s' % dump)
+                if (size is None or
+                        (min_size is not None and size < min_size) or
+                        (max_size is not None and size > max_size)):
+                    return False
+            return True
+
+        return page._replace(dumps=[
+            dump for dump in page.dumps if matches(dump)
+        ])
+
+    def local_path(self, db, filename):
+        return self.storage.local_path(db, filename)
+
+    def accel_redirect_uri(self, db, filename):
+        return self.storage.accel_redirect_uri(db, filename)
+
+    def stat_dump(self, db, filename):
+        return self.storage.stat_dump(db, filename)
+
+    def read_dump(self, db, filename, offset=0, length=None):
+        return self.storage.read_dump(
+            db, filename, offset=offset, length=length
+        )
 
     def public_keys(self):
         return self.encrypter.public_keys()
@@ -75,8 +516,48 @@ class Bagger():
     def recipients(self):
         return self.encrypter.recipients()
 
-    def download_commands(self, dbname, dump):
+    def dump_checksum(self, dbname, filename):
+        """ Return the sha256 of a dump, None if it is unknown
+
+        From the catalog when it has it, otherwise from the storage.
+        """
+        if self.catalog is not None:
+            record = self.catalog.get(dbname, filename)
+            if record and record['checksum']:
+                return record['checksum']
+        return self.storage.read_checksum(dbname, filename)
+
+    def _commanders_key(self):
+        # what the download commands depend on besides the dump, never the
+        # credentials of the storage
+        return (
+            type(self.storage).__name__,
+            self.storage.location(),
+            getattr(self.storage.options, 'endpoint_url', None),
+            type(self.encrypter).__name__,
+            type(self.db.commander).__name__,
+        )
+
+    def download_commands(self, dbname, dump, checksum=None):
+        """ Return the commands to download and restore a dump
+
+        The commands only depend on the configuration of the commanders,
+        on the name of the dump and on its checksum, they are memoised.
 
+        :param checksum: sha256 of the dump, to check it once downloaded
+        """
+        url = url_for('download_dump', db=dbname, filename=dump,
+                      _external=True)
+        key = (self._commanders_key(), url, checksum)
+        commands = _download_commands.get(key)
+        if commands is None:
+            commands = self._render_download_commands(
+                dbname, dump, url, checksum
+            )
+            _download_commands.put(key, commands)
+        return commands
+
+    def _render_download_commands(self, dbname, dump, url, checksum=None):
         lines = [
             "# Using wget",
             "$$ wget $url",
@@ -84,12 +565,7 @@ class Bagger():
         params = {
             'dbname': dbname,
             'filename': dump,
-            'url': url_for(
-                'download_dump',
-                db=dbname,
-                filename=dump,
-                _external=True,
-            ),
+            'url': url,
         }
         storage_command, storage_params = self.storage.download_commands(
             dbname, dump
@@ -100,6 +576,14 @@ class Bagger():
         if storage_params:
             params.update(storage_params)
 
+        if checksum:
+            lines += [
+                '',
+                "# Check the integrity of the dump",
+                "$$ echo '$sha256  $filename' | sha256sum -c",
+            ]
+            params['sha256'] = checksum
+
         encrypter_dl_func = self.encrypter.download_commands
         (encryption_command,
             encryption_params) = encrypter_dl_func(dbname, dump)
@@ -110,6 +594,15 @@ class Bagger():
         if encryption_params:
             params.update(encryption_params)
 
+        db_command, db_params = self.db.commander.download_commands(
+            dbname, dump
+        )
+        if db_command:
+            lines.append('')
+            lines += db_command
+        if db_params:
+            params.update(db_params)
+
         tmpl = Template('\n'.join(lines))
         s = tmpl.substitute(**params)
         return s
@@ -0,0 +1,121 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class ListingCache():
+    """ In-memory cache of the listings of a storage
+
+    Keeps the listing of all the databases and the listings of single
+    databases, each one for ``ttl`` seconds. A listing of a database is
+    served from the listing of all the databases when it is fresh.
+
+    The cache is kept by each process: :meth:`invalidate` only applies to
+    the current process, the other ones (e.g. uwsgi workers) see the
+    dumps pushed or removed by this one at the end of the ``ttl``.
+
+    :param list_by_db: function returning the listing, same signature as
+                       :meth:`StorageCommander.list_by_db`
+    :param ttl: seconds before an entry is refreshed
+    """
+
+    def __init__(self, list_by_db, ttl):
+        self._list_by_db = list_by_db
+        self.ttl = ttl
+        # {dbname or None for all: (expire timestamp, listing)}
+        self._entries = {}
+        # incremented by invalidate, so a listing fetched before an
+        # invalidation is not kept
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    @staticmethod
+    def _copy(listing):
+        return {
+            dbname: type(files)(files) for dbname, files in listing.items()
+        }
+
+    def list_by_db(self, dbname=None):
+        with self._lock:
+            generation = self._generation
+            listing = self._fresh(dbname)
+            if listing is None and dbname:
+                full = self._fresh(None)
+                if full is not None:
+                    listing = {
+                        name: files for name, files in full.items()
+                        if name == dbname
+                    }
+        if listing is None:
+            # not locked during the call to the storage, at worst a
+            # listing is fetched twice
+            listing = self._list_by_db(dbname=dbname)
+            with self._lock:
+                # the listing can miss a dump pushed meanwhile
+                if generation == self._generation:
+                    self._entries[dbname] = (time.time() + self.ttl, listing)
+        return self._copy(listing)
+
+    def invalidate(self, dbname=None):
+        """ Forget the listings containing the database
+
+        Without database, forget everything.
+        """
+        with self._lock:
+            self._generation += 1
+            if dbname:
+                self._entries.pop(dbname, None)
+                self._entries.pop(None, None)
+            else:
+                self._entries.clear()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def listing_cache(storage, ttl):
+    """ Return the listing cache shared by the commanders of a storage """
+    key = storage.location()
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ListingCache(storage.list_by_db, ttl)
+    return cache
+
+
+class LRUCache():
+    """ Thread-safe mapping keeping the ``size`` last used entries """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,436 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from .storage import DumpPage
+
+_logger = logging.getLogger(__name__)
+
+# 20170904-143345 in 'prod_template-20170904-143345.pg'
+RE_DUMP_DATE = re.compile(r".*(\d{8}-\d{6}).*")
+
+# dumps per page of the listings of the storage during a reconciliation
+RECONCILE_PAGE_SIZE = 1000
+
+# columns added with the validation of the dumps, on existing databases too
+DUMP_VALIDATION_COLUMNS = (
+    ('validation', 'TEXT'),
+    ('validation_error', 'TEXT'),
+)
+
+
+def dump_timestamp(filename):
+    """ Timestamp of the date in the name of a dump, None if it has none
+
+    The names are generated with the local time of the server.
+    """
+    match = RE_DUMP_DATE.match(filename)
+    if match is None:
+        return None
+    try:
+        moment = datetime.strptime(match.groups()[0], "%Y%m%d-%H%M%S")
+    except ValueError:
+        return None
+    return moment.timestamp()
+
+
+def _like_pattern(text):
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%')
+    return '%%%s%%' % (escaped.replace('_', '\\_'),)
+
+
+class DumpCatalog():
+    """ Catalog of the dumps of a storage, stored in SQLite
+
+    Records the dumps pushed by the server with their date, size,
+    duration, checksum, encryption recipients and the result of their
+    validation. The listings and the searches are indexed queries instead
+    of listings of the storage. :meth:`reconcile` adds the dumps pushed by
+    other means and forgets the ones removed from the storage.
+
+    :param path: path of the SQLite database
+    :param location: URL of the root of the storage
+    """
+
+    def __init__(self, path, location):
+        self.path = path
+        self.location = location
+        self._reconciled = False
+        self._init_schema()
+
+    @contextmanager
+    def _cursor(self, immediate=False):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cr = conn.cursor()
+            cr.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield cr
+            except BaseException:
+                cr.execute('ROLLBACK')
+                raise
+            cr.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _init_schema(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS dumps ('
+                ' storage TEXT NOT NULL,'
+                ' dbname TEXT NOT NULL,'
+                ' filename TEXT NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' size INTEGER,'
+                ' duration REAL,'
+                ' checksum TEXT,'
+                ' recipients TEXT,'
+                ' recorded_at REAL NOT NULL,'
+                ' PRIMARY KEY (storage, dbname, filename)'
+                ')'
+            )
+            columns = {
+                row[1] for row in conn.execute('PRAGMA table_info(dumps)')
+            }
+            for column, definition in DUMP_VALIDATION_COLUMNS:
+                if column not in columns:
+                    conn.execute(
+                        'ALTER TABLE dumps ADD COLUMN %s %s'
+                        % (column, definition)
+                    )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS dumps_created_at '
+                'ON dumps (storage, created_at)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS dumps_dbname_created_at '
+                'ON dumps (storage, dbname, created_at)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS dumps_size '
+                'ON dumps (storage, size)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS catalog_state ('
+                ' storage TEXT PRIMARY KEY,'
+                ' reconciled_at REAL NOT NULL'
+                ')'
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def record(self, dbname, filename, size=None, duration=None,
+               checksum=None, recipients=(), created_at=None,
+               validation=None, validation_error=None):
+        """ Record a dump pushed to the storage
+
+        :param created_at: timestamp of the dump, by default the date in
+                           its name or the current time
+        :param validation: result of the validation of the dump, see
+                           :class:`~dumpbagserver.validation.DumpValidator`
+        """
+        now = time.time()
+        if created_at is None:
+            created_at = dump_timestamp(filename) or now
+        with self._cursor() as cr:
+            cr.execute(
+                'INSERT OR REPLACE INTO dumps '
+                '(storage, dbname, filename, created_at, size, duration, '
+                ' checksum, recipients, recorded_at, validation, '
+                ' validation_error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.location, dbname, filename, created_at, size, duration,
+                 checksum, ','.join(recipients) or None, now, validation,
+                 validation_error)
+            )
+
+    def forget(self, dbname, filename):
+        """ Remove a dump deleted from the storage """
+        with self._cursor() as cr:
+            cr.execute(
+                'DELETE FROM dumps '
+                'WHERE storage = ? AND dbname = ? AND filename = ?',
+                (self.location, dbname, filename)
+            )
+
+    def forget_dumps(self, dumps):
+        """ Remove several dumps deleted from the storage
+
+        :param dumps: list of tuples (dbname, filename)
+        """
+        with self._cursor() as cr:
+            cr.executemany(
+                'DELETE FROM dumps '
+                'WHERE storage = ? AND dbname = ? AND filename = ?',
+                [(self.location, dbname, filename)
+                 for dbname, filename in dumps]
+            )
+
+    @staticmethod
+    def _row_to_dict(row):
+        return {
+            'dbname': row['dbname'],
+            'filename': row['filename'],
+            'created_at': row['created_at'],
+            'size': row['size'],
+            'duration': row['duration'],
+            'checksum': row['checksum'],
+            'recipients': (row['recipients'].split(',')
+                           if row['recipients'] else []),
+            'validation': row['validation'],
+            'validation_error': row['validation_error'],
+        }
+
+    def get(self, dbname, filename):
+        """ Return the record of a dump as a dict, None if unknown """
+        with self._cursor() as cr:
+            cr.execute(
+                'SELECT * FROM dumps '
+                'WHERE storage = ? AND dbname = ? AND filename = ?',
+                (self.location, dbname, filename)
+            )
+            row = cr.fetchone()
+        return self._row_to_dict(row) if row else None
+
+    @property
+    def ready(self):
+        """ The catalog has been reconciled with the storage at least once
+
+        Before, it may not know all the dumps and must not be used for
+        the listings.
+        """
+        if not self._reconciled:
+            self._reconciled = self.reconciled_at() is not None
+        return self._reconciled
+
+    def reconciled_at(self):
+        with self._cursor() as cr:
+            cr.execute(
+                'SELECT reconciled_at FROM catalog_state WHERE storage = ?',
+                (self.location,)
+            )
+            row = cr.fetchone()
+        return row['reconciled_at'] if row else None
+
+    def reconcile(self, storage, min_interval=0):
+        """ Align the catalog on the dumps of the storage
+
+        The dumps recorded while the storage is listed are kept even if
+        the listing does not contain them. Several processes may reconcile
+        the same catalog at the same time.
+
+        :param storage: the :class:`StorageCommander` of the catalog
+        :param min_interval: seconds, the catalog is not reconciled when
+                             another process did it more recently
+        :return: dict with the numbers of dumps added and removed, None
+                 when the reconciliation is skipped
+        """
+        started = time.time()
+        if min_interval:
+            reconciled_at = self.reconciled_at()
+            if reconciled_at and reconciled_at > started - min_interval:
+                self._reconciled = True
+                return None
+        listed = {}
+        cursor = None
+        while True:
+            page = storage.list_page(cursor=cursor, limit=RECONCILE_PAGE_SIZE)
+            for dbname, filename in page.dumps:
+                listed[(dbname, filename)] = page.sizes.get(
+                    '%s/%s' % (dbname, filename)
+                )
+            cursor = page.cursor
+            if not cursor:
+                break
+        # the writes of the other processes wait for the end of this one
+        with self._cursor(immediate=True) as cr:
+            cr.execute(
+                'SELECT dbname, filename, size, recorded_at FROM dumps '
+                'WHERE storage = ?', (self.location,)
+            )
+            known = {
+                (row['dbname'], row['filename']): row for row in cr.fetchall()
+            }
+            added = [key for key in listed if key not in known]
+            removed = [
+                key for key, row in known.items()
+                if key not in listed and row['recorded_at'] < started
+            ]
+            resized = [
+                (listed[key], self.location) + key for key, row
+                in known.items()
+                if key in listed and row['size'] is None
+                and listed[key] is not None
+            ]
+            cr.executemany(
+                'INSERT OR IGNORE INTO dumps '
+                '(storage, dbname, filename, created_at, size, recorded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(self.location, dbname, filename,
+                  dump_timestamp(filename) or started,
+                  listed[(dbname, filename)], started)
+                 for dbname, filename in added]
+            )
+            added_count = max(cr.rowcount, 0)
+            cr.executemany(
+                'DELETE FROM dumps '
+                'WHERE storage = ? AND dbname = ? AND filename = ?',
+                [(self.location,) + key for key in removed]
+            )
+            removed_count = max(cr.rowcount, 0)
+            cr.executemany(
+                'UPDATE dumps SET size = ? '
+                'WHERE storage = ? AND dbname = ? AND filename = ?',
+                resized
+            )
+            cr.execute(
+                'INSERT OR REPLACE INTO catalog_state '
+                '(storage, reconciled_at) VALUES (?, ?)',
+                (self.location, started)
+            )
+        self._reconciled = True
+        if added_count or removed_count:
+            _logger.info('catalog of %s reconciled: %d dumps added, '
+                         '%d removed', self.location, added_count,
+                         removed_count)
+        return {'added': added_count, 'removed': removed_count}
+
+    def list_by_db(self, dbname=None):
+        """ Same result as :meth:`StorageCommander.list_by_db`
+
+        The dumps of a database are sorted by name.
+        """
+        query = 'SELECT dbname, filename FROM dumps WHERE storage = ?'
+        params = [self.location]
+        if dbname:
+            query += ' AND dbname = ?'
+            params.append(dbname)
+        with self._cursor() as cr:
+            cr.execute(query + ' ORDER BY dbname, filename', params)
+            rows = cr.fetchall()
+        dumps = {}
+        for row in rows:
+            dumps.setdefault(row['dbname'], []).append(row['filename'])
+        return dumps
+
+    def search(self, dbname=None, after=None, limit=1000, search=None,
+               since=None, until=None, min_size=None, max_size=None):
+        """ Return a :class:`DumpPage` of the dumps matching the filters
+
+        Same pages as :meth:`StorageCommander.list_page`, with the records
+        of the dumps in ``details``.
+
+        :param after: 'dbname/filename' before the first dump returned
+        :param search: text contained in the name of the dumps
+        :param since: minimum timestamp of the dumps
+        :param until: maximum timestamp of the dumps
+        :param min_size: minimum size of the dumps in bytes
+        :param max_size: maximum size of the dumps in bytes
+        """
+        query = 'SELECT * FROM dumps WHERE storage = ?'
+        params = [self.location]
+        if dbname:
+            query += ' AND dbname = ?'
+            params.append(dbname)
+        if after:
+            after_db, __, after_file = after.partition('/')
+            query += ' AND (dbname > ? OR (dbname = ? AND filename > ?))'
+            params += [after_db, after_db, after_file]
+        if search:
+            query += " AND filename LIKE ? ESCAPE '\\'"
+            params.append(_like_pattern(search))
+        for clause, value in (('created_at >= ?', since),
+                              ('created_at <= ?', until),
+                              ('size >= ?', min_size),
+                              ('size <= ?', max_size)):
+            if value is not None:
+                query += ' AND ' + clause
+                params.append(value)
+        query += ' ORDER BY dbname, filename LIMIT ?'
+        # one more to know if there is a next page
+        params.append(limit + 1)
+        with self._cursor() as cr:
+            cr.execute(query, params)
+            rows = [self._row_to_dict(row) for row in cr.fetchall()]
+        next_page = len(rows) > limit
+        rows = rows[:limit]
+        keys = ['%s/%s' % (row['dbname'], row['filename']) for row in rows]
+        return DumpPage(
+            [(row['dbname'], row['filename']) for row in rows],
+            keys[-1] if next_page else None,
+            {key: row['size'] for key, row in zip(keys, rows)},
+            dict(zip(keys, rows)),
+        )
+
+
+class CatalogReconciler():
+    """ Thread reconciling a catalog with its storage at an interval
+
+    :param catalog: the :class:`DumpCatalog`
+    :param storage: the :class:`StorageCommander` of the catalog
+    :param interval: seconds between two reconciliations
+    """
+
+    def __init__(self, catalog, storage, interval):
+        self.catalog = catalog
+        self.storage = storage
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(
+            target=self._loop, name='dumpbag-catalog'
+        )
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while True:
+            try:
+                # every process runs a reconciler, one of them is enough
+                self.catalog.reconcile(self.storage,
+                                       min_interval=self.interval)
+            except Exception:
+                _logger.exception('could not reconcile the catalog of %s',
+                                  self.catalog.location)
+            if self._stop.wait(self.interval):
+                return
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def dump_catalog(config, storage):
+    """ Return the catalog of the dumps of a storage
+
+    None when the catalog is deactivated. The first call starts the
+    reconciliation of the catalog with the storage.
+    """
+    if not config.catalog:
+        return None
+    key = (config.state_db, storage.location())
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = _catalogs[key] = DumpCatalog(*key)
+            if config.catalog_reconcile_interval:
+                CatalogReconciler(
+                    catalog, storage, config.catalog_reconcile_interval
+                ).start()
+    return catalog
@@ -0,0 +1,94 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+
+class ActivityMarkers():
+    """ Activity markers of the databases at the time of their last dump
+
+    A marker is a string given by the database commander (e.g. the write
+    counters of ``pg_stat_database``). When the marker of a database has
+    not changed since its last dump, the database has not been written
+    and its last dump is still valid. Stored in the SQLite state database.
+
+    :param path: path of the SQLite database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._init_schema()
+
+    @contextmanager
+    def _cursor(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn.cursor()
+        finally:
+            conn.close()
+
+    def _init_schema(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS activity_markers ('
+                ' dbname TEXT PRIMARY KEY,'
+                ' marker TEXT NOT NULL,'
+                ' filename TEXT NOT NULL,'
+                ' dumped_at REAL NOT NULL,'
+                ' skipped_at REAL,'
+                ' skips INTEGER NOT NULL DEFAULT 0'
+                ')'
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, dbname):
+        """ Return the marker of the last dump as a dict, None if unknown """
+        with self._cursor() as cr:
+            cr.execute(
+                'SELECT * FROM activity_markers WHERE dbname = ?', (dbname,)
+            )
+            row = cr.fetchone()
+        return dict(row) if row else None
+
+    def record_dump(self, dbname, marker, filename):
+        """ Record the marker read before the dump of a database """
+        with self._cursor() as cr:
+            cr.execute(
+                'INSERT OR REPLACE INTO activity_markers '
+                '(dbname, marker, filename, dumped_at, skipped_at, skips) '
+                'VALUES (?, ?, ?, ?, NULL, 0)',
+                (dbname, marker, filename, time.time())
+            )
+
+    def record_skip(self, dbname):
+        """ Record that the dump of an unchanged database was skipped """
+        with self._cursor() as cr:
+            cr.execute(
+                'UPDATE activity_markers SET skipped_at = ?, '
+                'skips = skips + 1 WHERE dbname = ?',
+                (time.time(), dbname)
+            )
+
+
+_markers = None
+
+
+def activity_markers(config):
+    """ Return the markers of the process
+
+    None when the unchanged databases are not skipped.
+    """
+    global _markers
+    if not (config.skip_unchanged and config.state_db):
+        return None
+    if _markers is None:
+        _markers = ActivityMarkers(config.state_db)
+    return _markers
@@ -1,12 +1,39 @@
 # -*- coding: utf-8 -*-
 from os import environ as env
-from .database import StaticOptions, PostgresOptions
-from .storage import LocalOptions, S3Options
+from .database import (
+    COMPRESSION_EXTENSIONS, StaticOptions, PostgresOptions,
+)
+from .storage import LocalOptions, S3Options, S3ClientOptions
+from .dedup import DedupOptions
 from .encryption import NoOpEncryptionOptions, GPGKeysOptions
+from .retention import Retention, parse_retention
+from .scheduler import parse_schedules
+from .validation import VALIDATION_MODES
 
 from .exception import DumpConfigurationError
 
 
+def _env_bool(name, default=False):
+    value = env.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_int(name, default, minimum=0):
+    value = env.get(name, str(default))
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise DumpConfigurationError(
+            "%s must be an integer greater or equal to %d, got '%s'"
+            % (name, minimum, value)
+        )
+    return number
+
+
 class FlaskConfig(object):
     SECRET_KEY = env.get('FLASK_SECRET_KEY', '')
     DEBUG = env.get('FLASK_DEBUG', False)
@@ -25,6 +52,135 @@ class DumpBagConfig(object):
         exclude = env.get('BAG_EXCLUDE_DATABASE', '').strip()
         return exclude.split(',') if exclude else []
 
+    @property
+    def streaming(self):
+        """ Stream the dumps through encryption to the storage
+
+        When activated, no temporary file is written on the disk.
+        """
+        return _env_bool('BAG_STREAMING')
+
+    @property
+    def metrics(self):
+        """ Expose the metrics on /metrics """
+        return _env_bool('BAG_METRICS', True)
+
+    @property
+    def metrics_bytes(self):
+        """ Count the bytes of the stages of the streamed dumps
+
+        The output of a stage is then read by Python instead of being
+        given directly to the process of the next stage. The dumps made in
+        a file are counted from the size of their files.
+        """
+        return _env_bool('BAG_METRICS_BYTES')
+
+    @property
+    def dump_concurrency(self):
+        """ Number of databases dumped at the same time by 'dumpall' """
+        return _env_int('BAG_DUMP_CONCURRENCY', 1, minimum=1)
+
+    @property
+    def dump_validation(self):
+        """ Validation of the dumps while they are pushed, None to not
+
+        'list' reads the table of contents of the dumps, 'restore' restores
+        them in a scratch database.
+        """
+        mode = env.get('BAG_DUMP_VALIDATION', '').strip().lower()
+        if mode in ('', 'none'):
+            return None
+        if mode not in VALIDATION_MODES:
+            raise DumpConfigurationError(
+                "'%s' is not a valid dump validation among [none,%s]"
+                % (mode, ','.join(VALIDATION_MODES))
+            )
+        return mode
+
+    @property
+    def listing_cache_ttl(self):
+        """ Seconds during which the listings of the storage are cached
+
+        0 to deactivate the cache.
+        """
+        return _env_int('BAG_LISTING_CACHE_TTL', 60)
+
+    @property
+    def state_db(self):
+        """ Path of the SQLite database keeping the state of the server
+
+        When set, the dumps are run asynchronously as jobs.
+        """
+        return env.get('BAG_STATE_DB') or None
+
+    @property
+    def catalog(self):
+        """ Keep a catalog of the dumps in the state database
+
+        The listings and the searches of the dumps are then served by the
+        catalog instead of the storage.
+        """
+        return bool(self.state_db) and _env_bool('BAG_CATALOG', True)
+
+    @property
+    def catalog_reconcile_interval(self):
+        """ Seconds between the reconciliations of the catalog
+
+        0 to not reconcile the catalog in this process.
+        """
+        return _env_int('BAG_CATALOG_RECONCILE_INTERVAL', 600)
+
+    @property
+    def job_workers(self):
+        """ Number of jobs run at the same time by this process
+
+        0 for a process which only pushes jobs to the queue.
+        """
+        return _env_int('BAG_JOB_WORKERS', 1)
+
+    @property
+    def skip_unchanged(self):
+        """ Do not dump again the databases not written since their dump
+
+        Applies to 'dumpall' and the scheduled runs, requires the state
+        database. The writes are detected with the tuple counters of
+        pg_stat_database: a database whose only changes are on sequences
+        (nextval, setval) is considered as unchanged.
+        """
+        return _env_bool('BAG_SKIP_UNCHANGED')
+
+    @property
+    def schedules(self):
+        """ Schedules of the dumps run by the server, see README
+
+        Requires the state database and job workers.
+        """
+        return parse_schedules(env.get('BAG_SCHEDULES', ''))
+
+    @property
+    def schedule_stagger(self):
+        """ Seconds between the starts of the dumps of a scheduled run """
+        return _env_int('BAG_SCHEDULE_STAGGER', 60)
+
+    @property
+    def schedule_retries(self):
+        """ Number of retries of a failed dump of a scheduled run """
+        return _env_int('BAG_SCHEDULE_RETRIES', 2)
+
+    @property
+    def schedule_retry_delay(self):
+        """ Seconds between a failed dump of a scheduled run and its retry """
+        return _env_int('BAG_SCHEDULE_RETRY_DELAY', 900)
+
+    @property
+    def retention(self):
+        """ :class:`Retention` of the dumps, None when they are all kept
+
+        See README.
+        """
+        policies = parse_retention(env.get('BAG_RETENTION', ''))
+        return Retention(policies) if policies else None
+
     @property
     def database_kind(self):
         return env.get('BAG_DB_KIND', 'static')
@@ -54,15 +210,77 @@ class DumpBagConfig(object):
                     " - BAG_DB_USER\n"
                     " - BAG_DB_PASSWORD"
                 )
-            return PostgresOptions(db_host, db_user, db_password, port=db_port)
+            compression = env.get('BAG_DUMP_COMPRESSION', 'zlib')
+            if compression not in COMPRESSION_EXTENSIONS:
+                raise DumpConfigurationError(
+                    "'%s' is not a valid compression among [%s]"
+                    % (compression, ','.join(sorted(COMPRESSION_EXTENSIONS)))
+                )
+            compression_level = None
+            if env.get('BAG_DUMP_COMPRESSION_LEVEL'):
+                compression_level = _env_int('BAG_DUMP_COMPRESSION_LEVEL', 0)
+            return PostgresOptions(
+                db_host, db_user, db_password, port=db_port,
+                jobs=_env_int('BAG_DB_DUMP_JOBS', 1, minimum=1),
+                compression=compression,
+                compression_level=compression_level,
+                compression_threads=_env_int(
+                    'BAG_DUMP_COMPRESSION_THREADS', 1
+                ),
+                list_cache_ttl=_env_int('BAG_DB_LIST_CACHE_TTL', 10),
+                standbys=self._standbys(db_port),
+                standby_catchup_timeout=_env_int(
+                    'BAG_DB_STANDBY_CATCHUP_TIMEOUT', 60
+                ),
+                validation_server=self._validation_server(db_port),
+            )
         else:
             raise DumpConfigurationError(
                 "'%s' is not a valid kind of database among [static,postgres]"
                 % (kind,)
             )
 
-    def storage_options(self):
-        kind = self.storage_kind
+    @staticmethod
+    def _standbys(default_port):
+        standbys = []
+        for server in env.get('BAG_DB_STANDBY_HOSTS', '').split(','):
+            if not server.strip():
+                continue
+            host, __, port = server.strip().partition(':')
+            if port and not port.isdigit():
+                raise DumpConfigurationError(
+                    "BAG_DB_STANDBY_HOSTS must be a list of host[:port], "
+                    "got '%s'" % (server,)
+                )
+            standbys.append((host, port or default_port))
+        return standbys
+
+    def _validation_server(self, default_port):
+        """ (host, port) of the scratch databases of the 'restore' validation
+
+        Required by the 'restore' validation, which never restores the dumps
+        on the primary.
+        """
+        server = env.get('BAG_DUMP_VALIDATION_HOST', '').strip()
+        if not server:
+            if self.dump_validation == 'restore':
+                raise DumpConfigurationError(
+                    "BAG_DUMP_VALIDATION=restore requires "
+                    "BAG_DUMP_VALIDATION_HOST, the server of the scratch "
+                    "databases"
+                )
+            return None
+        host, __, port = server.partition(':')
+        if port and not port.isdigit():
+            raise DumpConfigurationError(
+                "BAG_DUMP_VALIDATION_HOST must be a host[:port], got '%s'"
+                % (server,)
+            )
+        return (host, port or default_port)
+
+    def storage_options(self, kind=None):
+        if kind is None:
+            kind = self.storage_kind
         if kind == 'local':
             storage_dir = env.get('BAG_STORAGE_LOCAL_DIR')
             if not storage_dir:
@@ -71,8 +289,13 @@ class DumpBagConfig(object):
                     "are required: \n"
                     " - BAG_LOCAL_STORAGE_DIR\n"
                 )
-            return LocalOptions(storage_dir)
-        elif kind == 's3':
+            return LocalOptions(
+                storage_dir,
+                accel_redirect=(
+                    env.get('BAG_STORAGE_LOCAL_ACCEL_REDIRECT') or None
+                ),
+            )
+        elif kind in ('s3', 's3-client'):
             bucket = env.get('BAG_S3_BUCKET_NAME')
             access_key = env.get('BAG_S3_ACCESS_KEY')
             secret_access_key = env.get('BAG_S3_SECRET_ACCESS_KEY')
@@ -84,11 +307,57 @@ class DumpBagConfig(object):
                     " - BAG_S3_ACCESS_KEY\n"
                     " - BAG_S3_SECRET_ACCESS_KEY"
                 )
-            return S3Options(bucket, access_key, secret_access_key)
+            if kind == 's3-client':
+                return S3ClientOptions(
+                    bucket, access_key, secret_access_key,
+                    endpoint_url=env.get('BAG_S3_ENDPOINT_URL') or None,
+                    region=env.get('BAG_S3_REGION') or None,
+                    part_size=(
+                        _env_int('BAG_S3_PART_SIZE_MB', 64, minimum=5)
+                        * 1024 ** 2
+                    ),
+                    max_concurrency=_env_int(
+                        'BAG_S3_MAX_CONCURRENCY', 8, minimum=1
+                    ),
+                )
+            expected_size = env.get('BAG_S3_STREAM_EXPECTED_SIZE')
+            return S3Options(
+                bucket, access_key, secret_access_key,
+                stream_expected_size=(
+                    int(expected_size) if expected_size else None
+                ),
+            )
+        elif kind == 'dedup':
+            backend = env.get('BAG_DEDUP_BACKEND', 'local')
+            if backend not in ('local', 's3-client'):
+                raise DumpConfigurationError(
+                    "'%s' is not a valid backend for the dedup storage "
+                    "among [local,s3-client]" % (backend,)
+                )
+            passphrase_file = env.get('BAG_DEDUP_PASSPHRASE_FILE')
+            if not passphrase_file:
+                raise DumpConfigurationError(
+                    "For dedup storage, the following environment variables "
+                    "are required: \n"
+                    " - BAG_DEDUP_PASSPHRASE_FILE"
+                )
+            return DedupOptions(
+                self.storage_options(kind=backend),
+                self.encryption_options(),
+                passphrase_file,
+                chunk_size=(
+                    _env_int('BAG_DEDUP_CHUNK_SIZE_KB', 1024, minimum=64)
+                    * 1024
+                ),
+                max_concurrency=_env_int(
+                    'BAG_DEDUP_MAX_CONCURRENCY', 4, minimum=1
+                ),
+                gc_grace=_env_int('BAG_DEDUP_GC_GRACE', 24 * 3600),
+            )
         else:
             raise DumpConfigurationError(
-                "'%s' is not a valid kind of storage among [local,s3]"
-                % (kind,)
+                "'%s' is not a valid kind of storage among "
+                "[local,s3,s3-client,dedup]" % (kind,)
             )
 
     def encryption_options(self):
@@ -1,18 +1,48 @@
 # Copyright 2017 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import io
 import logging
 import os
+import random
+import re
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
+import uuid
+import zlib
 
+from contextlib import contextmanager
 from subprocess import PIPE
 
 from .exception import DumpingError
+from .stream import CHUNK_SIZE, PipedProcess
 
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:  # the metadata queries are then run with psql
+    psycopg2 = None
 
 _logger = logging.getLogger(__name__)
 
+# extension added to the dumps by the compression codecs
+COMPRESSION_EXTENSIONS = {
+    'zlib': '',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+    'none': '',
+}
+
+# commands of the download instructions decompressing a dump, zstd takes
+# a second file name as another input, lz4 as the output
+DECOMPRESS_COMMANDS = {
+    'zstd': 'zstd -d $compressed -o $decompressed',
+    'lz4': 'lz4 -d $compressed $decompressed',
+}
+
 
 class DatabaseOptions():
     """ Base options for commanders """
@@ -40,9 +70,56 @@ class DatabaseCommander():
     def list_databases(self):
         raise NotImplementedError
 
+    def database_sizes(self):
+        """ Return the size in bytes of the databases
+
+        :return: dict {dbname: size}, the size is None when unknown
+        """
+        return {dbname: None for dbname in self.list_databases()}
+
+    def activity_markers(self):
+        """ Return markers of the writes in the databases
+
+        A marker changes when a database is written, the databases
+        without marker are considered as changed.
+
+        :return: dict {dbname: marker}
+        """
+        return {}
+
+    def dump_extension(self):
+        """ Extension of the dump files """
+        return '.pg'
+
+    def download_commands(self, dbname, filename):
+        return [], {}
+
     def exec_dump(self, dbname, target):
         raise NotImplementedError
 
+    @contextmanager
+    def exec_dump_stream(self, dbname):
+        """ Dump a database to a stream
+
+        Context manager yielding a binary file object with the content
+        of the dump. Leaving the context waits for the end of the dump
+        and raises :class:`DumpingError` if it failed.
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def validation_pipeline(self, dbname, mode):
+        """ Commands validating a dump read on their stdin
+
+        Context manager yielding a tuple (commands, env) where the commands
+        are piped together, see
+        :class:`~dumpbagserver.validation.DumpValidator`. Yields None when
+        the dumps of the commander cannot be validated.
+
+        :param mode: one of :data:`~dumpbagserver.validation.VALIDATION_MODES`
+        """
+        yield None
+
 
 class StaticDatabaseCommander(DatabaseCommander):
     """ Commander used for tests
@@ -59,15 +136,190 @@ class StaticDatabaseCommander(DatabaseCommander):
         with open(target, 'w') as fh:
             fh.write('test %s' % (dbname,))
 
+    @contextmanager
+    def exec_dump_stream(self, dbname):
+        yield io.BytesIO(('test %s' % (dbname,)).encode('utf8'))
+
 
 class StaticOptions():
     """ Options for the static commander """
     _commander = StaticDatabaseCommander
 
 
+class SyntheticDumpStream():
+    """ Generated stream of ``size`` bytes
+
+    Every page of 4KB starts with random bytes, a proportion ``entropy``
+    of the page, and ends with repeated rows of text: the stream is as
+    compressible as a dump with the same proportion of incompressible data.
+    The content depends only on the seed.
+
+    The random bytes are taken at random offsets of a pool generated
+    once, which is much faster than generating them for every page.
+    """
+
+    PAGE_SIZE = 4096
+    POOL_SIZE = 16 * 1024 ** 2
+    ROW = b'4242\tres.partner\tAgrolait\t2017-09-04 09:23:33\tt\n'
+
+    def __init__(self, size, entropy=1.0, seed=0):
+        self._remaining = size
+        self._random = random.Random(seed)
+        self._random_size = int(self.PAGE_SIZE * entropy)
+        rows = self.ROW * (self.PAGE_SIZE // len(self.ROW) + 1)
+        self._filler = rows[:self.PAGE_SIZE - self._random_size]
+        self._pool = b''
+        if self._random_size:
+            pool_size = min(self.POOL_SIZE, size) + self._random_size
+            self._pool = self._random.getrandbits(
+                pool_size * 8
+            ).to_bytes(pool_size, 'little')
+        self._buffer = b''
+
+    def _page(self):
+        if not self._random_size:
+            return self._filler
+        offset = self._random.randrange(
+            len(self._pool) - self._random_size
+        )
+        return self._pool[offset:offset + self._random_size] + self._filler
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        pages = [self._buffer]
+        length = len(self._buffer)
+        while length < size:
+            page = self._page()
+            pages.append(page)
+            length += len(page)
+        data = b''.join(pages)
+        self._buffer = data[size:]
+        self._remaining -= size
+        return data[:size]
+
+
+class SyntheticDatabaseCommander(DatabaseCommander):
+    """ Commander generating dumps, used for benchmarks
+
+    The dumps of a database are the same at every call.
+
+    :params options: options for the commands
+    :type options: SyntheticOptions
+
+    """
+
+    def list_databases(self):
+        return list(self.options.databases)
+
+    def database_sizes(self):
+        return {dbname: self.options.size for dbname in self.list_databases()}
+
+    def _stream(self, dbname):
+        return SyntheticDumpStream(
+            self.options.size, entropy=self.options.entropy,
+            seed=zlib.crc32(dbname.encode('utf8')) + self.options.seed,
+        )
+
+    def exec_dump(self, dbname, target):
+        with open(target, 'wb') as f:
+            shutil.copyfileobj(self._stream(dbname), f, CHUNK_SIZE)
+
+    @contextmanager
+    def exec_dump_stream(self, dbname):
+        yield self._stream(dbname)
+
+
+class SyntheticOptions():
+    """ Options for the synthetic commander
+
+    :param size: size of the dumps in bytes
+    :param entropy: proportion of random bytes, from 0 to 1
+    :param databases: names of the databases
+    :param seed: change it to generate other dumps
+    """
+    _commander = SyntheticDatabaseCommander
+
+    def __init__(self, size, entropy=1.0, databases=('db1', 'db2', 'db3'),
+                 seed=0):
+        self.size = size
+        self.entropy = entropy
+        self.databases = databases
+        self.seed = seed
+
+
+class MetadataConnectionPool():
+    """ Connections to the 'postgres' database for the metadata queries
+
+    The connections are opened on demand and kept open, a thread waits
+    for a free connection when ``size`` connections are used.
+    """
+
+    def __init__(self, host, port, user, password, size=4):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            0, size, host=host, port=port, user=user, password=password,
+            dbname='postgres', connect_timeout=10, application_name='dumpbag',
+        )
+        self._free = threading.BoundedSemaphore(size)
+
+    def query(self, query, params=None):
+        """ Return the rows of a query
+
+        A connection closed by the server is replaced once.
+        """
+        with self._free:
+            for attempt in (1, 2):
+                conn = self._pool.getconn()
+                try:
+                    conn.autocommit = True
+                    with conn.cursor() as cr:
+                        cr.execute(query, params)
+                        rows = cr.fetchall()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self._pool.putconn(conn, close=True)
+                    if attempt == 2:
+                        raise
+                    continue
+                except Exception:
+                    self._pool.putconn(conn, close=True)
+                    raise
+                self._pool.putconn(conn)
+                return rows
+
+
+_metadata_pools = {}
+_metadata_lock = threading.Lock()
+# {key of the server: (expire timestamp, list of databases)}
+_database_lists = {}
+
+
+def _server_key(options, host=None, port=None):
+    return (host or options.host, str(port or options.port), options.user,
+            options.password)
+
+
+def _metadata_pool(options, host=None, port=None):
+    """ Return the pool shared by the commanders of the same server """
+    key = _server_key(options, host=host, port=port)
+    with _metadata_lock:
+        pool = _metadata_pools.get(key)
+        if pool is None:
+            pool = _metadata_pools[key] = MetadataConnectionPool(*key)
+    return pool
+
+
+RE_LSN = re.compile(r'^[0-9A-F]+/[0-9A-F]+$')
+
+
 class PostgresDatabaseCommander(DatabaseCommander):
     """ Commander used for PostgreSQL
 
+    The metadata (list of databases, sizes) are read on the primary
+    server with a pool of connections shared by the commanders, or with
+    ``psql`` when psycopg2 is not installed. ``pg_dump`` is the only
+    command run, on a standby server when one is available (see
+    :meth:`_dump_server`).
+
     :params options: options for the commands
     :type options: PostgresOptions
 
@@ -78,18 +330,36 @@ class PostgresDatabaseCommander(DatabaseCommander):
                 }
         return vars
 
-    def list_databases(self):
-        psql_env = os.environ.copy()
-        psql_env.update(**self._env_variables())
-        command = [
+    def _query(self, query, host=None, port=None):
+        """ Return the rows of a metadata query, empty on error
+
+        :param host: server of the query, the primary by default
+        """
+        if psycopg2 is None or not self.options.metadata_connection:
+            return self._psql(query, host=host, port=port)
+        try:
+            return _metadata_pool(self.options, host=host, port=port).query(
+                query
+            )
+        except psycopg2.Error as err:
+            _logger.error('error when reading the databases:\n%s', err)
+            return []
+
+    def _psql_command(self, query, host=None, port=None):
+        return [
             'psql',
-            '--host', self.options.host,
-            '--port', str(self.options.port),
+            '--host', host or self.options.host,
+            '--port', str(port or self.options.port),
             '--username', self.options.user,
             '--quiet', '--no-align', '--tuples-only',
             '--dbname', 'postgres',
-            '--command', 'SELECT datname FROM pg_database',
+            '--command', query,
         ]
+
+    def _psql(self, query, host=None, port=None):
+        psql_env = os.environ.copy()
+        psql_env.update(**self._env_variables())
+        command = self._psql_command(query, host=host, port=port)
         proc = subprocess.Popen(
             command, env=psql_env, stdin=PIPE, stdout=PIPE, stderr=PIPE
         )
@@ -98,23 +368,209 @@ class PostgresDatabaseCommander(DatabaseCommander):
             _logger.error(
                 'error when listing databases:\n%s', stderr.decode('utf8')
             )
-        return stdout.decode('utf8').split()
+        # NULL is an empty value
+        return [
+            tuple(value or None for value in line.split('|'))
+            for line in stdout.decode('utf8').splitlines() if line
+        ]
 
-    def exec_dump(self, dbname, target):
+    def list_databases(self):
+        """ Return the databases, cached for ``list_cache_ttl`` seconds
+
+        The list is read again by every dump to check the database.
+        """
+        key = _server_key(self.options)
+        with _metadata_lock:
+            entry = _database_lists.get(key)
+        if entry and entry[0] > time.time():
+            return list(entry[1])
+        databases = [
+            row[0] for row in self._query('SELECT datname FROM pg_database')
+        ]
+        if databases and self.options.list_cache_ttl:
+            with _metadata_lock:
+                _database_lists[key] = (
+                    time.time() + self.options.list_cache_ttl, databases
+                )
+        return list(databases)
+
+    def database_sizes(self):
+        # the size of a database needs the privilege to connect to it
+        rows = self._query(
+            "SELECT datname, CASE WHEN has_database_privilege(datname, "
+            "'CONNECT') THEN pg_database_size(datname) END FROM pg_database"
+        )
+        return {
+            dbname: int(size) if size is not None else None
+            for dbname, size in rows
+        }
+
+    def activity_markers(self):
+        # xact_commit is not used, read-only transactions (pg_dump too)
+        # increase it, nor the WAL position, shared by all the databases.
+        # TRUNCATE and DDL update the system catalogs so they change the
+        # counters, nextval/setval alone do not (see skip_unchanged);
+        # the counters are reset after a crash, changing stats_reset
+        rows = self._query(
+            "SELECT datname, tup_inserted, tup_updated, tup_deleted, "
+            "stats_reset FROM pg_stat_database WHERE datname IS NOT NULL"
+        )
+        return {
+            row[0]: ':'.join(str(value) for value in row[1:])
+            for row in rows
+        }
+
+    def _process_env(self):
         psql_env = os.environ.copy()
         psql_env.update(**self._env_variables())
-        command = [
-            'pg_dump',
-            '--format', 'c',
-            '--host', self.options.host,
-            '--port', self.options.port,
+        return psql_env
+
+    @property
+    def _parallel(self):
+        return self.options.jobs > 1
+
+    @property
+    def _compressor(self):
+        """ Command compressing the dump, None when pg_dump compresses """
+        codec = self.options.compression
+        level = self.options.compression_level
+        if codec == 'zstd':
+            command = ['zstd', '--stdout', '--quiet',
+                       '-T%d' % (self.options.compression_threads,)]
+        elif codec == 'lz4':
+            command = ['lz4', '--stdout', '--quiet']
+        else:
+            return None
+        if level is not None:
+            command.append('-%d' % (level,))
+        return command
+
+    @property
+    def _decompressor(self):
+        """ Command decompressing the dump, None when pg_restore can """
+        if self._compressor is None:
+            return None
+        return [self.options.compression, '-d', '--stdout', '--quiet']
+
+    def dump_extension(self):
+        # the directory format is packed in a tar
+        extension = '.pg.tar' if self._parallel else '.pg'
+        return extension + COMPRESSION_EXTENSIONS[self.options.compression]
+
+    def download_commands(self, dbname, filename):
+        if filename.endswith('.gpg'):
+            filename = filename[:-len('.gpg')]
+        lines = []
+        params = {}
+        for codec, extension in COMPRESSION_EXTENSIONS.items():
+            if extension and filename.endswith(extension):
+                params['compressed'] = filename
+                filename = filename[:-len(extension)]
+                params['decompressed'] = filename
+                lines += [
+                    "# decompress the dump",
+                    "$$ %s" % (DECOMPRESS_COMMANDS[codec],),
+                ]
+        if filename.endswith('.pg.tar'):
+            lines += [
+                "# restore the directory format dump with parallel jobs",
+                "$$ mkdir $restore_dir && tar -xf $archive -C $restore_dir",
+                "$$ pg_restore --jobs 4 --dbname <database> $restore_dir",
+            ]
+            params.update({
+                'archive': filename,
+                'restore_dir': filename[:-len('.tar')],
+            })
+        return lines, params
+
+    def _caught_up(self, host, port, lsn):
+        """ Wait until a standby has replayed the WAL up to a position """
+        deadline = time.time() + self.options.standby_catchup_timeout
+        while True:
+            rows = self._query(
+                "SELECT pg_last_wal_replay_lsn() >= '%s'::pg_lsn" % (lsn,),
+                host=host, port=port,
+            )
+            if rows and rows[0][0] in (True, 't'):
+                return True
+            if not rows or time.time() >= deadline:
+                return False
+            time.sleep(1)
+
+    def _dump_server(self):
+        """ Return the (host, port) of the server to dump from
+
+        The standby servers replicating the primary are tried from the
+        most up to date, then the least loaded (active connections). A
+        standby is used once it has replayed the WAL written on the
+        primary until now, so the dump contains everything committed
+        before it, otherwise the primary is used.
+        """
+        primary = (self.options.host, str(self.options.port))
+        if not self.options.standbys:
+            return primary
+        rows = self._query('SELECT pg_current_wal_lsn()')
+        if not rows or not RE_LSN.match(str(rows[0][0])):
+            return primary
+        lsn = rows[0][0]
+        candidates = []
+        for host, port in self.options.standbys:
+            rows = self._query(
+                "SELECT pg_is_in_recovery(), "
+                "pg_wal_lsn_diff('%s'::pg_lsn, pg_last_wal_replay_lsn()), "
+                "(SELECT count(*) FROM pg_stat_activity "
+                "WHERE state = 'active')" % (lsn,),
+                host=host, port=port,
+            )
+            if not rows:
+                continue
+            in_recovery, behind, active = rows[0]
+            if in_recovery not in (True, 't') or behind is None:
+                # promoted or not replicating
+                continue
+            candidates.append(
+                (max(float(behind), 0), int(active), host, str(port))
+            )
+        for behind, active, host, port in sorted(candidates):
+            if self._caught_up(host, port, lsn):
+                _logger.info('dumping from the standby %s:%s', host, port)
+                return host, port
+            _logger.warning('the standby %s:%s is %d bytes behind the '
+                            'primary', host, port, behind)
+        _logger.info('no standby is available, dumping from the primary')
+        return primary
+
+    def _dump_command(self, dbname, target=None):
+        host, port = self._dump_server()
+        command = ['pg_dump']
+        if self._parallel:
+            # only the directory format can be dumped with several jobs
+            command += ['--format', 'd', '--jobs', str(self.options.jobs)]
+        else:
+            command += ['--format', 'c']
+        command += [
+            '--host', host,
+            '--port', port,
             '--username', self.options.user,
             '--no-owner',
-            '--file', target,
-            dbname
         ]
+        if self.options.compression == 'zlib':
+            if self.options.compression_level is not None:
+                command += [
+                    '--compress', str(self.options.compression_level)
+                ]
+        else:
+            # not compressed or compressed by another process
+            command += ['--compress', '0']
+        if target:
+            command += ['--file', target]
+        command.append(dbname)
+        return command
+
+    def _exec(self, command):
         proc = subprocess.Popen(
-            command, env=psql_env, stdin=PIPE, stdout=PIPE, stderr=PIPE
+            command, env=self._process_env(),
+            stdin=PIPE, stdout=PIPE, stderr=PIPE
         )
         stdout, stderr = proc.communicate()
         if proc.returncode:
@@ -123,16 +579,154 @@ class PostgresDatabaseCommander(DatabaseCommander):
             )
             raise DumpingError(stderr.decode('utf8'))
 
+    @contextmanager
+    def _dump_directory(self, dbname):
+        """ Dump in directory format in a temporary directory
+
+        Context manager yielding the path of the dump directory.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            target = os.path.join(tmpdir, dbname)
+            self._exec(self._dump_command(dbname, target=target))
+            yield target
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    @staticmethod
+    def _tar_command(directory, target='-'):
+        return ['tar', '--create', '--file', target, '--directory', directory,
+                '.']
+
+    def exec_dump(self, dbname, target):
+        if self._compressor:
+            with self.exec_dump_stream(dbname) as stream:
+                with open(target, 'wb') as f:
+                    shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        elif self._parallel:
+            with self._dump_directory(dbname) as directory:
+                self._exec(self._tar_command(directory, target=target))
+        else:
+            self._exec(self._dump_command(dbname, target=target))
+
+    @contextmanager
+    def _stage(self, proc):
+        """ Yield the stdout of a process, raise if it failed """
+        try:
+            yield proc.stdout
+        except BaseException:
+            proc.abort()
+            raise
+        returncode, stderr = proc.wait()
+        if returncode:
+            _logger.error('error when creating dump:\n%s', stderr)
+            raise DumpingError(stderr)
+
+    @contextmanager
+    def _exec_dump_stream(self, dbname):
+        if self._parallel:
+            # pg_dump can write the directory format only on the disk
+            with self._dump_directory(dbname) as directory:
+                proc = PipedProcess(self._tar_command(directory))
+                with self._stage(proc) as stream:
+                    yield stream
+        else:
+            proc = PipedProcess(
+                self._dump_command(dbname), env=self._process_env()
+            )
+            with self._stage(proc) as stream:
+                yield stream
+
+    @contextmanager
+    def validation_pipeline(self, dbname, mode):
+        """ ``pg_restore`` reading the dump
+
+        With the 'list' mode, ``pg_restore --list`` reads the table of
+        contents at the beginning of the dump. With the 'restore' mode, the
+        dump is restored in a scratch database created on the validation
+        server, never on the primary, dropped once the validation is done.
+        The tar of the directory format (several jobs) cannot be read from
+        a stream.
+        """
+        if self._parallel:
+            yield None
+            return
+        commands = [self._decompressor] if self._decompressor else []
+        if mode == 'list':
+            yield commands + [['pg_restore', '--list']], self._process_env()
+            return
+        if not self.options.validation_server:
+            raise DumpingError(
+                'no server for the scratch databases of the validation'
+            )
+        host, port = self.options.validation_server
+        scratch = 'dumpbag_check_%s_%s' % (dbname[:30], uuid.uuid4().hex[:12])
+        identifier = '"%s"' % (scratch.replace('"', '""'),)
+        self._exec(self._psql_command(
+            'CREATE DATABASE %s' % (identifier,), host=host, port=port
+        ))
+        try:
+            yield commands + [[
+                'pg_restore',
+                '--host', host,
+                '--port', str(port),
+                '--username', self.options.user,
+                '--no-owner', '--no-privileges', '--exit-on-error',
+                '--dbname', scratch,
+            ]], self._process_env()
+        finally:
+            try:
+                self._exec(self._psql_command(
+                    'DROP DATABASE IF EXISTS %s' % (identifier,),
+                    host=host, port=port,
+                ))
+            except DumpingError:
+                _logger.error('scratch database %s could not be dropped',
+                              scratch)
+
+    @contextmanager
+    def exec_dump_stream(self, dbname):
+        with self._exec_dump_stream(dbname) as stream:
+            compressor = self._compressor
+            if not compressor:
+                yield stream
+                return
+            proc = PipedProcess(compressor, source=stream)
+            with self._stage(proc) as compressed:
+                yield compressed
+
 
 class PostgresOptions(DatabaseOptions):
     """ Options for the PostgreSQL commander """
     _commander = PostgresDatabaseCommander
 
-    def __init__(self, host, user, password, port='5432'):
+    def __init__(self, host, user, password, port='5432', jobs=1,
+                 compression='zlib', compression_level=None,
+                 compression_threads=1, metadata_connection=True,
+                 list_cache_ttl=10, standbys=(), standby_catchup_timeout=60,
+                 validation_server=None):
         self.host = host
         self.port = port
+        # list of (host, port) of the standby servers to dump from
+        self.standbys = standbys
+        # seconds to wait for a standby to replay the WAL of the primary
+        self.standby_catchup_timeout = standby_catchup_timeout
+        # (host, port) of the server of the scratch databases of the
+        # 'restore' validation
+        self.validation_server = validation_server
         self.user = user
         self.password = password
+        # read the metadata with a connection instead of psql
+        self.metadata_connection = metadata_connection
+        # seconds during which the list of the databases is cached
+        self.list_cache_ttl = list_cache_ttl
+        # with more than 1 job, pg_dump uses the directory format
+        self.jobs = jobs
+        # zlib is done by pg_dump, zstd and lz4 by their own command
+        self.compression = compression
+        self.compression_level = compression_level
+        # only used by zstd, 0 uses all the cores
+        self.compression_threads = compression_threads
 
 
 class Database():
@@ -143,23 +737,47 @@ class Database():
         self.commander = commander
 
     def list_databases(self):
-        databases = self.commander.list_databases()
+        return self._filter(self.commander.list_databases())
+
+    def _filter(self, databases):
+        """ Filter the databases with the only/exclude lists """
         if self.only:
             databases = [db for db in databases if db in self.only]
         if self.exclude:
             databases = [db for db in databases if db not in self.exclude]
         return databases
 
+    def database_sizes(self):
+        """ Return the sizes of the databases which can be dumped """
+        sizes = self.commander.database_sizes()
+        databases = self._filter(list(sizes))
+        return {dbname: sizes[dbname] for dbname in databases}
+
     def _generate_dump_name(self, dbname):
         now = time.strftime("%Y%m%d-%H%M%S")
-        return '%s-%s.pg' % (dbname, now)
+        return '%s-%s%s' % (dbname, now, self.commander.dump_extension())
 
-    def create_dump_file(self, tmpdir, dbname):
+    def _check_database(self, dbname):
         databases = self.list_databases()
         if dbname not in databases:
             raise DumpingError('Database %s does not exist or is excluded'
                                % (dbname,))
+
+    def create_dump_file(self, tmpdir, dbname):
+        self._check_database(dbname)
         name = self._generate_dump_name(dbname)
         target = os.path.join(tmpdir, name)
         self.commander.exec_dump(dbname, target)
         return name
+
+    @contextmanager
+    def create_dump_stream(self, dbname):
+        """ Dump a database without writing it on the disk
+
+        Context manager yielding a tuple (name, stream) where stream is
+        a binary file object with the content of the dump.
+        """
+        self._check_database(dbname)
+        name = self._generate_dump_name(dbname)
+        with self.commander.exec_dump_stream(dbname) as stream:
+            yield name, stream
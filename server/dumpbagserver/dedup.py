@@ -0,0 +1,602 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import BotoCoreError, ClientError
+
+from .encryption import EncryptionCommander, NoOpEncryptionCommander
+from .exception import DumpNotExistError, DumpStorageError
+from .storage import (
+    DumpStat, LocalOptions, StorageCommander, _delete_errors, _s3_client,
+)
+from .stream import read_chunks
+
+_logger = logging.getLogger(__name__)
+
+MANIFESTS = 'manifests'
+CHUNKS = 'chunks'
+# markers of the pushes, listing the chunks they reuse from the last dump
+PUSHES = 'pushes'
+
+# boundaries are searched only after this byte: it is found every 256
+# bytes in compressed data and ends every row of the COPY of pg_dump
+ANCHOR = b'\n'
+ANCHOR_SPACING = 256
+# bytes before an anchor deciding if it is a boundary
+WINDOW = 48
+DEFAULT_CHUNK_SIZE = 1024 ** 2
+
+
+def _find_boundary(buf, start, end, mask):
+    pos = buf.find(ANCHOR, max(start, WINDOW), end)
+    while pos != -1:
+        if not zlib.crc32(buf[pos - WINDOW:pos]) & mask:
+            return pos + 1
+        pos = buf.find(ANCHOR, pos + 1, end)
+    return end
+
+
+def content_chunks(stream, avg_size=DEFAULT_CHUNK_SIZE):
+    """ Generator splitting a stream in content-defined chunks
+
+    A boundary depends only on the bytes before it, so an insertion in
+    a dump changes only the chunks around it, the next ones are the same
+    than in the previous dump. The chunks are between a quarter and 4
+    times ``avg_size``.
+
+    The anchors are found with ``bytes.find`` and only the anchors are
+    hashed, which is much faster in Python than a rolling hash on every
+    byte.
+    """
+    min_size = avg_size // 4
+    max_size = avg_size * 4
+    bits = max(0, (avg_size // ANCHOR_SPACING).bit_length() - 1)
+    mask = (1 << bits) - 1
+    buf = b''
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = stream.read(max_size)
+            if data:
+                buf += data
+            else:
+                eof = True
+        if not buf:
+            return
+        end = min(len(buf), max_size)
+        cut = _find_boundary(buf, min_size, end, mask)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+class LocalObjectStore():
+    """ Objects stored as files in a directory """
+
+    def __init__(self, root):
+        self.root = root
+
+    def location(self):
+        return 'file://%s' % (os.path.abspath(self.root),)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, data, expire=False):
+        path = self._path(key)
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        # unique, as the same chunk can be written by concurrent pushes,
+        # hidden so it is not listed
+        fd, partial = tempfile.mkstemp(
+            prefix='.%s.' % (name,), suffix='.part', dir=directory
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # a chunk written meanwhile by another push has the same content
+            os.replace(partial, path)
+        except BaseException:
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise DumpNotExistError('%s does not exist' % (key,))
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError as err:
+                if err.errno != errno.ENOENT:  # file does not exist
+                    raise
+
+    def list(self, prefix):
+        """ Generator of (key, modification timestamp) """
+        top = self._path(prefix.rstrip('/'))
+        for dirpath, __, filenames in os.walk(top):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                yield key, os.stat(path).st_mtime
+
+
+class S3ObjectStore():
+    """ Objects stored in a S3 bucket with the pooled client """
+
+    # maximum number of keys of a delete_objects request
+    DELETE_BATCH = 1000
+
+    def __init__(self, options):
+        self.options = options
+
+    def location(self):
+        return 's3://%s' % (self.options.bucket,)
+
+    @contextmanager
+    def _s3_errors(self):
+        try:
+            yield
+        except (Boto3Error, BotoCoreError, ClientError) as err:
+            _logger.error('error when calling S3:\n%s', err)
+            raise DumpStorageError(str(err))
+
+    def put(self, key, data, expire=False):
+        params = {}
+        if expire:
+            # see S3StorageCommander._add_expire_tag, never set on the
+            # chunks as they are shared by several dumps
+            params['Tagging'] = 'Expire=True'
+        with self._s3_errors():
+            _s3_client(self.options).put_object(
+                Bucket=self.options.bucket, Key=key, Body=data, **params
+            )
+
+    def get(self, key):
+        with self._s3_errors():
+            try:
+                response = _s3_client(self.options).get_object(
+                    Bucket=self.options.bucket, Key=key
+                )
+            except ClientError as err:
+                if err.response['Error']['Code'] == 'NoSuchKey':
+                    raise DumpNotExistError('%s does not exist' % (key,))
+                raise
+            return response['Body'].read()
+
+    def exists(self, key):
+        with self._s3_errors():
+            try:
+                _s3_client(self.options).head_object(
+                    Bucket=self.options.bucket, Key=key
+                )
+            except ClientError as err:
+                if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    return False
+                raise
+        return True
+
+    def delete(self, keys):
+        keys = list(keys)
+        client = _s3_client(self.options)
+        for idx in range(0, len(keys), self.DELETE_BATCH):
+            batch = keys[idx:idx + self.DELETE_BATCH]
+            with self._s3_errors():
+                response = client.delete_objects(
+                    Bucket=self.options.bucket,
+                    Delete={
+                        'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True,
+                    },
+                )
+            if response.get('Errors'):
+                # the chunks not removed must not be reported as removed
+                _logger.error('error when deleting chunks: %s',
+                              _delete_errors(response['Errors']))
+                raise DumpStorageError(_delete_errors(response['Errors']))
+
+    def list(self, prefix):
+        paginator = _s3_client(self.options).get_paginator('list_objects_v2')
+        with self._s3_errors():
+            for page in paginator.paginate(Bucket=self.options.bucket,
+                                           Prefix=prefix):
+                for content in page.get('Contents', []):
+                    yield (content['Key'],
+                           content['LastModified'].timestamp())
+
+
+class DedupStorageCommander(StorageCommander):
+    """ Commander storing the dumps deduplicated in content-defined chunks
+
+    A dump is split in chunks (:func:`content_chunks`), each chunk is
+    stored once under the sha256 of its content, encrypted with a
+    symmetric key, and a manifest lists the chunks of the dump. Only the
+    chunks not in the previous dump of the database are uploaded.
+
+    As the chunks must be readable to rebuild the dumps, the dumps are
+    given unencrypted to this storage and the downloads are encrypted
+    with the public keys on the fly.
+
+    Removing a dump only removes its manifest, the chunks no longer used
+    are removed by :meth:`collect_garbage`.
+
+    :params options: options for the commands
+    :type options: DedupOptions
+
+    """
+
+    handles_encryption = True
+
+    def __init__(self, options):
+        super().__init__(options)
+        if isinstance(options.store_options, LocalOptions):
+            self.store = LocalObjectStore(options.store_options.storage_dir)
+        else:
+            self.store = S3ObjectStore(options.store_options)
+        self.encrypter = EncryptionCommander.new_commander(
+            options.encryption_options
+        )
+
+    def location(self):
+        return 'dedup+%s' % (self.store.location(),)
+
+    @staticmethod
+    def _manifest_key(dbname, filename):
+        return '%s/%s/%s' % (MANIFESTS, dbname, filename)
+
+    @staticmethod
+    def _chunk_key(digest):
+        return '%s/%s/%s' % (CHUNKS, digest[:2], digest)
+
+    @staticmethod
+    def _push_key(dbname, filename):
+        return '%s/%s/%s' % (PUSHES, dbname, filename)
+
+    def _gpg(self, args, data):
+        command = [
+            'gpg', '--batch', '--quiet', '--yes',
+            '--pinentry-mode', 'loopback',
+            '--passphrase-file', self.options.passphrase_file,
+        ] + args
+        proc = subprocess.run(
+            command, input=data, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if proc.returncode:
+            stderr = proc.stderr.decode('utf8', 'replace')
+            _logger.error('error when running gpg on a chunk:\n%s', stderr)
+            raise DumpStorageError(stderr)
+        return proc.stdout
+
+    def _encrypt_chunk(self, data):
+        return self._gpg([
+            '--symmetric', '--cipher-algo', 'AES256',
+            '--compress-algo', 'none',
+            # the passphrase is a random key, stretching it for every
+            # chunk would cost half a second of CPU per chunk
+            '--s2k-count', '65536',
+            '--output', '-',
+        ], data)
+
+    def _decrypt_chunk(self, data):
+        return self._gpg(['--decrypt', '--output', '-'], data)
+
+    def _read_manifest(self, dbname, filename):
+        try:
+            data = self.store.get(self._manifest_key(dbname, filename))
+        except DumpNotExistError:
+            raise DumpNotExistError('%s dump does not exist' % (filename,))
+        return json.loads(data.decode('utf8'))
+
+    def _known_chunks(self, dbname, filename):
+        """ Chunks of the last dump of the database
+
+        Only these chunks are not uploaded again: a chunk which exists but
+        is not referenced could be removed by the garbage collector before
+        the manifest is written, uploading it again protects it with the
+        grace period.
+
+        The last dump can be removed during the push, so the chunks reused
+        are listed in a marker of the push, then the last dump is checked
+        again: either it is still there when :meth:`collect_garbage` reads
+        the manifests, or the marker is there when it reads the markers.
+        """
+        dumps = sorted(self.list_by_db(dbname=dbname).get(dbname, []))
+        if not dumps:
+            return set()
+        try:
+            manifest = self._read_manifest(dbname, dumps[-1])
+        except DumpNotExistError:  # removed meanwhile
+            return set()
+        known = set(digest for digest, __ in manifest['chunks'])
+        self.store.put(
+            self._push_key(dbname, filename),
+            json.dumps({'chunks': sorted(known)}).encode('utf8'),
+        )
+        if not self.store.exists(self._manifest_key(dbname, dumps[-1])):
+            return set()
+        return known
+
+    def _upload_chunk(self, digest, data):
+        self.store.put(self._chunk_key(digest), self._encrypt_chunk(data))
+        return len(data)
+
+    def push_to_storage(self, dbname, source_path, filename):
+        source = os.path.join(source_path, filename)
+        with open(source, 'rb') as f:
+            self.push_stream(dbname, f, filename)
+
+    def push_stream(self, dbname, stream, filename, size=None):
+        # the size is not needed to split the stream in chunks
+        known = self._known_chunks(dbname, filename)
+        chunks = []
+        total = 0
+        uploaded = 0
+        pending = set()
+        concurrency = self.options.max_concurrency
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            try:
+                for data in content_chunks(stream, self.options.chunk_size):
+                    digest = hashlib.sha256(data).hexdigest()
+                    chunks.append((digest, len(data)))
+                    total += len(data)
+                    if digest in known:
+                        continue
+                    known.add(digest)
+                    # bound the chunks kept in memory
+                    if len(pending) >= 2 * concurrency:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED
+                        )
+                        uploaded += sum(future.result() for future in done)
+                    pending.add(
+                        executor.submit(self._upload_chunk, digest, data)
+                    )
+                uploaded += sum(future.result() for future in pending)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        manifest = {
+            'size': total,
+            'chunks': chunks,
+            'created': time.time(),
+        }
+        # written last: a dump is listed only when all its chunks exist
+        self.store.put(
+            self._manifest_key(dbname, filename),
+            json.dumps(manifest).encode('utf8'),
+            expire=True,
+        )
+        _logger.info(
+            'pushed dump %s in %d chunks, %d of %d bytes uploaded',
+            filename, len(chunks), uploaded, total,
+        )
+
+    def delete_dump(self, dbname, filename):
+        self.store.delete([self._manifest_key(dbname, filename)])
+
+    def delete_dumps(self, dumps):
+        self.store.delete([
+            self._manifest_key(dbname, filename) for dbname, filename in dumps
+        ])
+
+    def _fetch_chunk(self, digest):
+        return self._decrypt_chunk(self.store.get(self._chunk_key(digest)))
+
+    def _read_chunks(self, chunks):
+        """ Generator of the decrypted chunks, fetched concurrently """
+        concurrency = self.options.max_concurrency
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            fetching = deque()
+            digests = iter(chunks)
+            try:
+                while True:
+                    for digest in digests:
+                        fetching.append(
+                            executor.submit(self._fetch_chunk, digest)
+                        )
+                        if len(fetching) >= concurrency:
+                            break
+                    if not fetching:
+                        return
+                    yield fetching.popleft().result()
+            finally:
+                for future in fetching:
+                    future.cancel()
+
+    def _read_plain(self, manifest, offset=0, length=None):
+        """ Generator of the content of a dump, only the chunks in the
+        range are fetched """
+        end = manifest['size'] if length is None else offset + length
+        selected = []
+        position = 0
+        for digest, size in manifest['chunks']:
+            if position + size > offset and position < end:
+                if not selected:
+                    skip = offset - position
+                selected.append(digest)
+            position += size
+        if not selected:
+            return
+        remaining = end - offset
+        for data in self._read_chunks(selected):
+            data = data[skip:skip + remaining]
+            skip = 0
+            remaining -= len(data)
+            yield data
+
+    def read_dump(self, dbname, filename, offset=0, length=None):
+        manifest = self._read_manifest(dbname, filename)
+        if isinstance(self.encrypter, NoOpEncryptionCommander):
+            for data in self._read_plain(manifest, offset, length):
+                yield data
+            return
+        with self.encrypter.encrypt_stream(
+                _IterStream(self._read_plain(manifest))) as encrypted:
+            for data in read_chunks(encrypted, offset=offset, length=length):
+                yield data
+
+    @contextmanager
+    def read_from_storage(self, dbname, filename):
+        manifest = self._read_manifest(dbname, filename)
+        if isinstance(self.encrypter, NoOpEncryptionCommander):
+            yield _IterStream(self._read_plain(manifest))
+            return
+        with self.encrypter.encrypt_stream(
+                _IterStream(self._read_plain(manifest))) as encrypted:
+            yield encrypted
+
+    def stat_dump(self, dbname, filename):
+        manifest = self._read_manifest(dbname, filename)
+        if not isinstance(self.encrypter, NoOpEncryptionCommander):
+            # the size is known only once encrypted
+            return None
+        return DumpStat(
+            manifest['size'],
+            datetime.fromtimestamp(int(manifest['created']), timezone.utc),
+            hashlib.sha256(
+                ''.join(digest for digest, __ in manifest['chunks'])
+                .encode('ascii')
+            ).hexdigest(),
+        )
+
+    def list_by_db(self, dbname=None):
+        prefix = MANIFESTS + '/'
+        if dbname:
+            prefix += dbname + '/'
+        files = {}
+        for key, __ in self.store.list(prefix):
+            spl = key.split('/')
+            if len(spl) != 3:
+                continue
+            __, name, filename = spl
+            files.setdefault(name, [])
+            files[name].append(filename)
+        return files
+
+    def collect_garbage(self, grace=None, dry_run=False):
+        """ Remove the chunks referenced by no manifest
+
+        The chunks written less than ``grace`` seconds ago are kept: they
+        may belong to a dump being pushed, whose manifest does not exist
+        yet. The chunks reused by the pushes of the last ``grace`` seconds
+        are kept too, see :meth:`_known_chunks`, the older markers of the
+        pushes are removed.
+
+        :return: dict with the number of chunks kept and removed
+        """
+        if grace is None:
+            grace = self.options.gc_grace
+        # listed before the manifests: a chunk uploaded after the listing
+        # of the manifests is recent enough to be protected by the grace
+        chunks = list(self.store.list(CHUNKS + '/'))
+        referenced = set()
+        for dbname, filenames in self.list_by_db().items():
+            for filename in filenames:
+                try:
+                    manifest = self._read_manifest(dbname, filename)
+                except DumpNotExistError:
+                    continue
+                referenced.update(digest for digest, __ in manifest['chunks'])
+        limit = time.time() - grace
+        # listed after the manifests: a push reusing the chunks of a dump
+        # removed meanwhile has written its marker before the removal
+        stale = []
+        for key, mtime in self.store.list(PUSHES + '/'):
+            if mtime < limit:
+                stale.append(key)
+                continue
+            try:
+                marker = json.loads(self.store.get(key).decode('utf8'))
+            except DumpNotExistError:
+                continue
+            referenced.update(marker['chunks'])
+        unused = [
+            key for key, mtime in chunks
+            if key.rsplit('/', 1)[-1] not in referenced and mtime < limit
+        ]
+        if not dry_run:
+            # the chunks first, the markers protect them until then
+            if unused:
+                self.store.delete(unused)
+            if stale:
+                self.store.delete(stale)
+        _logger.info('%s %d unused chunks, %d chunks kept',
+                     'would remove' if dry_run else 'removed',
+                     len(unused), len(chunks) - len(unused))
+        return {
+            'kept': len(chunks) - len(unused),
+            'removed': len(unused),
+            'dry_run': dry_run,
+        }
+
+
+class _IterStream():
+    """ Minimal binary file object reading a generator of bytes """
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class DedupOptions():
+    """ Options for the deduplicated Storage commander
+
+    :param store_options: LocalOptions or S3ClientOptions of the place
+                          where the chunks and manifests are stored
+    :param encryption_options: options of the encryption of the downloads
+    :param passphrase_file: file with the passphrase encrypting the chunks
+    :param chunk_size: average size of the chunks in bytes
+    :param max_concurrency: number of chunks uploaded or downloaded at the
+                            same time
+    :param gc_grace: seconds before an unreferenced chunk can be removed
+    """
+    _commander = DedupStorageCommander
+
+    def __init__(self, store_options, encryption_options, passphrase_file,
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_concurrency=4,
+                 gc_grace=24 * 3600):
+        self.store_options = store_options
+        self.encryption_options = encryption_options
+        self.passphrase_file = passphrase_file
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        self.gc_grace = gc_grace
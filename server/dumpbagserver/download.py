@@ -0,0 +1,214 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import base64
+import hashlib
+import logging
+import uuid
+
+from flask import request
+from werkzeug.exceptions import Conflict, RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
+
+from dumpbagserver import app
+
+from .exception import DumpChecksumError
+
+_logger = logging.getLogger(__name__)
+
+# above, the Range header is ignored and the whole dump is sent
+MAX_RANGES = 32
+# buffer of wsgi.file_wrapper when the server cannot use sendfile
+FILE_WRAPPER_BUFFER_SIZE = 1024 ** 2
+
+
+def _byte_ranges(length):
+    """ Return the list of (start, stop) requested in the Range header
+
+    None when the whole dump must be sent: no Range header or too many
+    ranges. Raises RequestedRangeNotSatisfiable when no range is in the dump.
+    """
+    requested = request.range
+    if requested is None or requested.units != 'bytes':
+        return None
+    if len(requested.ranges) > MAX_RANGES:
+        return None
+    ranges = []
+    for start, stop in requested.ranges:
+        if start < 0:  # suffix range: last bytes
+            start = max(0, length + start)
+            stop = length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(length=length)
+    return ranges
+
+
+def _if_range_matches(stat):
+    """ False if the dump changed since the client got its first part """
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == stat.etag
+    if if_range.date:
+        return stat.last_modified <= if_range.date
+    return True
+
+
+def _multipart(bagger, dbname, filename, ranges, length):
+    """ Return a multipart/byteranges body and its length
+
+    :return: tuple (boundary, body generator, content length)
+    """
+    boundary = uuid.uuid4().hex
+    headers = [
+        ('\r\n--%s\r\n'
+         'Content-Type: application/octet-stream\r\n'
+         'Content-Range: bytes %d-%d/%d\r\n\r\n'
+         % (boundary, start, stop - 1, length)).encode('ascii')
+        for start, stop in ranges
+    ]
+    closing = ('\r\n--%s--\r\n' % (boundary,)).encode('ascii')
+
+    def body():
+        for header, (start, stop) in zip(headers, ranges):
+            yield header
+            for chunk in bagger.read_dump(
+                    dbname, filename, offset=start, length=stop - start):
+                yield chunk
+        yield closing
+
+    content_length = (
+        sum(len(header) for header in headers) +
+        sum(stop - start for start, stop in ranges) +
+        len(closing)
+    )
+    return boundary, body(), content_length
+
+
+def _verified(chunks, checksum, filename):
+    """ Generator of the chunks of a dump checked against its sha256
+
+    The last chunk is held back until the whole dump is hashed: on a
+    mismatch, the transfer stops before its end, so the client receives
+    less than the Content-Length and knows the dump is not valid.
+    """
+    digest = hashlib.sha256()
+    previous = None
+    for chunk in chunks:
+        digest.update(chunk)
+        if previous is not None:
+            yield previous
+        previous = chunk
+    if digest.hexdigest() != checksum:
+        _logger.error('dump %s does not match its sha256 %s, got %s',
+                      filename, checksum, digest.hexdigest())
+        raise DumpChecksumError(
+            '%s does not match its sha256' % (filename,)
+        )
+    if previous is not None:
+        yield previous
+
+
+def _verified_response(bagger, dbname, filename, stat):
+    checksum = bagger.dump_checksum(dbname, filename)
+    if checksum is None:
+        raise Conflict('the sha256 of %s is unknown' % (filename,))
+    response = app.response_class(
+        _verified(bagger.read_dump(dbname, filename), checksum, filename),
+        mimetype='application/octet-stream',
+    )
+    response.headers.set(
+        'Content-Disposition', 'attachment', filename=filename
+    )
+    response.headers['Repr-Digest'] = 'sha-256=:%s:' % (
+        base64.b64encode(bytes.fromhex(checksum)).decode('ascii'),
+    )
+    if stat is not None:
+        response.content_length = stat.size
+    return response
+
+
+def dump_response(bagger, dbname, filename, verify=False):
+    """ Response sending a dump
+
+    When the storage knows the size of the dump, the response supports
+    conditional requests (ETag, Last-Modified) and byte ranges, single
+    or multiple, so downloads can be resumed or split.
+
+    Dumps on the local disk are not read by Python: they are sent by
+    nginx (X-Accel-Redirect) when configured, or with the
+    ``wsgi.file_wrapper`` of the server (sendfile with uwsgi).
+
+    With ``verify``, the whole dump is read by Python and checked against
+    its sha256 while it is sent, see :func:`_verified`.
+    """
+    stat = bagger.stat_dump(dbname, filename)
+    if verify:
+        return _verified_response(bagger, dbname, filename, stat)
+    accel_uri = bagger.accel_redirect_uri(dbname, filename)
+    if accel_uri:
+        # nginx handles the ranges and conditional requests
+        response = app.response_class(mimetype='application/octet-stream')
+        response.headers.set(
+            'Content-Disposition', 'attachment', filename=filename
+        )
+        response.headers['X-Accel-Redirect'] = accel_uri
+        return response
+    if stat is None:
+        response = app.response_class(
+            bagger.read_dump(dbname, filename),
+            mimetype='application/octet-stream',
+        )
+        response.headers.set(
+            'Content-Disposition', 'attachment', filename=filename
+        )
+        return response
+
+    response = app.response_class(mimetype='application/octet-stream')
+    response.headers.set(
+        'Content-Disposition', 'attachment', filename=filename
+    )
+    response.set_etag(stat.etag)
+    response.last_modified = stat.last_modified
+    response.accept_ranges = 'bytes'
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    length = stat.size
+    ranges = _byte_ranges(length) if _if_range_matches(stat) else None
+    if ranges is None:
+        path = bagger.local_path(dbname, filename)
+        if path:
+            response.response = wrap_file(
+                request.environ, open(path, 'rb'),
+                buffer_size=FILE_WRAPPER_BUFFER_SIZE,
+            )
+            response.direct_passthrough = True
+        else:
+            response.response = bagger.read_dump(dbname, filename)
+        response.content_length = length
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response.status_code = 206
+        response.response = bagger.read_dump(
+            dbname, filename, offset=start, length=stop - start
+        )
+        response.content_length = stop - start
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, length
+        )
+    else:
+        boundary, body, content_length = _multipart(
+            bagger, dbname, filename, ranges, length
+        )
+        response.status_code = 206
+        response.response = body
+        response.content_length = content_length
+        response.headers['Content-Type'] = (
+            'multipart/byteranges; boundary=%s' % (boundary,)
+        )
+    return response
@@ -3,15 +3,46 @@
 
 import os
 import subprocess
+import threading
 
+from contextlib import contextmanager
 from subprocess import PIPE
 
 from .exception import DumpEncryptionError
+from .stream import PipedProcess
 
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# public keyrings of gpg 2.1+ and of the previous versions
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg')
+
+
+def gpg_home():
+    """ Directory of the keyrings of gpg """
+    return os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+
+
+def keyring_signature(home):
+    """ Modification time and size of the public keyrings
+
+    Changes when a key is imported or removed.
+    """
+    signature = []
+    for name in KEYRING_FILES:
+        try:
+            stat = os.stat(os.path.join(home, name))
+        except FileNotFoundError:
+            continue
+        signature.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+# {(gpg home, recipients): (signature of the keyrings, armored keys)}
+_exported_keys = {}
+_exported_keys_lock = threading.Lock()
+
 
 class EncryptionOptions():
     """ Base options for commanders """
@@ -45,6 +76,21 @@ class EncryptionCommander():
     def encrypt(self, tmpdir, filename):
         raise NotImplementedError
 
+    def encrypted_filename(self, filename):
+        """ Name of the file once encrypted """
+        return filename
+
+    @contextmanager
+    def encrypt_stream(self, source):
+        """ Encrypt a stream
+
+        Context manager yielding a binary file object with the encrypted
+        content of ``source``. Leaving the context waits for the end of
+        the encryption and raises :class:`DumpEncryptionError` if it
+        failed.
+        """
+        raise NotImplementedError
+
     def download_commands(self, dbname, filename):
         return [], {}
 
@@ -55,6 +101,10 @@ class NoOpEncryptionCommander(EncryptionCommander):
     def encrypt(self, tmpdir, filename):
         return filename
 
+    @contextmanager
+    def encrypt_stream(self, source):
+        yield source
+
 
 class NoOpEncryptionOptions():
     """ Options for no-op (no encryption) """
@@ -65,30 +115,51 @@ class GPGKeysCommander(EncryptionCommander):
     """ Commander for encryption with GPG Public/Private Keys """
 
     def public_keys(self):
-        keys = []
-        for recipient in self.recipients():
-            command = [
-                'gpg', '--export', '-a', recipient
-            ]
-            proc = subprocess.Popen(
-                command, stdin=PIPE, stdout=PIPE, stderr=PIPE
-            )
-            stdout, stderr = proc.communicate()
-            keys.append(stdout.decode('utf8'))
-        return keys
+        """ Armored public keys of the recipients
+
+        The keys of all the recipients are exported at once, in a single
+        armored block. The export is kept in memory until the keyrings
+        change.
+        """
+        home = gpg_home()
+        key = (home, tuple(self.recipients()))
+        signature = keyring_signature(home)
+        with _exported_keys_lock:
+            cached = _exported_keys.get(key)
+        if cached and cached[0] == signature:
+            return list(cached[1])
+        command = ['gpg', '--batch', '--export', '-a'] + self.recipients()
+        proc = subprocess.Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        keys = stdout.decode('utf8')
+        keys = [keys] if keys else []
+        if proc.returncode:
+            # exported again at the next call
+            _logger.error('error when exporting the public keys:\n%s',
+                          stderr.decode('utf8'))
+            return keys
+        with _exported_keys_lock:
+            _exported_keys[key] = (signature, keys)
+        return list(keys)
 
     def recipients(self):
         return self.options.recipients
 
-    def encrypt(self, tmpdir, filename):
-        target = os.path.join(tmpdir, filename)
+    def _encrypt_command(self):
         command = [
             'gpg', '--encrypt', '--always-trust',
+            # the dumps are already compressed
+            '--compress-algo', 'none',
         ]
         for recipient in self.recipients():
             command += [
                 '--recipient', recipient,
             ]
+        return command
+
+    def encrypt(self, tmpdir, filename):
+        target = os.path.join(tmpdir, filename)
+        command = self._encrypt_command()
         command.append(target)
         proc = subprocess.Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
         stdout, stderr = proc.communicate()
@@ -97,8 +168,27 @@ class GPGKeysCommander(EncryptionCommander):
                 'error when encrypting %s:\n%s', target, stderr.decode('utf8')
             )
             raise DumpEncryptionError(stderr.decode('utf8'))
+        return self.encrypted_filename(filename)
+
+    def encrypted_filename(self, filename):
         return "%s.gpg" % (filename,)
 
+    @contextmanager
+    def encrypt_stream(self, source):
+        command = self._encrypt_command()
+        # without a file, gpg reads stdin and writes stdout
+        command.append('--batch')
+        proc = PipedProcess(command, source=source)
+        try:
+            yield proc.stdout
+        except BaseException:
+            proc.abort()
+            raise
+        returncode, stderr = proc.wait()
+        if returncode:
+            _logger.error('error when encrypting stream:\n%s', stderr)
+            raise DumpEncryptionError(stderr)
+
     def download_commands(self, dbname, filename):
         lines = [
             "# decrypt with gpg, "
@@ -24,3 +24,7 @@ class DumpEncryptionError(DumpBagError):
 
 class DumpStorageError(DumpBagError):
     """ Error with the storage """
+
+
+class DumpChecksumError(DumpBagError):
+    """ The content of a dump does not match its checksum """
@@ -0,0 +1,543 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from .bagger import Bagger
+from .changes import activity_markers
+
+_logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# a running job is updated at this interval (seconds) by its worker, when
+# it is not updated for STALE_AFTER, the worker is considered dead (e.g.
+# the server has been restarted) and the job is run again if it has
+# attempts left, it fails otherwise
+HEARTBEAT_INTERVAL = 30
+STALE_AFTER = 4 * HEARTBEAT_INTERVAL
+
+
+JOB_SCHEDULE_COLUMNS = (
+    ('run_id', 'TEXT'),
+    ('not_before', 'REAL'),
+    ('deadline', 'REAL'),
+    ('max_attempts', 'INTEGER NOT NULL DEFAULT 1'),
+    ('retry_delay', 'REAL NOT NULL DEFAULT 0'),
+)
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+
+class JobQueue():
+    """ Persistent queue of dump jobs, stored in SQLite
+
+    A job is either a dump of a database ('dump') or of all the databases
+    ('dumpall'). The queue can be shared by several processes using the
+    same file: a job is claimed by only one worker.
+
+    The jobs of the scheduled runs (see :mod:`dumpbagserver.scheduler`)
+    are not claimed before their start time (``not_before``), are given up
+    after the end of the window of the run (``deadline``) and are retried
+    on failure.
+
+    :param path: path of the SQLite database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._init_schema()
+
+    @contextmanager
+    def _cursor(self, immediate=False):
+        # one connection per operation: they are used by several threads
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cr = conn.cursor()
+            cr.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield cr
+            except BaseException:
+                cr.execute('ROLLBACK')
+                raise
+            cr.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _init_schema(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY,'
+                ' kind TEXT NOT NULL,'
+                ' dbname TEXT,'
+                ' status TEXT NOT NULL,'
+                ' worker TEXT,'
+                ' created_at REAL NOT NULL,'
+                ' started_at REAL,'
+                ' finished_at REAL,'
+                ' heartbeat_at REAL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' result TEXT,'
+                ' error TEXT'
+                ')'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_status_idx '
+                'ON jobs (status, created_at)'
+            )
+            # columns added with the scheduler, on existing databases too
+            columns = {
+                row[1] for row in conn.execute('PRAGMA table_info(jobs)')
+            }
+            for column, definition in JOB_SCHEDULE_COLUMNS:
+                if column not in columns:
+                    conn.execute(
+                        'ALTER TABLE jobs ADD COLUMN %s %s'
+                        % (column, definition)
+                    )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_run_idx ON jobs (run_id)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                ' id TEXT PRIMARY KEY,'
+                ' schedule TEXT NOT NULL,'
+                ' planned_at REAL NOT NULL,'
+                ' deadline REAL NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' UNIQUE (schedule, planned_at)'
+                ')'
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, dbname=None, run_id=None, not_before=None,
+                deadline=None, max_attempts=1, retry_delay=0):
+        """ Add a job in the queue
+
+        :param run_id: scheduled run of the job
+        :param not_before: timestamp before which the job is not started
+        :param deadline: timestamp after which the job is not started
+        :param max_attempts: number of runs of a failing job
+        :param retry_delay: seconds between a failure and the next attempt
+        :return: id of the job
+        """
+        job_id = uuid.uuid4().hex
+        with self._cursor() as cr:
+            self._insert(cr, job_id, kind, dbname, run_id=run_id,
+                         not_before=not_before, deadline=deadline,
+                         max_attempts=max_attempts, retry_delay=retry_delay)
+        return job_id
+
+    @staticmethod
+    def _insert(cr, job_id, kind, dbname, run_id=None, not_before=None,
+                deadline=None, max_attempts=1, retry_delay=0):
+        cr.execute(
+            'INSERT INTO jobs (id, kind, dbname, status, created_at, run_id, '
+            'not_before, deadline, max_attempts, retry_delay) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, dbname, QUEUED, time.time(), run_id, not_before,
+             deadline, max_attempts, retry_delay)
+        )
+
+    def claim(self, worker):
+        """ Take the oldest pending job and mark it as running
+
+        Jobs left running by a dead worker are pending too, unless they
+        have no attempts left: they fail, as they may be what killed their
+        worker (e.g. pg_dump killed for lack of memory). The jobs which
+        could not start before their deadline fail.
+
+        :return: the job as a dict or None if there is nothing to do
+        """
+        now = time.time()
+        with self._cursor(immediate=True) as cr:
+            cr.execute(
+                'UPDATE jobs SET status = ?, finished_at = ?, '
+                'error = COALESCE(error || ?, ?) '
+                'WHERE status = ? AND deadline < ?',
+                (FAILED, now, ', then the window of the run has ended',
+                 'the window of the run has ended', QUEUED, now)
+            )
+            cr.execute(
+                'UPDATE jobs SET status = ?, finished_at = ?, '
+                'error = COALESCE(error || ?, ?) '
+                'WHERE status = ? AND heartbeat_at < ? '
+                'AND attempts >= max_attempts',
+                (FAILED, now, ', then the job was abandoned by its worker',
+                 'the job was abandoned by its worker', RUNNING,
+                 now - STALE_AFTER)
+            )
+            if cr.rowcount:
+                _logger.error('%d jobs abandoned by their worker have failed',
+                              cr.rowcount)
+            cr.execute(
+                'SELECT * FROM jobs '
+                'WHERE (status = ? AND COALESCE(not_before, 0) <= ?) '
+                'OR (status = ? AND heartbeat_at < ?) '
+                'ORDER BY COALESCE(not_before, created_at) LIMIT 1',
+                (QUEUED, now, RUNNING, now - STALE_AFTER)
+            )
+            row = cr.fetchone()
+            if not row:
+                return None
+            if row['status'] == RUNNING:
+                _logger.warning(
+                    'job %s has been abandoned by %s, running it again',
+                    row['id'], row['worker'],
+                )
+            cr.execute(
+                'UPDATE jobs SET status = ?, worker = ?, started_at = ?, '
+                'heartbeat_at = ?, attempts = attempts + 1 WHERE id = ?',
+                (RUNNING, worker, now, now, row['id'])
+            )
+        return self.get(row['id'])
+
+    def heartbeat(self, job_ids):
+        """ Signal that the running jobs are still alive """
+        if not job_ids:
+            return
+        with self._cursor() as cr:
+            cr.executemany(
+                'UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = ?',
+                [(time.time(), job_id, RUNNING) for job_id in job_ids]
+            )
+
+    def _close(self, job_id, status, result=None, error=None):
+        with self._cursor() as cr:
+            cr.execute(
+                'UPDATE jobs SET status = ?, finished_at = ?, result = ?, '
+                'error = ? WHERE id = ?',
+                (status, time.time(),
+                 json.dumps(result) if result is not None else None,
+                 error, job_id)
+            )
+
+    def finish(self, job_id, result=None):
+        self._close(job_id, DONE, result=result)
+
+    def fail(self, job_id, error, result=None):
+        """ Mark a job as failed
+
+        A job with attempts left is queued again after its retry delay,
+        unless it would then start after its deadline.
+
+        :return: True if the job will be retried
+        """
+        now = time.time()
+        with self._cursor() as cr:
+            cr.execute(
+                'UPDATE jobs SET status = ?, not_before = ? + retry_delay, '
+                'error = ?, worker = NULL, heartbeat_at = NULL '
+                'WHERE id = ? AND status = ? AND attempts < max_attempts '
+                'AND (deadline IS NULL OR deadline > ? + retry_delay)',
+                (QUEUED, now, error, job_id, RUNNING, now)
+            )
+            if cr.rowcount:
+                return True
+        self._close(job_id, FAILED, result=result, error=error)
+        return False
+
+    def _to_dict(self, row):
+        duration = None
+        if row['started_at'] and row['finished_at']:
+            duration = row['finished_at'] - row['started_at']
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'dbname': row['dbname'],
+            'status': row['status'],
+            'created_at': _isoformat(row['created_at']),
+            'started_at': _isoformat(row['started_at']),
+            'finished_at': _isoformat(row['finished_at']),
+            'duration': duration,
+            'attempts': row['attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'run_id': row['run_id'],
+            'not_before': _isoformat(row['not_before']),
+        }
+
+    def get(self, job_id):
+        """ Return a job as a dict, None if it does not exist """
+        with self._cursor() as cr:
+            cr.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+            row = cr.fetchone()
+        return self._to_dict(row) if row else None
+
+    def dump_durations(self, history=30):
+        """ Return the durations of the last successful dumps
+
+        Read from the jobs finished during the last ``history`` days.
+
+        :return: dict {dbname: seconds}
+        """
+        durations = {}
+        with self._cursor() as cr:
+            cr.execute(
+                'SELECT kind, dbname, started_at, finished_at, result '
+                'FROM jobs WHERE finished_at > ? AND result IS NOT NULL '
+                'AND kind IN (?, ?) ORDER BY finished_at',
+                (time.time() - history * 86400, 'dump', 'dumpall')
+            )
+            for row in cr.fetchall():
+                result = json.loads(row['result'])
+                if result.get('skipped') is True:
+                    continue
+                if row['kind'] == 'dump':
+                    durations[row['dbname']] = (
+                        row['finished_at'] - row['started_at']
+                    )
+                else:
+                    for dbname in result.get('succeeded', {}):
+                        durations[dbname] = result['durations'][dbname]
+        return durations
+
+    def has_run(self, schedule, planned_at):
+        with self._cursor() as cr:
+            cr.execute(
+                'SELECT 1 FROM runs WHERE schedule = ? AND planned_at = ?',
+                (schedule, planned_at)
+            )
+            return cr.fetchone() is not None
+
+    def create_run(self, schedule, planned_at, deadline, jobs):
+        """ Add a run of a schedule and its jobs
+
+        Only one of the processes sharing the queue creates the run of a
+        schedule at a given time.
+
+        :param jobs: list of dicts of the arguments of :meth:`enqueue`
+        :return: id of the run, None if it already exists
+        """
+        run_id = uuid.uuid4().hex
+        with self._cursor(immediate=True) as cr:
+            cr.execute(
+                'INSERT OR IGNORE INTO runs '
+                '(id, schedule, planned_at, deadline, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (run_id, schedule, planned_at, deadline, time.time())
+            )
+            if not cr.rowcount:
+                return None
+            for job in jobs:
+                self._insert(cr, uuid.uuid4().hex, run_id=run_id,
+                             deadline=deadline, **job)
+        return run_id
+
+    def _run_to_dict(self, cr, row):
+        cr.execute(
+            'SELECT * FROM jobs WHERE run_id = ? ORDER BY not_before',
+            (row['id'],)
+        )
+        jobs = [self._to_dict(job) for job in cr.fetchall()]
+        statuses = {job['status'] for job in jobs}
+        if statuses & {QUEUED, RUNNING}:
+            status = RUNNING
+        elif FAILED in statuses:
+            status = FAILED
+        else:
+            status = DONE
+        finished = [job['finished_at'] for job in jobs]
+        return {
+            'id': row['id'],
+            'schedule': row['schedule'],
+            'status': status,
+            'planned_at': _isoformat(row['planned_at']),
+            'deadline': _isoformat(row['deadline']),
+            'finished_at': (
+                max(finished) if finished and status != RUNNING else None
+            ),
+            'succeeded': sum(1 for job in jobs if job['status'] == DONE),
+            'skipped': sum(1 for job in jobs
+                           if (job['result'] or {}).get('skipped')),
+            'failed': sum(1 for job in jobs if job['status'] == FAILED),
+            'jobs': jobs,
+        }
+
+    def get_run(self, run_id):
+        """ Return a run with its jobs, None if it does not exist """
+        with self._cursor() as cr:
+            cr.execute('SELECT * FROM runs WHERE id = ?', (run_id,))
+            row = cr.fetchone()
+            return self._run_to_dict(cr, row) if row else None
+
+    def runs(self, schedule=None, limit=20):
+        """ Return the history of the runs, the last first """
+        with self._cursor() as cr:
+            if schedule:
+                cr.execute(
+                    'SELECT * FROM runs WHERE schedule = ? '
+                    'ORDER BY planned_at DESC LIMIT ?', (schedule, limit)
+                )
+            else:
+                cr.execute(
+                    'SELECT * FROM runs ORDER BY planned_at DESC LIMIT ?',
+                    (limit,)
+                )
+            return [self._run_to_dict(cr, row) for row in cr.fetchall()]
+
+
+class JobRunner():
+    """ Pool of threads running the jobs of a :class:`JobQueue`
+
+    :param queue: the queue
+    :param bagger_factory: callable returning a new Bagger
+    :param workers: number of jobs run at the same time
+    :param poll_interval: seconds between checks for jobs pushed by other
+                          processes
+    :param markers: :class:`~dumpbagserver.changes.ActivityMarkers` to skip
+                    the databases which have not changed in 'dumpall' and
+                    in the scheduled runs
+    """
+
+    def __init__(self, queue, bagger_factory, workers=1, poll_interval=5,
+                 markers=None):
+        self.queue = queue
+        self.bagger_factory = bagger_factory
+        self.markers = markers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.name = '%s:%s' % (socket.gethostname(), os.getpid())
+        self._running = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name='dumpbag-job-worker-%d' % (idx,)
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(
+            target=self._heartbeat, name='dumpbag-job-heartbeat'
+        )
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        _logger.info('started %d job workers', self.workers)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def notify(self):
+        """ Wake up a worker, a job has been pushed by this process """
+        self._wakeup.set()
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            with self._lock:
+                running = list(self._running)
+            try:
+                self.queue.heartbeat(running)
+            except sqlite3.Error:
+                _logger.exception('could not update the running jobs')
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(self.name)
+            except sqlite3.Error:
+                _logger.exception('could not read the jobs queue')
+                job = None
+            if not job:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            with self._lock:
+                self._running.add(job['id'])
+            try:
+                self.run_job(job)
+            finally:
+                with self._lock:
+                    self._running.discard(job['id'])
+
+    def run_job(self, job):
+        _logger.info('running job %s (%s %s)',
+                     job['id'], job['kind'], job['dbname'] or '')
+        try:
+            bagger = self.bagger_factory()
+            if job['kind'] == 'dump' and job['run_id'] and self.markers:
+                filename, skipped = bagger.bag_if_changed(
+                    job['dbname'], self.markers
+                )
+                self.queue.finish(
+                    job['id'], {'filename': filename, 'skipped': skipped}
+                )
+            elif job['kind'] == 'dump':
+                filename = bagger.bag_one_database(job['dbname'])
+                self.queue.finish(job['id'], {'filename': filename})
+            elif job['kind'] == 'dumpall':
+                report = bagger.bag_all_databases(
+                    durations=self.queue.dump_durations(),
+                    markers=self.markers,
+                )
+                if report.ok:
+                    self.queue.finish(job['id'], report.to_dict())
+                else:
+                    self.queue.fail(
+                        job['id'],
+                        'dump failed for %s' % (', '.join(report.failed),),
+                        result=report.to_dict(),
+                    )
+            else:
+                self.queue.fail(job['id'], 'unknown job %s' % (job['kind'],))
+        except Exception as err:
+            _logger.exception('job %s failed', job['id'])
+            self.queue.fail(job['id'], '%s: %s' % (type(err).__name__, err))
+
+
+_queue = None
+_runner = None
+
+
+def job_queue(config):
+    """ Return the queue of the process, None if jobs are not activated """
+    global _queue
+    if not config.state_db:
+        return None
+    if _queue is None:
+        _queue = JobQueue(config.state_db)
+    return _queue
+
+
+def job_runner(config):
+    """ Return the runner of the process, started on the first call """
+    global _runner
+    queue = job_queue(config)
+    if queue is None or not config.job_workers:
+        return None
+    if _runner is None:
+        _runner = JobRunner(
+            queue, lambda: Bagger(config), workers=config.job_workers,
+            markers=activity_markers(config),
+        )
+        _runner.start()
+    return _runner
@@ -0,0 +1,156 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+import time
+
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+    Histogram, generate_latest,
+)
+from prometheus_client import multiprocess
+
+# from seconds for small databases to hours for the big ones
+DUMP_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200,
+                14400, 28800, float('inf'))
+REQUEST_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300,
+                   1800, float('inf'))
+
+STAGE_DURATION = Histogram(
+    'dumpbag_stage_duration_seconds',
+    'Duration of the stages of the dumps (dump, encrypt, push, total)',
+    ['dbname', 'stage'], buckets=DUMP_BUCKETS,
+)
+STAGE_BYTES = Counter(
+    'dumpbag_stage_bytes',
+    'Bytes produced by the stages of the dumps',
+    ['dbname', 'stage'],
+)
+DUMP_FAILURES = Counter(
+    'dumpbag_dump_failures',
+    'Failed dumps by class of exception',
+    ['dbname', 'error'],
+)
+DUMPS_SKIPPED = Counter(
+    'dumpbag_dumps_skipped',
+    'Dumps skipped because the database has not changed',
+    ['dbname'],
+)
+DUMPS_REMOVED = Counter(
+    'dumpbag_dumps_removed',
+    'Dumps removed by the retention policies',
+    ['dbname'],
+)
+DUMP_VALIDATIONS = Counter(
+    'dumpbag_dump_validations',
+    'Validations of the dumps by result (passed, failed, skipped)',
+    ['dbname', 'result'],
+)
+DUMPS_IN_PROGRESS = Gauge(
+    'dumpbag_dumps_in_progress',
+    'Dumps being run',
+    multiprocess_mode='livesum',
+)
+LISTING_DURATION = Histogram(
+    'dumpbag_listing_duration_seconds',
+    'Duration of the listings of the dumps',
+    buckets=REQUEST_BUCKETS,
+)
+DOWNLOAD_DURATION = Histogram(
+    'dumpbag_download_duration_seconds',
+    'Duration of the downloads of the dumps, until the last byte is sent',
+    buckets=REQUEST_BUCKETS,
+)
+
+
+@contextmanager
+def dump_metrics(dbname):
+    """ Count a dump in progress, its total duration and its failure """
+    DUMPS_IN_PROGRESS.inc()
+    start = time.time()
+    try:
+        yield
+    except Exception as err:
+        DUMP_FAILURES.labels(dbname, type(err).__name__).inc()
+        raise
+    else:
+        STAGE_DURATION.labels(dbname, 'total').observe(time.time() - start)
+    finally:
+        DUMPS_IN_PROGRESS.dec()
+
+
+class _Stage():
+    # file written by the stage, set in the context to count its size
+    path = None
+
+
+@contextmanager
+def stage_metrics(dbname, stage):
+    """ Record the duration of a stage which succeeded """
+    start = time.time()
+    current = _Stage()
+    yield current
+    STAGE_DURATION.labels(dbname, stage).observe(time.time() - start)
+    if current.path:
+        STAGE_BYTES.labels(dbname, stage).inc(os.path.getsize(current.path))
+
+
+class MeteredStream():
+    """ Count the bytes read from the output of a stage of a pipeline
+
+    As the stages of a pipeline run concurrently, the duration of a stage
+    is the time from the start of the pipeline until the end of its
+    output.
+
+    The stream has no file descriptor, so it is read by Python by the
+    next stage instead of being given to its process.
+    """
+
+    def __init__(self, stream, dbname, stage, start=None):
+        self._stream = stream
+        self._bytes = STAGE_BYTES.labels(dbname, stage)
+        self._duration = STAGE_DURATION.labels(dbname, stage)
+        self._start = time.time() if start is None else start
+        self._ended = False
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if data:
+            self._bytes.inc(len(data))
+        elif not self._ended:
+            self._ended = True
+            self._duration.observe(time.time() - self._start)
+        return data
+
+
+def observe_download(response, start):
+    """ Record the duration of a download once the response is sent
+
+    The files sent by the server (``wsgi.file_wrapper``) or by nginx are
+    not closed by the response, their duration is the time to prepare
+    the response.
+    """
+    if response.direct_passthrough or response.status_code == 304:
+        DOWNLOAD_DURATION.observe(time.time() - start)
+    else:
+        response.call_on_close(
+            lambda: DOWNLOAD_DURATION.observe(time.time() - start)
+        )
+    return response
+
+
+def exposition():
+    """ Return the metrics in the text format of Prometheus
+
+    With several processes (uwsgi), each process writes its metrics in
+    ``PROMETHEUS_MULTIPROC_DIR`` and they are aggregated here.
+
+    :return: tuple (body, content type)
+    """
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
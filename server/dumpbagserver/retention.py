@@ -0,0 +1,148 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import fnmatch
+import re
+import time
+
+from .catalog import dump_timestamp
+from .exception import DumpConfigurationError
+
+# format of the periods of the rotation, by name of the counter
+RETENTION_PERIODS = (
+    ('daily', '%Y-%m-%d'),
+    # ISO year and week
+    ('weekly', '%G-%V'),
+    ('monthly', '%Y-%m'),
+)
+
+
+class RetentionPolicy():
+    """ Grandfather-father-son rotation of the dumps of a database
+
+    Keeps the last dump of each of the ``daily`` last days having dumps,
+    of the ``weekly`` last weeks and of the ``monthly`` last months. The
+    last dump of the database is always kept, as well as the dumps without
+    a date in their name.
+    """
+
+    def __init__(self, daily=0, weekly=0, monthly=0):
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name, __ in RETENTION_PERIODS}
+
+    def keep(self, filenames):
+        """ Return the set of the dumps to keep """
+        keep = set()
+        dated = []
+        for filename in filenames:
+            timestamp = dump_timestamp(filename)
+            if timestamp is None:
+                keep.add(filename)
+            else:
+                dated.append((timestamp, filename))
+        # the newest first: the first dump seen in a period is its last one
+        dated.sort(reverse=True)
+        if dated:
+            keep.add(dated[0][1])
+        for name, period_format in RETENTION_PERIODS:
+            count = getattr(self, name)
+            periods = set()
+            for timestamp, filename in dated:
+                if len(periods) >= count:
+                    break
+                period = time.strftime(period_format,
+                                       time.localtime(timestamp))
+                if period not in periods:
+                    periods.add(period)
+                    keep.add(filename)
+        return keep
+
+
+def parse_retention(text):
+    """ Parse the retention policies of the configuration
+
+    One policy per line (or separated by ``;``)::
+
+        <database patterns>: daily=<n> weekly=<n> monthly=<n>
+
+    The patterns (fnmatch) are separated by commas, a database uses the
+    first policy matching its name, the dumps of the databases matched by
+    no policy are never removed. The counters not given are 0.
+
+    :return: list of tuples (patterns, :class:`RetentionPolicy`)
+    """
+    policies = []
+    for line in re.split(r'[;\n]', text or ''):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        patterns, sep, definition = line.partition(':')
+        patterns = [
+            pattern.strip() for pattern in patterns.split(',')
+            if pattern.strip()
+        ]
+        if not sep or not patterns:
+            raise DumpConfigurationError(
+                "invalid retention '%s', expected "
+                "'<databases>: daily=<n> weekly=<n> monthly=<n>'" % (line,)
+            )
+        counters = {}
+        for counter in definition.split():
+            name, __, value = counter.partition('=')
+            if (name not in dict(RETENTION_PERIODS) or
+                    not value.isdigit() or name in counters):
+                raise DumpConfigurationError(
+                    "invalid counter '%s' in retention '%s', expected "
+                    "daily=<n>, weekly=<n> or monthly=<n>" % (counter, line)
+                )
+            counters[name] = int(value)
+        if not counters:
+            raise DumpConfigurationError(
+                "retention '%s' keeps nothing but the last dump, give at "
+                "least one of daily, weekly or monthly" % (line,)
+            )
+        policies.append((patterns, RetentionPolicy(**counters)))
+    return policies
+
+
+class Retention():
+    """ Dumps to remove according to the policies of the databases
+
+    :param policies: list of tuples (patterns, :class:`RetentionPolicy`),
+                     see :func:`parse_retention`
+    """
+
+    def __init__(self, policies):
+        self.policies = policies
+
+    def policy(self, dbname):
+        """ Return the policy of a database, None if it has none """
+        for patterns, policy in self.policies:
+            if any(fnmatch.fnmatchcase(dbname, pattern)
+                   for pattern in patterns):
+                return policy
+        return None
+
+    def plan(self, listing):
+        """ Split the dumps in the ones to keep and the ones to remove
+
+        :param listing: dict {dbname: [filenames]}, see
+                        :meth:`StorageCommander.list_by_db`
+        :return: dict {dbname: {'keep': [...], 'delete': [...]}} for the
+                 databases having a policy, the dumps sorted by name
+        """
+        plan = {}
+        for dbname, filenames in listing.items():
+            policy = self.policy(dbname)
+            if policy is None:
+                continue
+            keep = policy.keep(filenames)
+            plan[dbname] = {
+                'keep': sorted(keep),
+                'delete': sorted(set(filenames) - keep),
+            }
+        return plan
@@ -0,0 +1,354 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import fnmatch
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from .bagger import Bagger
+from .exception import DumpConfigurationError
+from .jobs import _isoformat, job_queue
+
+_logger = logging.getLogger(__name__)
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+
+# name, minimum, maximum of the fields of a cron expression
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+)
+
+RE_CRON_PART = re.compile(r'^(\*|(\d+)(?:-(\d+))?)(?:/(\d+))?$')
+
+# the occurrences are searched up to this number of days ahead
+CRON_HORIZON_DAYS = 4 * 366
+
+
+class CronExpression():
+    """ Cron expression: minute hour day month weekday
+
+    Supports ``*``, values, ranges (``1-5``), steps (``*/15``, ``0-30/10``),
+    lists (``1,15``) and the aliases ``@hourly``, ``@daily``, ``@weekly``,
+    ``@monthly``. As with cron, when both the day and the weekday are
+    restricted, a time matching either of them matches. The times are
+    in the local time of the server.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise DumpConfigurationError(
+                "cron expression '%s' must have %d fields"
+                % (expression, len(CRON_FIELDS))
+            )
+        values = [
+            self._parse_field(field, *spec)
+            for field, spec in zip(fields, CRON_FIELDS)
+        ]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        # 0 and 7 are sunday
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _parse_field(self, field, name, minimum, maximum):
+        values = set()
+        for part in field.split(','):
+            match = RE_CRON_PART.match(part)
+            if not match:
+                raise DumpConfigurationError(
+                    "invalid %s '%s' in cron expression '%s'"
+                    % (name, part, self.expression)
+                )
+            every, start, end, step = match.groups()
+            if every == '*':
+                start, end = minimum, maximum
+            else:
+                start = int(start)
+                # '5/15' means from 5 to the end by 15
+                end = int(end) if end else (maximum if step else start)
+            step = int(step) if step else 1
+            if not minimum <= start <= end <= maximum or not step:
+                raise DumpConfigurationError(
+                    "invalid %s '%s' in cron expression '%s'"
+                    % (name, part, self.expression)
+                )
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        # isoweekday(): monday is 1, sunday is 7
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        if self._any_day:
+            return weekday
+        if self._any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, moment):
+        """ Return the first time strictly after ``moment`` """
+        moment = moment.replace(second=0, microsecond=0) + timedelta(
+            minutes=1
+        )
+        limit = moment + timedelta(days=CRON_HORIZON_DAYS)
+        while moment < limit:
+            if moment.month not in self.months:
+                # first day of the next month
+                moment = (moment.replace(day=1, hour=0, minute=0)
+                          + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        return None
+
+
+class Schedule():
+    """ Dumps of databases run at the times of a cron expression
+
+    :param name: name of the schedule
+    :param cron: cron expression
+    :param databases: patterns (fnmatch) of the names of the databases
+    :param window: seconds after the time of a run during which its dumps
+                   can be started or retried
+    """
+
+    def __init__(self, name, cron, databases=('*',), window=4 * 3600):
+        self.name = name
+        self.cron = CronExpression(cron)
+        self.databases = tuple(databases)
+        self.window = window
+
+    def select(self, databases):
+        return [
+            dbname for dbname in databases
+            if any(fnmatch.fnmatchcase(dbname, pattern)
+                   for pattern in self.databases)
+        ]
+
+    def current_run(self, now):
+        """ Timestamp of the last run whose window is still open """
+        start = datetime.fromtimestamp(now - self.window)
+        planned = None
+        moment = self.cron.next_after(start)
+        while moment is not None and moment.timestamp() <= now:
+            planned = moment
+            moment = self.cron.next_after(moment)
+        return planned.timestamp() if planned else None
+
+    def next_run(self, now):
+        moment = self.cron.next_after(datetime.fromtimestamp(now))
+        return moment.timestamp() if moment else None
+
+
+def parse_schedules(text):
+    """ Parse the schedules of the configuration
+
+    One schedule per line (or separated by ``;``)::
+
+        <name>: <cron expression> [| <database patterns> [| <window>]]
+
+    The patterns are separated by commas (default ``*``), the window is
+    in minutes (default 240).
+    """
+    schedules = []
+    for line in re.split(r'[;\n]', text or ''):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, sep, definition = line.partition(':')
+        parts = [part.strip() for part in definition.split('|')]
+        if not sep or not name.strip() or not parts[0] or len(parts) > 3:
+            raise DumpConfigurationError(
+                "invalid schedule '%s', expected "
+                "'<name>: <cron> | <databases> | <window minutes>'" % (line,)
+            )
+        kwargs = {}
+        if len(parts) > 1 and parts[1]:
+            kwargs['databases'] = [
+                pattern.strip() for pattern in parts[1].split(',')
+                if pattern.strip()
+            ]
+        if len(parts) > 2 and parts[2]:
+            if not parts[2].isdigit() or not int(parts[2]):
+                raise DumpConfigurationError(
+                    "window of the schedule '%s' must be a number of "
+                    "minutes, got '%s'" % (name.strip(), parts[2])
+                )
+            kwargs['window'] = int(parts[2]) * 60
+        schedules.append(Schedule(name.strip(), parts[0], **kwargs))
+    names = [schedule.name for schedule in schedules]
+    if len(set(names)) != len(names):
+        raise DumpConfigurationError('the names of the schedules must be '
+                                     'unique: %s' % (', '.join(names),))
+    return schedules
+
+
+class Scheduler():
+    """ Thread queueing the dumps of the schedules in a :class:`JobQueue`
+
+    At the time of a run, a job is queued for each database of the
+    schedule. Their start times are spread by ``stagger`` seconds (less
+    if they would not all start in the first half of the window), the
+    failed dumps are retried after ``retry_delay`` seconds while the
+    window is open. A run missed while the server was stopped is started
+    if its window is still open. Several processes can share the queue:
+    a run is queued only once.
+
+    :param queue: the queue
+    :param schedules: list of :class:`Schedule`
+    :param bagger_factory: callable returning a new Bagger
+    :param stagger: seconds between the starts of the dumps of a run
+    :param retries: number of retries of a failed dump
+    :param retry_delay: seconds between a failure and its retry
+    :param interval: seconds between checks of the schedules
+    """
+
+    def __init__(self, queue, schedules, bagger_factory, stagger=60,
+                 retries=2, retry_delay=900, interval=30):
+        self.queue = queue
+        self.schedules = schedules
+        self.bagger_factory = bagger_factory
+        self.stagger = stagger
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._loop, name='dumpbag-scheduler'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        _logger.info('started the scheduler of %s',
+                     ', '.join(schedule.name for schedule in self.schedules))
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                _logger.exception('could not queue the scheduled dumps')
+            if self._stop.wait(self.interval):
+                return
+
+    def tick(self, now=None):
+        """ Queue the runs which are due
+
+        :return: ids of the queued runs
+        """
+        if now is None:
+            now = time.time()
+        run_ids = []
+        for schedule in self.schedules:
+            planned_at = schedule.current_run(now)
+            if planned_at is None:
+                continue
+            if self.queue.has_run(schedule.name, planned_at):
+                continue
+            run_id = self.queue_run(schedule, planned_at)
+            if run_id:
+                run_ids.append(run_id)
+        return run_ids
+
+    def queue_run(self, schedule, planned_at):
+        # the longest dumps start first
+        databases = self.bagger_factory().dump_order(
+            durations=self.queue.dump_durations()
+        )
+        if not databases:
+            # the listing failed (a metadata query returns no rows on
+            # error), a run without jobs would be done: retry next tick
+            _logger.error('no database listed, run of %s not queued',
+                          schedule.name)
+            return None
+        databases = schedule.select(databases)
+        deadline = planned_at + schedule.window
+        stagger = self.stagger
+        if databases and stagger * len(databases) > schedule.window / 2:
+            stagger = schedule.window / 2 / len(databases)
+        jobs = [
+            {
+                'kind': 'dump',
+                'dbname': dbname,
+                'not_before': planned_at + idx * stagger,
+                'max_attempts': self.retries + 1,
+                'retry_delay': self.retry_delay,
+            }
+            for idx, dbname in enumerate(databases)
+        ]
+        try:
+            run_id = self.queue.create_run(
+                schedule.name, planned_at, deadline, jobs
+            )
+        except sqlite3.Error:
+            _logger.exception('could not queue the run of %s', schedule.name)
+            return None
+        if run_id:
+            _logger.info('queued run %s of %s for %d databases',
+                         run_id, schedule.name, len(jobs))
+        return run_id
+
+    def to_dict(self, now=None):
+        if now is None:
+            now = time.time()
+        return [
+            {
+                'name': schedule.name,
+                'cron': schedule.cron.expression,
+                'databases': list(schedule.databases),
+                'window': schedule.window,
+                'next_run': _isoformat(schedule.next_run(now)),
+                'runs': self.queue.runs(schedule=schedule.name, limit=10),
+            }
+            for schedule in self.schedules
+        ]
+
+
+_scheduler = None
+
+
+def job_scheduler(config):
+    """ Return the scheduler of the process, started on the first call
+
+    None when there is no schedule or the process does not run jobs.
+    """
+    global _scheduler
+    queue = job_queue(config)
+    if queue is None or not config.job_workers or not config.schedules:
+        return None
+    if _scheduler is None:
+        _scheduler = Scheduler(
+            queue, config.schedules, lambda: Bagger(config),
+            stagger=config.schedule_stagger,
+            retries=config.schedule_retries,
+            retry_delay=config.schedule_retry_delay,
+        )
+        _scheduler.start()
+    return _scheduler
@@ -2,21 +2,68 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 import errno
+import io
 import json
 import logging
 import os
 import shutil
 import subprocess
 import tempfile
+import threading
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from contextlib import contextmanager
-from subprocess import PIPE
+from datetime import datetime, timezone
+from subprocess import DEVNULL, PIPE
+
+import boto3
+
+from boto3.exceptions import Boto3Error
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 
 from .exception import DumpNotExistError, DumpStorageError
+from .stream import CHUNK_SIZE, PipedProcess, read_chunks
 
 _logger = logging.getLogger(__name__)
 
 
+# last_modified is an aware datetime in UTC, etag an opaque string
+DumpStat = namedtuple('DumpStat', 'size last_modified etag')
+# suffix of the files keeping the sha256 of the dumps, see push_checksum
+CHECKSUM_SUFFIX = '.sha256'
+
+
+def is_dump(filename):
+    """ False for the hidden files and the checksums of the dumps """
+    return not (filename.startswith('.') or
+                filename.endswith(CHECKSUM_SUFFIX))
+
+
+def checksum_content(filename, checksum):
+    """ Content of the checksum file of a dump, as written by sha256sum """
+    return ('%s  %s\n' % (checksum, filename)).encode('utf8')
+
+
+def parse_checksum(content):
+    """ Return the sha256 in the content of a checksum file """
+    fields = content.decode('utf8', 'replace').split()
+    return fields[0].lower() if fields else None
+
+
+# page of a listing: dumps is a list of (dbname, filename) ordered by
+# database and filename, cursor gives the next page, None on the last one,
+# sizes are the sizes in bytes by 'dbname/filename' when the listing
+# returns them, details the records of the catalog by 'dbname/filename'
+# when the page comes from it
+DumpPage = namedtuple('DumpPage', 'dumps cursor sizes details')
+# the 'defaults' argument of namedtuple needs python 3.7
+DumpPage.__new__.__defaults__ = (None,)
+
+
 class StorageOptions():
     """ Base options for commanders """
     _commander = None
@@ -30,6 +77,10 @@ class StorageCommander():
 
     """
 
+    # when True, the dumps are pushed unencrypted and the storage is
+    # responsible of their encryption
+    handles_encryption = False
+
     def __init__(self, options):
         self.options = options
 
@@ -40,9 +91,55 @@ class StorageCommander():
             raise TypeError('No commander class set for these options')
         return klass(options)
 
+    def location(self):
+        """ URL of the root of the storage """
+        raise NotImplementedError
+
     def push_to_storage(self, dbname, source_path, filename):
         raise NotImplementedError
 
+    def push_stream(self, dbname, stream, filename, size=None):
+        """ Push the content of a stream to the storage
+
+        :param stream: binary file object read until its end
+        :param size: size of the stream in bytes, when known beforehand
+        """
+        raise NotImplementedError
+
+    def delete_dump(self, dbname, filename):
+        """ Remove a dump from the storage, if it exists """
+        raise NotImplementedError
+
+    def push_checksum(self, dbname, filename, checksum):
+        """ Store the sha256 of a dump next to it
+
+        In ``<filename>.sha256``, with the format of ``sha256sum``, so a
+        downloaded dump can be checked with ``sha256sum -c``.
+        """
+        self.push_stream(
+            dbname, io.BytesIO(checksum_content(filename, checksum)),
+            filename + CHECKSUM_SUFFIX,
+        )
+
+    def read_checksum(self, dbname, filename):
+        """ Return the sha256 of a dump, None if it is unknown """
+        try:
+            with self.read_from_storage(
+                    dbname, filename + CHECKSUM_SUFFIX) as f:
+                return parse_checksum(f.read())
+        except DumpNotExistError:
+            return None
+
+    def delete_dumps(self, dumps):
+        """ Remove several dumps from the storage, if they exist
+
+        The storages which can remove several objects at once override it.
+
+        :param dumps: list of tuples (dbname, filename)
+        """
+        for dbname, filename in dumps:
+            self.delete_dump(dbname, filename)
+
     @contextmanager
     def read_from_storage(self, dbname, filename):
         """ Get a file from storage for reading
@@ -59,9 +156,64 @@ class StorageCommander():
         """
         raise NotImplementedError
 
-    def read_dump(self, dbname, filename):
+    def list_page(self, dbname=None, cursor=None, start_after=None,
+                  limit=1000):
+        """ Return a :class:`DumpPage` of the dumps
+
+        The base implementation pages the complete listing, the storages
+        which can list by page override it.
+
+        :param dbname: name of a dbname to filter
+        :param cursor: cursor of the previous page
+        :param start_after: 'dbname/filename' before the first dump returned
+        :param limit: maximum number of dumps returned
+        """
+        after = cursor or start_after
+        keys = sorted(
+            '%s/%s' % (name, filename)
+            for name, filenames in self.list_by_db(dbname=dbname).items()
+            for filename in filenames
+        )
+        if after:
+            keys = [key for key in keys if key > after]
+        page = keys[:limit]
+        return DumpPage(
+            [tuple(key.split('/', 1)) for key in page],
+            page[-1] if len(keys) > limit else None,
+            {},
+        )
+
+    def stat_dump(self, dbname, filename):
+        """ Return the :class:`DumpStat` of a dump
+
+        None when the storage does not know them.
+        Raises :class:`DumpNotExistError` if the dump does not exist.
+        """
+        return None
+
+    def local_path(self, dbname, filename):
+        """ Path of the dump on the local file system
+
+        None when the storage is not local.
+        """
+        return None
+
+    def accel_redirect_uri(self, dbname, filename):
+        """ URI of the dump in an internal location of nginx
+
+        When the storage returns one, the server sends a X-Accel-Redirect
+        header and nginx sends the dump itself.
+        """
+        return None
+
+    def read_dump(self, dbname, filename, offset=0, length=None):
+        """ Generator returning the content of a dump by chunks
+
+        :param offset: position of the first byte to read
+        :param length: number of bytes to read, until the end by default
+        """
         with self.read_from_storage(dbname, filename) as f:
-            for chunk in iter(lambda: f.read(1024), b''):
+            for chunk in read_chunks(f, offset=offset, length=length):
                 yield chunk
 
     def download_commands(self, dbname, filename):
@@ -76,6 +228,12 @@ class LocalStorageCommander(StorageCommander):
 
     """
 
+    # number of files removed at the same time by delete_dumps
+    DELETE_CONCURRENCY = 8
+
+    def location(self):
+        return 'file://%s' % (os.path.abspath(self.options.storage_dir),)
+
     def push_to_storage(self, dbname, source_path, filename):
         source = os.path.join(source_path, filename)
         target_dir = os.path.join(self.options.storage_dir, dbname)
@@ -84,6 +242,42 @@ class LocalStorageCommander(StorageCommander):
         target = os.path.join(target_dir, filename)
         shutil.copy2(source, target)
 
+    def push_stream(self, dbname, stream, filename, size=None):
+        target_dir = os.path.join(self.options.storage_dir, dbname)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        target = os.path.join(target_dir, filename)
+        # hidden while being written so it is not listed before the end
+        partial = os.path.join(target_dir, '.%s.part' % (filename,))
+        try:
+            with open(partial, 'wb') as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+            os.rename(partial, target)
+        except BaseException:
+            self._remove(partial)
+            raise
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:  # file does not exist
+                raise
+
+    def delete_dump(self, dbname, filename):
+        path = os.path.join(self.options.storage_dir, dbname, filename)
+        self._remove(path)
+        self._remove(path + CHECKSUM_SUFFIX)
+
+    def delete_dumps(self, dumps):
+        # the files are removed concurrently, unlinks are slow on network
+        # file systems
+        with ThreadPoolExecutor(
+                max_workers=self.DELETE_CONCURRENCY) as executor:
+            for __ in executor.map(lambda dump: self.delete_dump(*dump),
+                                   dumps):
+                pass
+
     @contextmanager
     def read_from_storage(self, dbname, filename):
         storage_dir = self.options.storage_dir
@@ -93,6 +287,29 @@ class LocalStorageCommander(StorageCommander):
         with open(fullpath, 'rb') as f:
             yield f
 
+    def local_path(self, dbname, filename):
+        return os.path.join(self.options.storage_dir, dbname, filename)
+
+    def accel_redirect_uri(self, dbname, filename):
+        if not self.options.accel_redirect:
+            return None
+        return '%s/%s/%s' % (
+            self.options.accel_redirect.rstrip('/'),
+            quote(dbname), quote(filename),
+        )
+
+    def stat_dump(self, dbname, filename):
+        fullpath = self.local_path(dbname, filename)
+        try:
+            stat = os.stat(fullpath)
+        except FileNotFoundError:
+            raise DumpNotExistError('%s dump does not exist' % (filename,))
+        return DumpStat(
+            stat.st_size,
+            datetime.fromtimestamp(int(stat.st_mtime), timezone.utc),
+            '%x-%x' % (stat.st_size, stat.st_mtime_ns),
+        )
+
     def list_by_db(self, dbname=None):
         files = {}
         storage_dir = self.options.storage_dir
@@ -101,17 +318,62 @@ class LocalStorageCommander(StorageCommander):
             if dbname and dbname != directory:
                 continue
             for filename in filenames:
+                if not is_dump(filename):
+                    continue
                 files.setdefault(directory, set())
                 files[directory].add(filename)
         return files
 
+    def list_page(self, dbname=None, cursor=None, start_after=None,
+                  limit=1000):
+        # the cursor is the last dump of the previous page
+        after_db, after_file = '', ''
+        if cursor or start_after:
+            after_db, __, after_file = (cursor or start_after).partition('/')
+        storage_dir = self.options.storage_dir
+        if dbname:
+            databases = [dbname]
+        else:
+            try:
+                databases = sorted(
+                    entry.name for entry in os.scandir(storage_dir)
+                    if entry.is_dir() and not entry.name.startswith('.')
+                )
+            except FileNotFoundError:
+                databases = []
+        dumps = []
+        sizes = {}
+        for name in databases:
+            if name < after_db:
+                continue
+            try:
+                entries = sorted(
+                    (entry for entry
+                     in os.scandir(os.path.join(storage_dir, name))
+                     if entry.is_file() and is_dump(entry.name)),
+                    key=lambda entry: entry.name,
+                )
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if name == after_db and entry.name <= after_file:
+                    continue
+                if len(dumps) == limit:
+                    last = dumps[-1]
+                    return DumpPage(dumps, '%s/%s' % last, sizes)
+                dumps.append((name, entry.name))
+                sizes['%s/%s' % (name, entry.name)] = entry.stat().st_size
+        return DumpPage(dumps, None, sizes)
+
 
 class LocalOptions():
     """ Options for the local storage commander """
     _commander = LocalStorageCommander
 
-    def __init__(self, storage_dir):
+    def __init__(self, storage_dir, accel_redirect=None):
         self.storage_dir = storage_dir
+        # prefix of an internal location of nginx serving storage_dir
+        self.accel_redirect = accel_redirect
 
 
 class S3StorageCommander(StorageCommander):
@@ -122,14 +384,24 @@ class S3StorageCommander(StorageCommander):
 
     """
 
+    # maximum number of keys of a delete-objects request
+    DELETE_BATCH = 1000
+
+    def location(self):
+        return 's3://%s' % (self.options.bucket,)
+
     def _env_variables(self):
         vars = {'AWS_ACCESS_KEY_ID': self.options.access_key,
                 'AWS_SECRET_ACCESS_KEY': self.options.secret_access_key}
         return vars
 
-    def _exec_s3_cmd(self, command):
+    def _s3_env(self):
         s3env = os.environ.copy()
         s3env.update(**self._env_variables())
+        return s3env
+
+    def _exec_s3_cmd(self, command):
+        s3env = self._s3_env()
         proc = subprocess.Popen(command, env=s3env, stdout=PIPE, stderr=PIPE)
         stdout, stderr = proc.communicate()
         if proc.returncode:
@@ -151,6 +423,69 @@ class S3StorageCommander(StorageCommander):
         command = ['aws', 's3', 'cp', source, target]
         self._exec_s3_cmd(command)
 
+    def push_stream(self, dbname, stream, filename, size=None):
+        key = "%s/%s" % (dbname, filename)
+        target = "s3://%s/%s" % (self.options.bucket, key)
+        command = ['aws', 's3', 'cp', '-', target]
+        expected_size = size or self.options.stream_expected_size
+        if expected_size:
+            # required by aws to choose the part size above 50GB
+            command += ['--expected-size', str(expected_size)]
+        proc = PipedProcess(
+            command, source=stream, env=self._s3_env(), stdout=DEVNULL
+        )
+        returncode, stderr = proc.wait()
+        if returncode:
+            _logger.error('error when running aws command:\n%s', stderr)
+            raise DumpStorageError(stderr)
+        self._add_expire_tag(key)
+        _logger.info('pushed dump %s to S3', filename)
+
+    def delete_dump(self, dbname, filename):
+        # with its checksum, in one request
+        self.delete_dumps([(dbname, filename)])
+
+    @staticmethod
+    def _delete_batches(dumps, size):
+        """ Keys of the dumps and of their checksums, by batches """
+        keys = []
+        for dbname, filename in dumps:
+            key = '%s/%s' % (dbname, filename)
+            keys += [key, key + CHECKSUM_SUFFIX]
+        for idx in range(0, len(keys), size):
+            yield keys[idx:idx + size]
+
+    def read_checksum(self, dbname, filename):
+        source = "s3://%s/%s/%s%s" % (
+            self.options.bucket, dbname, filename, CHECKSUM_SUFFIX
+        )
+        try:
+            stdout, _stderr = self._exec_s3_cmd(['aws', 's3', 'cp', source,
+                                                 '-'])
+        except DumpStorageError as err:
+            if '(404)' in str(err):
+                return None
+            raise
+        return parse_checksum(stdout)
+
+    def delete_dumps(self, dumps):
+        for batch in self._delete_batches(dumps, self.DELETE_BATCH):
+            # a file: the keys of a batch can exceed the length of an argument
+            with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+                json.dump({
+                    'Objects': [{'Key': key} for key in batch],
+                    'Quiet': True,
+                }, f)
+                f.flush()
+                command = ['aws', 's3api', 'delete-objects',
+                           '--bucket', self.options.bucket,
+                           '--delete', 'file://%s' % (f.name,),
+                           ]
+                stdout, __ = self._exec_s3_cmd(command)
+            errors = json.loads(stdout.decode('utf8') or '{}').get('Errors')
+            if errors:
+                raise DumpStorageError(_delete_errors(errors))
+
     def _add_expire_tag(self, key):
         """Add an Expire=True tag on the pushed object
 
@@ -169,23 +504,81 @@ class S3StorageCommander(StorageCommander):
     def read_from_storage(self, dbname, filename):
         """ Get a file from storage for reading
 
-        Context manager so it can clean the files after usage
+        The object is streamed from S3 on the stdout of ``aws``, nothing
+        is written on the disk.
         """
         source = "s3://%s/%s/%s" % (self.options.bucket, dbname, filename)
         _logger.info('Initiating download from S3 for %s', source)
-        tmpdir = tempfile.mkdtemp()
-        target = os.path.join(tmpdir, filename)
-        command = ['aws', 's3', 'cp', source, target]
-        self._exec_s3_cmd(command)
+        command = ['aws', 's3', 'cp', source, '-']
+        proc = PipedProcess(command, env=self._s3_env())
         try:
-            with open(target, 'rb') as f:
-                yield f
-        finally:
+            yield proc.stdout
+        except BaseException:
+            proc.abort()
+            raise
+        returncode, stderr = proc.wait()
+        if returncode:
+            _logger.error('error when running aws command:\n%s', stderr)
+            raise DumpStorageError(stderr)
+
+    def stat_dump(self, dbname, filename):
+        command = ['aws', 's3api', 'head-object',
+                   '--bucket', self.options.bucket,
+                   '--key', "%s/%s" % (dbname, filename),
+                   ]
+        try:
+            stdout, _stderr = self._exec_s3_cmd(command)
+        except DumpStorageError as err:
+            if '(404)' in str(err):
+                raise DumpNotExistError(
+                    '%s dump does not exist' % (filename,)
+                )
+            raise
+        head = json.loads(stdout.decode('utf8'))
+        # e.g. 2017-09-04T09:23:33+00:00
+        last_modified = datetime.strptime(
+            head['LastModified'][:19], '%Y-%m-%dT%H:%M:%S'
+        ).replace(tzinfo=timezone.utc)
+        return DumpStat(
+            head['ContentLength'], last_modified, head['ETag'].strip('"')
+        )
+
+    def read_dump(self, dbname, filename, offset=0, length=None):
+        if not offset and length is None:
+            for chunk in super().read_dump(dbname, filename):
+                yield chunk
+            return
+        byte_range = 'bytes=%d-%s' % (
+            offset, offset + length - 1 if length is not None else ''
+        )
+        # get-object writes the object in a file and the response on
+        # stdout, the file is a pipe to stream the content
+        read_fd, write_fd = os.pipe()
+        command = ['aws', 's3api', 'get-object',
+                   '--bucket', self.options.bucket,
+                   '--key', "%s/%s" % (dbname, filename),
+                   '--range', byte_range,
+                   '/dev/fd/%d' % (write_fd,),
+                   ]
+        # opened first, so it is closed when the command cannot start
+        with open(read_fd, 'rb') as f:
+            try:
+                proc = PipedProcess(
+                    command, env=self._s3_env(), stdout=DEVNULL,
+                    pass_fds=(write_fd,),
+                )
+            finally:
+                os.close(write_fd)
             try:
-                shutil.rmtree(tmpdir)
-            except OSError as err:
-                if err.errno != errno.ENOENT:  # file does not exist
-                    raise
+                for chunk in read_chunks(f, length=length):
+                    yield chunk
+            except BaseException:
+                proc.abort()
+                raise
+        returncode, stderr = proc.wait()
+        if returncode:
+            _logger.error('error when running aws command:\n%s', stderr)
+            raise DumpStorageError(stderr)
 
     def list_by_db(self, dbname=None):
         """ Return a dict with files path/url
@@ -202,13 +595,38 @@ class S3StorageCommander(StorageCommander):
         files = {}
         for line in json.loads(stdout.decode('utf8')) or []:
             spl = line.split('/')
-            if len(spl) != 2:
+            if len(spl) != 2 or not is_dump(spl[1]):
                 continue
             dbname, filename = spl
             files.setdefault(dbname, [])
             files[dbname].append(filename)
         return files
 
+    def list_page(self, dbname=None, cursor=None, start_after=None,
+                  limit=1000):
+        # the cursor is the NextToken of aws
+        command = ['aws', 's3api', 'list-objects-v2',
+                   '--bucket', self.options.bucket,
+                   '--max-items', str(limit),
+                   '--page-size', str(limit)]
+        if dbname:
+            command += ['--prefix', dbname + '/']
+        if cursor:
+            command += ['--starting-token', cursor]
+        elif start_after:
+            command += ['--start-after', start_after]
+        stdout, _stderr = self._exec_s3_cmd(command)
+        result = json.loads(stdout.decode('utf8') or '{}')
+        dumps = []
+        sizes = {}
+        for content in result.get('Contents') or []:
+            spl = content['Key'].split('/')
+            if len(spl) == 2 and is_dump(spl[1]):
+                dumps.append(tuple(spl))
+                if 'Size' in content:
+                    sizes[content['Key']] = content['Size']
+        return DumpPage(dumps, result.get('NextToken'), sizes)
+
     def download_commands(self, dbname, filename):
         target = "s3://%s/%s/%s" % (self.options.bucket, dbname, filename)
         lines = [
@@ -225,7 +643,246 @@ class S3Options(StorageOptions):
     """ Options for the S3 Storage commander """
     _commander = S3StorageCommander
 
-    def __init__(self, bucket, access_key, secret_access_key):
+    def __init__(self, bucket, access_key, secret_access_key,
+                 stream_expected_size=None):
         self.bucket = bucket
         self.access_key = access_key
         self.secret_access_key = secret_access_key
+        self.stream_expected_size = stream_expected_size
+
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def _delete_errors(errors):
+    """ Message of the errors of a S3 delete-objects request """
+    return 'could not delete %d objects: %s' % (len(errors), ', '.join(
+        '%s (%s)' % (error['Key'], error.get('Message') or error['Code'])
+        for error in errors
+    ))
+
+
+def _s3_client(options):
+    """ Return a S3 client shared by the commanders with the same options
+
+    The clients are thread-safe and keep a pool of connections.
+    """
+    key = (options.endpoint_url, options.region, options.access_key,
+           options.secret_access_key, options.max_pool_connections)
+    with _s3_clients_lock:
+        client = _s3_clients.get(key)
+        if client is None:
+            session = boto3.session.Session(
+                aws_access_key_id=options.access_key,
+                aws_secret_access_key=options.secret_access_key,
+                region_name=options.region,
+            )
+            client = session.client(
+                's3',
+                endpoint_url=options.endpoint_url,
+                config=BotoConfig(
+                    max_pool_connections=options.max_pool_connections,
+                ),
+            )
+            _s3_clients[key] = client
+    return client
+
+
+class S3ClientStorageCommander(S3StorageCommander):
+    """ Commander used for storing on S3 with an in-process client
+
+    Same storage as :class:`S3StorageCommander`, but the operations are
+    done with a pooled boto3 client instead of running ``aws`` commands.
+    The uploads are done in parts sent concurrently and the expire tag is
+    set by the upload.
+
+    :params options: options for the commands
+    :type options: S3ClientOptions
+
+    """
+
+    def _client(self):
+        return _s3_client(self.options)
+
+    def _transfer_config(self):
+        return TransferConfig(
+            multipart_threshold=self.options.part_size,
+            multipart_chunksize=self.options.part_size,
+            max_concurrency=self.options.max_concurrency,
+        )
+
+    @contextmanager
+    def _s3_errors(self):
+        try:
+            yield
+        except (Boto3Error, BotoCoreError, ClientError) as err:
+            _logger.error('error when calling S3:\n%s', err)
+            raise DumpStorageError(str(err))
+
+    def push_to_storage(self, dbname, source_path, filename):
+        source = os.path.join(source_path, filename)
+        with open(source, 'rb') as f:
+            self.push_stream(dbname, f, filename)
+
+    def push_stream(self, dbname, stream, filename, size=None):
+        key = "%s/%s" % (dbname, filename)
+        with self._s3_errors():
+            self._client().upload_fileobj(
+                stream, self.options.bucket, key,
+                # see _add_expire_tag
+                ExtraArgs={'Tagging': 'Expire=True'},
+                Config=self._transfer_config(),
+            )
+        _logger.info('pushed dump %s to S3', filename)
+
+    def read_checksum(self, dbname, filename):
+        return StorageCommander.read_checksum(self, dbname, filename)
+
+    def delete_dumps(self, dumps):
+        client = self._client()
+        for batch in self._delete_batches(dumps, self.DELETE_BATCH):
+            with self._s3_errors():
+                response = client.delete_objects(
+                    Bucket=self.options.bucket,
+                    Delete={
+                        'Objects': [{'Key': key} for key in batch],
+                        'Quiet': True,
+                    },
+                )
+            if response.get('Errors'):
+                raise DumpStorageError(_delete_errors(response['Errors']))
+
+    @contextmanager
+    def read_from_storage(self, dbname, filename):
+        key = "%s/%s" % (dbname, filename)
+        with self._s3_errors():
+            try:
+                response = self._client().get_object(
+                    Bucket=self.options.bucket, Key=key
+                )
+            except ClientError as err:
+                if err.response['Error']['Code'] == 'NoSuchKey':
+                    raise DumpNotExistError(
+                        '%s dump does not exist' % (filename,)
+                    )
+                raise
+        body = response['Body']
+        try:
+            with self._s3_errors():
+                yield body
+        finally:
+            body.close()
+
+    def stat_dump(self, dbname, filename):
+        key = "%s/%s" % (dbname, filename)
+        with self._s3_errors():
+            try:
+                head = self._client().head_object(
+                    Bucket=self.options.bucket, Key=key
+                )
+            except ClientError as err:
+                if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    raise DumpNotExistError(
+                        '%s dump does not exist' % (filename,)
+                    )
+                raise
+        return DumpStat(
+            head['ContentLength'],
+            head['LastModified'].astimezone(timezone.utc),
+            head['ETag'].strip('"'),
+        )
+
+    def read_dump(self, dbname, filename, offset=0, length=None):
+        if not offset and length is None:
+            for chunk in super().read_dump(dbname, filename):
+                yield chunk
+            return
+        byte_range = 'bytes=%d-%s' % (
+            offset, offset + length - 1 if length is not None else ''
+        )
+        key = "%s/%s" % (dbname, filename)
+        with self._s3_errors():
+            body = self._client().get_object(
+                Bucket=self.options.bucket, Key=key, Range=byte_range
+            )['Body']
+            try:
+                for chunk in read_chunks(body, length=length):
+                    yield chunk
+            finally:
+                body.close()
+
+    def list_by_db(self, dbname=None):
+        params = {'Bucket': self.options.bucket}
+        if dbname:
+            params['Prefix'] = dbname + '/'
+        files = {}
+        paginator = self._client().get_paginator('list_objects_v2')
+        with self._s3_errors():
+            for page in paginator.paginate(**params):
+                for content in page.get('Contents', []):
+                    spl = content['Key'].split('/')
+                    if len(spl) != 2 or not is_dump(spl[1]):
+                        continue
+                    dbname, filename = spl
+                    files.setdefault(dbname, [])
+                    files[dbname].append(filename)
+        return files
+
+    def list_page(self, dbname=None, cursor=None, start_after=None,
+                  limit=1000):
+        # the cursor is the continuation token of S3
+        params = {'Bucket': self.options.bucket, 'MaxKeys': limit}
+        if dbname:
+            params['Prefix'] = dbname + '/'
+        if cursor:
+            params['ContinuationToken'] = cursor
+        elif start_after:
+            params['StartAfter'] = start_after
+        with self._s3_errors():
+            result = self._client().list_objects_v2(**params)
+        dumps = []
+        sizes = {}
+        for content in result.get('Contents', []):
+            spl = content['Key'].split('/')
+            if len(spl) == 2 and is_dump(spl[1]):
+                dumps.append(tuple(spl))
+                sizes[content['Key']] = content['Size']
+        cursor = None
+        if result.get('IsTruncated'):
+            cursor = result['NextContinuationToken']
+        return DumpPage(dumps, cursor, sizes)
+
+    def download_commands(self, dbname, filename):
+        lines, params = super().download_commands(dbname, filename)
+        if self.options.endpoint_url:
+            lines = [
+                "# Using S3 (recommended if you have the access, "
+                "see in lastpass)",
+                "$$ aws --profile=odoo-dumps "
+                "--endpoint-url $s3_endpoint_url s3 cp $s3_url .",
+            ]
+            params['s3_endpoint_url'] = self.options.endpoint_url
+        return lines, params
+
+
+class S3ClientOptions(S3Options):
+    """ Options for the S3 client Storage commander
+
+    :param endpoint_url: URL of a S3 compatible service, default is AWS
+    :param region: region of the bucket
+    :param part_size: size in bytes of the parts of the uploads
+    :param max_concurrency: number of parts uploaded at the same time
+    """
+    _commander = S3ClientStorageCommander
+
+    def __init__(self, bucket, access_key, secret_access_key,
+                 endpoint_url=None, region=None, part_size=64 * 1024 ** 2,
+                 max_concurrency=8):
+        super().__init__(bucket, access_key, secret_access_key)
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        # at least one connection per concurrent part
+        self.max_pool_connections = max(10, max_concurrency * 2)
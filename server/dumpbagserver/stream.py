@@ -0,0 +1,164 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import hashlib
+import io
+import subprocess
+import tempfile
+import threading
+
+from subprocess import PIPE
+
+CHUNK_SIZE = 64 * 1024
+
+
+def has_fileno(stream):
+    """ Return True if the stream is backed by a file descriptor """
+    try:
+        stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+class PipedProcess():
+    """ A subprocess used as a stage of a streaming pipeline
+
+    The process reads its stdin from ``source`` and its stdout is
+    available in :attr:`stdout` for the next stage. When ``source`` is
+    backed by a file descriptor (a file or the stdout of a previous
+    stage), it is given directly to the process, otherwise it is copied
+    to the stdin of the process by a thread.
+
+    stderr is spooled to an anonymous temporary file, so a process
+    writing a lot of messages never blocks on a full pipe.
+
+    :param command: command to run
+    :param source: file object to use as stdin, or None
+    :param env: environment of the process
+    :param stdout: stdout of the process, a pipe by default
+    :param pass_fds: file descriptors kept open in the process
+    """
+
+    def __init__(self, command, source=None, env=None, stdout=PIPE,
+                 pass_fds=()):
+        self.command = command
+        self._stderr = tempfile.TemporaryFile()
+        self._feeder = None
+        self._feed_error = None
+        stdin = source
+        if source is not None and not has_fileno(source):
+            stdin = PIPE
+        try:
+            self.proc = subprocess.Popen(
+                command, env=env, stdin=stdin, stdout=stdout,
+                stderr=self._stderr, pass_fds=pass_fds,
+            )
+        except BaseException:
+            self._stderr.close()
+            raise
+        if stdin is PIPE:
+            self._feeder = threading.Thread(target=self._feed, args=(source,))
+            self._feeder.daemon = True
+            self._feeder.start()
+
+    def _feed(self, source):
+        try:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                self.proc.stdin.write(chunk)
+        except BrokenPipeError:
+            # the process stopped reading, its exit code tells why
+            pass
+        except Exception as err:
+            self._feed_error = err
+            self.kill()
+        finally:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    @property
+    def stdout(self):
+        return self.proc.stdout
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+
+    def abort(self):
+        """ Kill the process and release its resources
+
+        Used when another stage of the pipeline failed: errors of this
+        process are ignored as they are a consequence of the first one.
+        """
+        self.kill()
+        try:
+            self.wait()
+        except Exception:
+            pass
+
+    def wait(self):
+        """ Wait for the end of the process
+
+        :return: tuple (returncode, stderr)
+        """
+        if self._feeder:
+            self._feeder.join()
+        returncode = self.proc.wait()
+        if self.proc.stdout:
+            self.proc.stdout.close()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode('utf8', 'replace')
+        self._stderr.close()
+        if self._feed_error:
+            raise self._feed_error
+        return returncode, stderr
+
+
+class HashingStream():
+    """ Compute the sha256 of the bytes read from a stream
+
+    A tap on a stage of a pipeline: the checksum is computed while the
+    next stage reads the stream, without reading the data again. As
+    :class:`~dumpbagserver.metrics.MeteredStream`, it has no file
+    descriptor, so it is read by Python by the next stage.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def read_chunks(stream, offset=0, length=None):
+    """ Generator reading a stream by chunks
+
+    :param offset: position of the first byte, bytes before are skipped
+                   when the stream cannot seek
+    :param length: number of bytes to read, until the end by default
+    """
+    if offset:
+        try:
+            stream.seek(offset)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            while offset:
+                chunk = stream.read(min(offset, CHUNK_SIZE))
+                if not chunk:
+                    return
+                offset -= len(chunk)
+    while length is None or length > 0:
+        size = CHUNK_SIZE if length is None else min(length, CHUNK_SIZE)
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
@@ -0,0 +1,143 @@
+# Copyright 2017 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+import subprocess
+
+from subprocess import PIPE
+
+from .stream import PipedProcess
+
+# 'list' reads the table of contents of the dumps, 'restore' restores
+# them in a scratch database
+VALIDATION_MODES = ('list', 'restore')
+
+VALIDATION_PASSED = 'passed'
+VALIDATION_FAILED = 'failed'
+# the dumps of the database commander cannot be validated
+VALIDATION_SKIPPED = 'skipped'
+
+
+class TeeStream():
+    """ Copy the bytes read from a stream to a file object
+
+    A tap on a stage of a pipeline, as
+    :class:`~dumpbagserver.stream.HashingStream`: the copy is written
+    while the next stage reads the stream. The copy stops when the reader
+    of the file object closes it (e.g. ``pg_restore --list`` which only
+    reads the beginning of the dump), the stream is still read entirely.
+    """
+
+    def __init__(self, stream, sink):
+        self._stream = stream
+        self._sink = sink
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if data and self._sink is not None:
+            try:
+                self._sink.write(data)
+            except BrokenPipeError:
+                self._sink = None
+        return data
+
+
+class DumpValidator():
+    """ Validate a dump while the other stages of a pipeline read it
+
+    The commands are piped together, the dump is valid when the last one
+    succeeds: the previous ones may be stopped early when it does not read
+    the whole dump. The dump is fed with :meth:`tee` on the stream pushed
+    to the storage, or read from ``source``.
+
+    :param commands: commands of the validation, None when the dump cannot
+                     be validated
+    :param env: environment of the commands
+    :param source: file object of the dump, given as stdin of the first
+                   command
+    :param error: error preparing the validation, the dump is then flagged
+                  as failed without running the commands
+    """
+
+    def __init__(self, commands, env=None, source=None, error=None):
+        self._processes = []
+        self._sink = None
+        self._error = error
+        self._finished = False
+        if not commands or error is not None:
+            self._finished = True
+            return
+        reader = None
+        if source is None:
+            read_fd, write_fd = os.pipe()
+            source = reader = os.fdopen(read_fd, 'rb')
+            self._sink = os.fdopen(write_fd, 'wb')
+        try:
+            for index, command in enumerate(commands):
+                last = index == len(commands) - 1
+                proc = PipedProcess(
+                    command, source=source, env=env,
+                    stdout=subprocess.DEVNULL if last else PIPE,
+                )
+                self._processes.append(proc)
+                if index:
+                    # the stage has its own copy of the pipe: the previous
+                    # stage gets a broken pipe when it stops reading,
+                    # instead of blocking on a pipe nobody reads
+                    source.close()
+                source = proc.stdout
+        except OSError as err:
+            # a missing command does not stop the dump, which is flagged
+            self._error = 'could not run %s: %s' % (command[0], err)
+            self.abort()
+        finally:
+            if reader is not None:
+                # the first command has its own copy of the read end
+                reader.close()
+
+    def tee(self, stream):
+        """ Return a stream feeding the validation while it is read """
+        if self._sink is None:
+            return stream
+        return TeeStream(stream, self._sink)
+
+    def _close_sink(self):
+        if self._sink is not None:
+            try:
+                self._sink.close()
+            except BrokenPipeError:
+                pass
+            self._sink = None
+
+    def abort(self):
+        """ Stop the validation, when the dump failed """
+        self._close_sink()
+        for proc in self._processes:
+            proc.abort()
+        self._finished = True
+
+    def result(self):
+        """ Wait for the end of the validation
+
+        To call once the whole dump has been read.
+
+        :return: tuple (status, error), the error is None unless the
+                 status is 'failed'
+        """
+        if self._error is not None:
+            return VALIDATION_FAILED, self._error
+        if not self._processes:
+            return VALIDATION_SKIPPED, None
+        self._close_sink()
+        results = [proc.wait() for proc in self._processes]
+        self._finished = True
+        returncode, stderr = results[-1]
+        if returncode:
+            return VALIDATION_FAILED, (
+                stderr.strip() or 'exit code %d' % (returncode,)
+            )
+        return VALIDATION_PASSED, None
+
+    def close(self):
+        if not self._finished:
+            self.abort()
@@ -1,15 +1,27 @@
 # Copyright 2017 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import hashlib
 import re
+import time
 from datetime import datetime
 
 from dumpbagserver import app, app_config
-from flask import flash, jsonify, redirect, render_template, request, url_for
+from flask import (abort, flash, jsonify, redirect, render_template, request,
+                   url_for)
 from werkzeug.routing import UnicodeConverter, ValidationError
 
 from .bagger import Bagger
+from .catalog import dump_timestamp
+from .changes import activity_markers
+from .dedup import DedupStorageCommander
+from .download import dump_response
+from .encryption import EncryptionCommander
+from .exception import DumpNotExistError
 from .forms import SearchForm
+from .jobs import job_queue, job_runner
+from .metrics import exposition, observe_download
+from .scheduler import job_scheduler
 
 
 class DBNameConverter(UnicodeConverter):
@@ -22,36 +34,136 @@ class DBNameConverter(UnicodeConverter):
 app.url_map.converters["dbname"] = DBNameConverter
 
 
-RE_DUMP_DATE = re.compile(r".*(\d{8}-\d{6}).*")
-
-
 @app.route("/databases")
 def databases():
-    databases = Bagger(app_config).list_databases()
-    return render_template("databases.html", databases=databases)
+    databases = Bagger(app_config).database_sizes()
+    return render_template(
+        "databases.html", databases=databases, form=SearchForm(request.args)
+    )
+
+
+@app.route("/api/databases")
+def database_sizes():
+    """ Return the size in bytes of the databases, null when unknown """
+    return jsonify(Bagger(app_config).database_sizes())
+
+
+# dumps per page of /api/dumps
+DUMPS_PAGE_SIZE = 100
+DUMPS_PAGE_MAX_SIZE = 1000
 
 
 @app.route("/")
 def dumps():
-    bagger = Bagger(app_config)
+    # the dumps are loaded by pages from /api/dumps
     search_form = SearchForm(request.args)
-    dumps = bagger.list_dumps()
+    search = ""
     if request.args.get('search', type=str) and search_form.validate():
-        sname = request.args.get('search', type=str)
-        dumps = {
-            name: dumpnames for name, dumpnames in dumps.items()
-            if any(sname.lower() in dumpname.lower() for dumpname in dumpnames)
-        }
+        search = request.args.get('search', type=str)
     return render_template(
         "dumps.html",
-        dumps=dumps,
-        download_commands=bagger.download_commands,
         form=search_form,
+        search=search,
+        page_size=DUMPS_PAGE_SIZE,
     )
 
 
+@app.route("/api/dumps")
+def dumps_page():
+    """ Return a page of the dumps
+
+    The next page is requested with the returned cursor, which is null on
+    the last page. The dumps are filtered by name (``search``), date
+    (``since``, ``until``) and size in bytes (``min_size``, ``max_size``).
+    With the catalog, the dumps have the result of their validation
+    (``validation``: passed, failed or skipped). The download commands of
+    a dump are returned by :func:`dump_commands`.
+    """
+    limit = request.args.get("limit", DUMPS_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), DUMPS_PAGE_MAX_SIZE)
+    bagger = Bagger(app_config)
+    page = bagger.list_page(
+        dbname=request.args.get("db") or None,
+        cursor=request.args.get("cursor") or None,
+        start_after=request.args.get("start_after") or None,
+        limit=limit,
+        search=request.args.get("search") or None,
+        since=_timestamp_arg("since"),
+        until=_timestamp_arg("until"),
+        min_size=request.args.get("min_size", type=int),
+        max_size=request.args.get("max_size", type=int),
+    )
+    dumps = []
+    for dbname, filename in page.dumps:
+        key = "%s/%s" % (dbname, filename)
+        dump = {
+            "dbname": dbname,
+            "filename": filename,
+            "date": date_from_dumpname(filename),
+            "url": url_for("download_dump", db=dbname, filename=filename),
+            "size": page.sizes.get(key),
+        }
+        record = (page.details or {}).get(key)
+        if record:
+            dump.update({
+                "date": _format_timestamp(record["created_at"]),
+                "duration": record["duration"],
+                "checksum": record["checksum"],
+                "recipients": record["recipients"],
+                "validation": record["validation"],
+                "validation_error": record["validation_error"],
+            })
+        dumps.append(dump)
+    return jsonify({"dumps": dumps, "cursor": page.cursor})
+
+
+# formats of the dates of the filters of /api/dumps
+ISO_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S")
+
+
+def _timestamp_arg(name):
+    """ Timestamp of an ISO date ('2017-09-04' or '2017-09-04T14:33:45') """
+    value = request.args.get(name)
+    if not value:
+        return None
+    for date_format in ISO_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).timestamp()
+        except ValueError:
+            continue
+    abort(400, "%s must be an ISO date, got '%s'" % (name, value))
+
+
+@app.route("/api/dumps/<dbname:db>/<string:filename>/commands")
+def dump_commands(db, filename):
+    """ Return the commands to download a dump and its sha256
+
+    Requested by the dumps page when a dump is expanded.
+    """
+    bagger = Bagger(app_config)
+    checksum = bagger.dump_checksum(db, filename)
+    return jsonify({
+        "commands": bagger.download_commands(db, filename, checksum=checksum),
+        "checksum": checksum,
+    })
+
+
+def _enqueue(kind, dbname=None):
+    job_id = job_queue(app_config).enqueue(kind, dbname=dbname)
+    runner = job_runner(app_config)
+    if runner:
+        runner.notify()
+    return job_id
+
+
 @app.route("/dump/<dbname:dbname>")
 def new_dump(dbname):
+    if job_queue(app_config):
+        job_id = _enqueue("dump", dbname=dbname)
+        flash("dump {} has been queued as job {}, follow it on {}".format(
+            dbname, job_id, url_for("job_status", job_id=job_id)
+        ))
+        return redirect(url_for("dumps", _anchor=dbname))
     filename = Bagger(app_config).bag_one_database(dbname)
     flash("dump {} has been pushed with filename {}".format(dbname, filename))
     return redirect(url_for("dumps", _anchor=dbname))
@@ -60,8 +172,70 @@ def new_dump(dbname):
 @app.route("/dumpall")
 def dumpall():
     # route used from curl / scheduler / cron
-    Bagger(app_config).bag_all_databases()
-    return ""
+    if job_queue(app_config):
+        job_id = _enqueue("dumpall")
+        return jsonify({
+            "job": job_id,
+            "url": url_for("job_status", job_id=job_id, _external=True),
+        }), 202
+    report = Bagger(app_config).bag_all_databases(
+        markers=activity_markers(app_config)
+    )
+    return jsonify(report.to_dict()), 200 if report.ok else 500
+
+
+def _dry_run():
+    """ A GET only reports what would be removed, unless dry_run=0
+
+    So a crawler or a prefetched link never removes anything.
+    """
+    default = 0 if request.method == "POST" else 1
+    return bool(request.values.get("dry_run", default, type=int))
+
+
+@app.route("/collect-chunks", methods=["GET", "POST"])
+def collect_chunks():
+    # route used from curl / scheduler / cron, with the dedup storage
+    storage = Bagger(app_config).storage
+    if not isinstance(storage, DedupStorageCommander):
+        abort(404)
+    return jsonify(storage.collect_garbage(dry_run=_dry_run()))
+
+
+@app.route("/retention", methods=["GET", "POST"])
+def retention():
+    # route used from curl / scheduler / cron, with BAG_RETENTION
+    policies = app_config.retention
+    if policies is None:
+        abort(404)
+    return jsonify(
+        Bagger(app_config).apply_retention(policies, dry_run=_dry_run())
+    )
+
+
+@app.route("/api/jobs/<string:job_id>")
+def job_status(job_id):
+    queue = job_queue(app_config)
+    job = queue.get(job_id) if queue else None
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route("/api/schedules")
+def schedules():
+    """ Return the schedules, their next run and their last runs """
+    current = job_scheduler(app_config)
+    return jsonify(current.to_dict() if current else [])
+
+
+@app.route("/api/runs/<string:run_id>")
+def run_status(run_id):
+    queue = job_queue(app_config)
+    run = queue.get_run(run_id) if queue else None
+    if run is None:
+        abort(404)
+    return jsonify(run)
 
 
 @app.route("/has_dump_for_today/<dbname:dbname>")
@@ -75,10 +249,23 @@ def has_dump_for_today(dbname):
 
 @app.route("/download/<dbname:db>/<string:filename>")
 def download_dump(db, filename):
-    dump = Bagger(app_config).read_dump(db, filename)
-    r = app.response_class(dump, mimetype="application/octet-stream")
-    r.headers.set("Content-Disposition", "attachment", filename=filename)
-    return r
+    start = time.time()
+    verify = request.args.get("verify", 0, type=int)
+    try:
+        response = dump_response(
+            Bagger(app_config), db, filename, verify=bool(verify)
+        )
+    except DumpNotExistError:
+        abort(404)
+    return observe_download(response, start)
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    if not app_config.metrics:
+        abort(404)
+    body, content_type = exposition()
+    return app.response_class(body, content_type=content_type)
 
 
 @app.route("/api/nightly")
@@ -87,8 +274,9 @@ def get_nightlies():
         for each dump of the current day
     """
     today = datetime.today().strftime("%Y%m%d")
-    storage = Bagger(app_config).storage
-    db_list = storage.list_by_db()
+    bagger = Bagger(app_config)
+    storage = bagger.storage
+    db_list = bagger.list_dumps()
     return jsonify(
         [
             storage.download_commands(k, v[-1])[1]["s3_url"]
@@ -109,27 +297,44 @@ def dumps_for(db):
 def help():
     gpg = app_config.encryption_kind == "gpg"
     gpg_recipients = app_config.encryption_options().recipients if gpg else ""
-    has_s3 = app_config.storage_kind == "s3"
+    # both S3 storages share the bucket layout of the dumps
+    has_s3 = app_config.storage_kind in ("s3", "s3-client")
     return render_template(
-        "help.html", has_s3=has_s3, has_gpg=gpg, gpg_recipients=gpg_recipients
+        "help.html", has_s3=has_s3, has_gpg=gpg, gpg_recipients=gpg_recipients,
+        form=SearchForm(request.args),
     )
 
 
+def _encrypter():
+    return EncryptionCommander.new_commander(app_config.encryption_options())
+
+
+def _static_response(body):
+    """ Text response with an ETag, 304 when the client already has it """
+    response = app.response_class(body, mimetype="text/plain")
+    response.set_etag(hashlib.sha256(body.encode("utf8")).hexdigest())
+    return response.make_conditional(request)
+
+
 @app.route("/keys")
 def public_keys():
-    return "\n".join(Bagger(app_config).public_keys())
+    # the export of the keys is cached until the keyrings change
+    return _static_response("\n".join(_encrypter().public_keys()))
 
 
 @app.route("/recipients")
 def recipients():
-    return ",".join(Bagger(app_config).recipients())
+    return _static_response(",".join(_encrypter().recipients()))
+
+
+def _format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
 
 @app.template_filter("date_from_dumpname")
 def date_from_dumpname(s):
     # extract 20170904-143345 from 'prod_template-20170904-143345.pg'
-    match = RE_DUMP_DATE.match(s)
-    if match is None:
+    timestamp = dump_timestamp(s)
+    if timestamp is None:
         return ""
-    converted = datetime.strptime(match.groups()[0], "%Y%m%d-%H%M%S")
-    return converted.strftime("%Y-%m-%d %H:%M:%S")
+    return _format_timestamp(timestamp)
@@ -4,7 +4,10 @@ setup(
     name="dumpbagserver",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["flask", "awscli", "Flask-WTF"],
+    install_requires=[
+        "flask", "awscli", "boto3", "Flask-WTF", "prometheus_client",
+        "psycopg2-binary",
+    ],
     setup_requires=["pytest-runner"],
-    tests_requires=["pytest", "mock"],
+    tests_requires=["pytest", "mock", "moto"],
 )
@@ -1,3 +1,7 @@
+import hashlib
+import io
+
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import mock
@@ -5,6 +9,10 @@ import pytest
 
 import dumpbagserver
 
+from dumpbagserver import (
+    changes, database, encryption, exception, storage,
+)
+
 
 @pytest.fixture
 def bagger():
@@ -14,6 +22,10 @@ def bagger():
     encryption = mock.Mock(name='encryption')
 
     config.exclude_databases = []
+    config.streaming = False
+    config.listing_cache_ttl = 0
+    config.catalog = False
+    config.dump_validation = None
     config.database_options.return_value = db
     config.storage_options.return_value = storage
     config.encryption_options.return_value = encryption
@@ -21,6 +33,25 @@ def bagger():
     return dumpbagserver.bagger.Bagger(config)
 
 
+@pytest.fixture
+def local_bagger(tmpdir):
+    config = mock.Mock(name='config')
+    config.only_databases = []
+    config.exclude_databases = []
+    config.streaming = True
+    config.listing_cache_ttl = 60
+    config.catalog = False
+    config.dump_validation = None
+    config.database_options.return_value = database.StaticOptions()
+    config.storage_options.return_value = storage.LocalOptions(
+        tmpdir.strpath
+    )
+    config.encryption_options.return_value = (
+        encryption.NoOpEncryptionOptions()
+    )
+    return dumpbagserver.bagger.Bagger(config)
+
+
 def test_has_dump_for_today(bagger):
     yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y%m%d-%H%M%S')
     today = datetime.now().strftime('%Y%m%d-%H%M%S')
@@ -36,3 +67,213 @@ def test_has_dump_for_today(bagger):
         'db2': ['db2-%s.pg.gpg' % yesterday]
     }
     assert bagger.has_dump_for_today('db1')
+
+
+def test_bag_one_database_streaming(tmpdir, local_bagger):
+    filename = local_bagger.bag_one_database('db1')
+    target = tmpdir.join('db1', filename).strpath
+    assert open(target, 'rb').read() == b'test db1'
+    assert local_bagger.list_dumps() == {'db1': {filename}}
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_bag_one_database_checksum(tmpdir, local_bagger, streaming):
+    local_bagger.config.streaming = streaming
+    filename = local_bagger.bag_one_database('db1')
+    checksum = hashlib.sha256(b'test db1').hexdigest()
+    # in the format of sha256sum, next to the dump
+    assert tmpdir.join('db1', filename + '.sha256').read() == (
+        '%s  %s\n' % (checksum, filename)
+    )
+    assert local_bagger.dump_checksum('db1', filename) == checksum
+    assert local_bagger.list_dumps() == {'db1': {filename}}
+    local_bagger.storage.delete_dump('db1', filename)
+    assert tmpdir.join('db1').listdir() == []
+
+
+def test_bag_one_database_streaming_failure(tmpdir, local_bagger):
+    @contextmanager
+    def failing_dump(dbname):
+        yield io.BytesIO(b'truncated')
+        raise exception.DumpingError('connection lost')
+
+    commander = local_bagger.db.commander
+    with mock.patch.object(commander, 'exec_dump_stream', failing_dump):
+        with pytest.raises(exception.DumpingError):
+            local_bagger.bag_one_database('db1')
+    # the incomplete dump has been removed from the storage
+    assert local_bagger.list_dumps() == {}
+
+
+def validation_pipeline(*commands):
+    @contextmanager
+    def pipeline(dbname, mode):
+        yield list(commands), None
+    return pipeline
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+@pytest.mark.parametrize('command, expected', [
+    (['grep', '-q', 'test db1'], ('passed', None)),
+    (['sh', '-c', 'cat > /dev/null; echo invalid >&2; exit 1'],
+     ('failed', 'invalid')),
+])
+def test_bag_one_database_validation(local_bagger, streaming, command,
+                                     expected):
+    local_bagger.config.streaming = streaming
+    local_bagger.config.dump_validation = 'list'
+    commander = local_bagger.db.commander
+    with mock.patch.object(commander, 'validation_pipeline',
+                           validation_pipeline(command)), \
+            mock.patch.object(local_bagger, '_record_dump') as record:
+        local_bagger.catalog = mock.Mock(name='catalog')
+        filename = local_bagger.bag_one_database('db1')
+    # a failed validation does not remove the dump
+    assert local_bagger.storage.list_by_db() == {'db1': {filename}}
+    assert record.call_args[0][-1] == expected
+
+
+def test_bag_one_database_validation_not_prepared(local_bagger):
+    local_bagger.config.dump_validation = 'restore'
+
+    @contextmanager
+    def no_scratch_database(dbname, mode):
+        raise exception.DumpingError('permission denied')
+        yield
+
+    commander = local_bagger.db.commander
+    with mock.patch.object(commander, 'validation_pipeline',
+                           no_scratch_database), \
+            mock.patch.object(local_bagger, '_record_dump') as record:
+        local_bagger.catalog = mock.Mock(name='catalog')
+        filename = local_bagger.bag_one_database('db1')
+    assert local_bagger.storage.list_by_db() == {'db1': {filename}}
+    assert record.call_args[0][-1] == ('failed', 'permission denied')
+
+
+def test_bag_one_database_validation_skipped(local_bagger):
+    # the static dumps cannot be validated
+    local_bagger.config.dump_validation = 'list'
+    with mock.patch.object(local_bagger, '_record_dump') as record:
+        local_bagger.catalog = mock.Mock(name='catalog')
+        local_bagger.bag_one_database('db1')
+    assert record.call_args[0][-1] == ('skipped', None)
+
+
+def test_bag_all_databases(tmpdir, local_bagger):
+    local_bagger.db.exclude = ['postgres', 'template0', 'template1']
+    report = local_bagger.bag_all_databases(concurrency=2)
+    assert report.ok
+    assert sorted(report.succeeded) == ['db1', 'db2', 'db3']
+    assert sorted(local_bagger.list_dumps()) == ['db1', 'db2', 'db3']
+
+
+def test_bag_all_databases_failure(local_bagger):
+    local_bagger.db.exclude = ['postgres', 'template0', 'template1']
+    bag_one_database = local_bagger.bag_one_database
+
+    def bag_or_fail(dbname):
+        if dbname == 'db2':
+            raise exception.DumpingError('could not dump')
+        return bag_one_database(dbname)
+
+    local_bagger.bag_one_database = bag_or_fail
+    report = local_bagger.bag_all_databases(concurrency=2)
+    # the failure did not stop the other dumps
+    assert not report.ok
+    assert sorted(report.succeeded) == ['db1', 'db3']
+    assert report.failed == {'db2': 'DumpingError: could not dump'}
+    assert sorted(report.durations) == ['db1', 'db2', 'db3']
+
+
+@pytest.mark.parametrize('sizes, durations, expected', [
+    # largest first
+    ({'db1': 10, 'db2': 30, 'db3': 20}, None, ['db2', 'db3', 'db1']),
+    # the duration of the previous dump wins over the size, the others
+    # are estimated from the rate of the known ones (db2: 120s)
+    ({'db1': 10, 'db2': 30, 'db3': 20}, {'db1': 100, 'db3': 20},
+     ['db2', 'db1', 'db3']),
+    # unknown sizes
+    ({'db1': None, 'db2': None, 'db3': None}, {'db2': 5, 'db3': 10},
+     ['db3', 'db2', 'db1']),
+    # durations of databases without size cannot be compared to sizes
+    ({'db1': None, 'db2': 30, 'db3': 20}, {'db1': 100},
+     ['db2', 'db3', 'db1']),
+])
+def test_dump_order(local_bagger, sizes, durations, expected):
+    with mock.patch.object(local_bagger.db, 'database_sizes',
+                           return_value=sizes):
+        assert local_bagger.dump_order(durations=durations) == expected
+
+
+def test_bag_all_databases_largest_first(local_bagger):
+    sizes = {'db1': 10, 'db2': 30, 'db3': 20}
+    local_bagger.db.commander.database_sizes = lambda: sizes
+    bagged = []
+    local_bagger.bag_one_database = bagged.append
+    local_bagger.bag_all_databases(concurrency=1)
+    assert bagged == ['db2', 'db3', 'db1']
+
+
+def test_bag_if_changed(tmpdir, local_bagger):
+    markers = changes.ActivityMarkers(tmpdir.join('state.db').strpath)
+    commander = local_bagger.db.commander
+    with mock.patch.object(commander, 'activity_markers',
+                           return_value={'db1': '1:0:0:'}):
+        filename, skipped = local_bagger.bag_if_changed('db1', markers)
+        assert not skipped
+        assert markers.get('db1')['filename'] == filename
+        # no write since the dump
+        assert local_bagger.bag_if_changed('db1', markers) == (
+            filename, True
+        )
+        assert markers.get('db1')['skips'] == 1
+        # the last dump has been removed from the storage
+        local_bagger.storage.delete_dump('db1', filename)
+        local_bagger.listing.invalidate('db1')
+        assert not local_bagger.bag_if_changed('db1', markers)[1]
+    with mock.patch.object(commander, 'activity_markers',
+                           return_value={'db1': '2:0:0:'}):
+        assert not local_bagger.bag_if_changed('db1', markers)[1]
+    # without marker, always dumped
+    assert not local_bagger.bag_if_changed('db1', markers)[1]
+
+
+def test_bag_all_databases_skip_unchanged(tmpdir, local_bagger):
+    local_bagger.db.exclude = ['postgres', 'template0', 'template1']
+    markers = changes.ActivityMarkers(tmpdir.join('state.db').strpath)
+    activity = {'db1': '1:0:0:', 'db2': '1:0:0:'}
+    commander = local_bagger.db.commander
+    with mock.patch.object(commander, 'activity_markers',
+                           return_value=activity):
+        report = local_bagger.bag_all_databases(concurrency=2,
+                                                markers=markers)
+        assert sorted(report.succeeded) == ['db1', 'db2', 'db3']
+        activity['db2'] = '1:1:0:'
+        report = local_bagger.bag_all_databases(concurrency=2,
+                                                markers=markers)
+    assert report.ok
+    assert sorted(report.succeeded) == ['db2', 'db3']
+    assert list(report.skipped) == ['db1']
+    assert report.to_dict()['skipped'] == report.skipped
+
+
+def test_download_commands_key(local_bagger):
+    key = local_bagger._commanders_key()
+    options = storage.S3ClientOptions(
+        'bucket', 'access', 'secret', endpoint_url='http://minio:9000',
+    )
+    local_bagger.storage = storage.StorageCommander.new_commander(options)
+    s3_key = local_bagger._commanders_key()
+    assert s3_key != key
+    assert s3_key[1:3] == ('s3://bucket', 'http://minio:9000')
+    # the credentials are not kept in the memo
+    assert 'access' not in repr(s3_key)
+    assert 'secret' not in repr(s3_key)
+
+
+def test_listing_cache_invalidated_on_push(local_bagger):
+    assert local_bagger.list_dumps() == {}
+    filename = local_bagger.bag_one_database('db1')
+    assert local_bagger.list_dumps() == {'db1': {filename}}
+    assert local_bagger.has_dump_for_today('db1')
@@ -0,0 +1,99 @@
+import time
+
+import mock
+import pytest
+
+from dumpbagserver import cache
+
+
+@pytest.fixture
+def storage():
+    storage = mock.Mock(name='storage')
+
+    def list_by_db(dbname=None):
+        listing = {
+            'db1': ['db1-20170904-092333.pg'],
+            'db2': ['db2-20170904-110917.pg'],
+        }
+        if dbname:
+            return {dbname: listing[dbname]}
+        return listing
+
+    storage.list_by_db.side_effect = list_by_db
+    return storage
+
+
+@pytest.fixture
+def listing(storage):
+    return cache.ListingCache(storage.list_by_db, 60)
+
+
+def test_cached(storage, listing):
+    assert listing.list_by_db() == listing.list_by_db()
+    assert storage.list_by_db.call_count == 1
+
+
+def test_db_served_from_full_listing(storage, listing):
+    listing.list_by_db()
+    assert listing.list_by_db(dbname='db1') == {
+        'db1': ['db1-20170904-092333.pg'],
+    }
+    assert storage.list_by_db.call_count == 1
+
+
+def test_db_entry(storage, listing):
+    listing.list_by_db(dbname='db2')
+    listing.list_by_db(dbname='db2')
+    assert storage.list_by_db.call_count == 1
+    # the full listing is not known yet
+    listing.list_by_db()
+    assert storage.list_by_db.call_count == 2
+
+
+def test_expired(storage, listing):
+    listing.list_by_db()
+    with mock.patch('time.time', return_value=time.time() + 61):
+        listing.list_by_db()
+    assert storage.list_by_db.call_count == 2
+
+
+def test_invalidate(storage, listing):
+    listing.list_by_db()
+    listing.list_by_db(dbname='db1')
+    listing.list_by_db(dbname='db2')
+    listing.invalidate('db1')
+    listing.list_by_db(dbname='db2')
+    assert storage.list_by_db.call_count == 2
+    listing.list_by_db(dbname='db1')
+    assert storage.list_by_db.call_count == 3
+    listing.list_by_db()
+    assert storage.list_by_db.call_count == 4
+
+
+def test_invalidate_during_listing(storage, listing):
+    def list_by_db(dbname=None):
+        # a dump is pushed while the storage is listed
+        listing.invalidate('db1')
+        return {'db1': []}
+
+    storage.list_by_db.side_effect = list_by_db
+    assert listing.list_by_db(dbname='db1') == {'db1': []}
+    # the listing fetched before the push is not kept
+    storage.list_by_db.side_effect = None
+    storage.list_by_db.return_value = {'db1': ['db1-20170904-092333.pg']}
+    assert listing.list_by_db(dbname='db1') == {
+        'db1': ['db1-20170904-092333.pg'],
+    }
+    assert storage.list_by_db.call_count == 2
+    listing.list_by_db(dbname='db1')
+    assert storage.list_by_db.call_count == 2
+
+
+def test_copy(listing):
+    listing.list_by_db()['db1'].append('foo')
+    assert listing.list_by_db()['db1'] == ['db1-20170904-092333.pg']
+
+
+def test_shared_by_storage(storage):
+    storage.location.return_value = 's3://foo'
+    assert cache.listing_cache(storage, 60) is cache.listing_cache(storage, 60)
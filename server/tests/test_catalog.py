@@ -0,0 +1,232 @@
+import sqlite3
+import time
+from datetime import datetime
+
+import mock
+import pytest
+
+import dumpbagserver.bagger
+from dumpbagserver import catalog, database, encryption, storage
+
+
+def timestamp(date):
+    return datetime.strptime(date, '%Y%m%d-%H%M%S').timestamp()
+
+
+@pytest.fixture
+def local_storage(tmpdir):
+    storage_dir = tmpdir.join('storage')
+    for dbname in ('db1', 'db2'):
+        storage_dir.join(dbname).ensure(dir=True)
+        for size, date in enumerate(('20170904-092333', '20170905-092333')):
+            storage_dir.join(dbname, '%s-%s.pg' % (dbname, date)).write(
+                'x' * (size + 1)
+            )
+    return storage.StorageCommander.new_commander(
+        storage.LocalOptions(storage_dir.strpath)
+    )
+
+
+@pytest.fixture
+def dump_catalog(tmpdir, local_storage):
+    return catalog.DumpCatalog(
+        tmpdir.join('state.db').strpath, local_storage.location()
+    )
+
+
+def test_dump_timestamp():
+    assert catalog.dump_timestamp('db1-20170904-092333.pg.gpg') == (
+        timestamp('20170904-092333')
+    )
+    assert catalog.dump_timestamp('db1.pg') is None
+    assert catalog.dump_timestamp('db1-20171304-092333.pg') is None
+
+
+def test_record(dump_catalog):
+    assert dump_catalog.get('db1', 'db1-20170904-092333.pg') is None
+    dump_catalog.record('db1', 'db1-20170904-092333.pg', size=10,
+                        duration=2.5, recipients=['alice', 'bob'],
+                        validation='failed', validation_error='truncated')
+    assert dump_catalog.get('db1', 'db1-20170904-092333.pg') == {
+        'dbname': 'db1',
+        'filename': 'db1-20170904-092333.pg',
+        'created_at': timestamp('20170904-092333'),
+        'size': 10,
+        'duration': 2.5,
+        'checksum': None,
+        'recipients': ['alice', 'bob'],
+        'validation': 'failed',
+        'validation_error': 'truncated',
+    }
+    assert dump_catalog.list_by_db() == {'db1': ['db1-20170904-092333.pg']}
+    dump_catalog.forget('db1', 'db1-20170904-092333.pg')
+    assert dump_catalog.list_by_db() == {}
+
+
+def test_validation_columns_added(tmpdir):
+    path = tmpdir.join('state.db').strpath
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE dumps (storage TEXT NOT NULL, dbname TEXT NOT NULL,'
+        ' filename TEXT NOT NULL, created_at REAL NOT NULL, size INTEGER,'
+        ' duration REAL, checksum TEXT, recipients TEXT,'
+        ' recorded_at REAL NOT NULL, PRIMARY KEY (storage, dbname, filename))'
+    )
+    conn.close()
+    dump_catalog = catalog.DumpCatalog(path, 'file:///storage')
+    dump_catalog.record('db1', 'db1-20170904-092333.pg', validation='passed')
+    assert dump_catalog.get('db1', 'db1-20170904-092333.pg')[
+        'validation'] == 'passed'
+
+
+def test_reconcile(dump_catalog, local_storage):
+    assert not dump_catalog.ready
+    dump_catalog.record('db1', 'db1-20170905-092333.pg', size=2,
+                        duration=3, recipients=['alice'])
+    dump_catalog.record('db3', 'db3-20170905-092333.pg')
+    with mock.patch('time.time', return_value=timestamp('20170906-000000')):
+        dump_catalog.record('db3', 'db3-20170906-000000.pg')
+    with mock.patch.object(catalog, 'RECONCILE_PAGE_SIZE', 3):
+        assert dump_catalog.reconcile(local_storage) == {
+            'added': 3, 'removed': 2,
+        }
+    assert dump_catalog.ready
+    assert dump_catalog.list_by_db() == {
+        'db1': ['db1-20170904-092333.pg', 'db1-20170905-092333.pg'],
+        'db2': ['db2-20170904-092333.pg', 'db2-20170905-092333.pg'],
+    }
+    # the details of the dumps recorded by the server are kept
+    assert dump_catalog.get('db1', 'db1-20170905-092333.pg')[
+        'recipients'] == ['alice']
+    assert dump_catalog.get('db2', 'db2-20170905-092333.pg')['size'] == 2
+    assert dump_catalog.reconcile(local_storage) == {
+        'added': 0, 'removed': 0,
+    }
+
+
+def test_reconcile_keeps_dumps_recorded_during_listing(dump_catalog,
+                                                       local_storage):
+    list_page = local_storage.list_page
+
+    def listing(**kwargs):
+        page = list_page(**kwargs)
+        # pushed once the storage is listed
+        dump_catalog.record('db3', 'db3-20170906-000000.pg')
+        # recorded by another process while the storage is listed
+        dump_catalog.record('db1', 'db1-20170904-092333.pg', size=1)
+        return page
+
+    with mock.patch.object(local_storage, 'list_page', side_effect=listing):
+        assert dump_catalog.reconcile(local_storage) == {
+            'added': 3, 'removed': 0,
+        }
+    assert dump_catalog.get('db3', 'db3-20170906-000000.pg')
+    assert len(dump_catalog.list_by_db()['db1']) == 2
+
+
+def test_reconcile_skipped_when_recent(dump_catalog, local_storage):
+    other = catalog.DumpCatalog(dump_catalog.path, dump_catalog.location)
+    other.reconcile(local_storage)
+    # reconciled by another process less than 10 minutes ago
+    with mock.patch.object(local_storage, 'list_page') as listing:
+        assert dump_catalog.reconcile(local_storage, min_interval=600) is None
+    assert not listing.called
+    assert dump_catalog.ready
+    with mock.patch('time.time', return_value=time.time() + 601):
+        assert dump_catalog.reconcile(local_storage, min_interval=600) == {
+            'added': 0, 'removed': 0,
+        }
+
+
+@pytest.mark.parametrize('filters, expected', [
+    ({}, ['db1/db1-20170904-092333.pg', 'db1/db1-20170905-092333.pg',
+          'db2/db2-20170904-092333.pg', 'db2/db2-20170905-092333.pg']),
+    ({'dbname': 'db2'},
+     ['db2/db2-20170904-092333.pg', 'db2/db2-20170905-092333.pg']),
+    ({'after': 'db1/db1-20170905-092333.pg'},
+     ['db2/db2-20170904-092333.pg', 'db2/db2-20170905-092333.pg']),
+    ({'search': '0905'},
+     ['db1/db1-20170905-092333.pg', 'db2/db2-20170905-092333.pg']),
+    ({'search': '_'}, []),
+    ({'since': timestamp('20170905-000000')},
+     ['db1/db1-20170905-092333.pg', 'db2/db2-20170905-092333.pg']),
+    ({'until': timestamp('20170905-000000'), 'dbname': 'db1'},
+     ['db1/db1-20170904-092333.pg']),
+    ({'min_size': 2},
+     ['db1/db1-20170905-092333.pg', 'db2/db2-20170905-092333.pg']),
+    ({'max_size': 1, 'search': 'db2'}, ['db2/db2-20170904-092333.pg']),
+])
+def test_search(dump_catalog, local_storage, filters, expected):
+    dump_catalog.reconcile(local_storage)
+    page = dump_catalog.search(**filters)
+    assert ['%s/%s' % dump for dump in page.dumps] == expected
+    assert page.cursor is None
+    assert sorted(page.details) == sorted(page.sizes) == expected
+
+
+def test_search_pages(dump_catalog, local_storage):
+    dump_catalog.reconcile(local_storage)
+    page = dump_catalog.search(limit=3)
+    assert len(page.dumps) == 3
+    assert page.cursor == 'db2/db2-20170904-092333.pg'
+    page = dump_catalog.search(after=page.cursor, limit=3)
+    assert page.dumps == [('db2', 'db2-20170905-092333.pg')]
+    assert page.cursor is None
+
+
+@pytest.fixture
+def catalog_bagger(tmpdir, local_storage):
+    config = mock.Mock(name='config')
+    config.only_databases = []
+    config.exclude_databases = []
+    config.streaming = True
+    config.listing_cache_ttl = 0
+    config.catalog = True
+    config.dump_validation = None
+    config.state_db = tmpdir.join('state.db').strpath
+    config.catalog_reconcile_interval = 0
+    config.database_options.return_value = database.StaticOptions()
+    config.storage_options.return_value = local_storage.options
+    config.encryption_options.return_value = (
+        encryption.NoOpEncryptionOptions()
+    )
+    return dumpbagserver.bagger.Bagger(config)
+
+
+def test_bagger_records_dumps(catalog_bagger):
+    filename = catalog_bagger.bag_one_database('db1')
+    record = catalog_bagger.catalog.get('db1', filename)
+    assert record['size'] == len(b'test db1')
+    assert record['duration'] >= 0
+    # the storage is listed until the catalog is reconciled
+    assert filename in catalog_bagger.list_dumps()['db1']
+    catalog_bagger.catalog.reconcile(catalog_bagger.storage)
+    with mock.patch.object(catalog_bagger.storage, 'list_by_db') as listing:
+        dumps = catalog_bagger.list_dumps(dbname='db1')
+        page = catalog_bagger.list_page(min_size=2)
+    assert not listing.called
+    assert dumps['db1'][-1] == filename
+    assert page.dumps == [
+        ('db1', 'db1-20170905-092333.pg'), ('db1', filename),
+        ('db2', 'db2-20170905-092333.pg'),
+    ]
+
+
+def test_bagger_records_validation(catalog_bagger):
+    catalog_bagger.config.dump_validation = 'list'
+    filename = catalog_bagger.bag_one_database('db1')
+    record = catalog_bagger.catalog.get('db1', filename)
+    assert record['validation'] == 'skipped'
+    assert record['validation_error'] is None
+
+
+def test_bagger_filters_storage_pages(catalog_bagger):
+    catalog_bagger.catalog = None
+    page = catalog_bagger.list_page(
+        search='DB2', since=timestamp('20170905-000000'),
+    )
+    assert page.dumps == [('db2', 'db2-20170905-092333.pg')]
+    page = catalog_bagger.list_page(max_size=1)
+    assert page.dumps == [
+        ('db1', 'db1-20170904-092333.pg'), ('db2', 'db2-20170904-092333.pg'),
+    ]
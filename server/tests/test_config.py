@@ -2,7 +2,9 @@ from os import environ as env
 
 import pytest
 
-from dumpbagserver import config, exception, database, storage, encryption
+from dumpbagserver import (
+    config, dedup, exception, database, storage, encryption,
+)
 
 
 def test_database_options_static():
@@ -31,6 +33,69 @@ def test_database_options_postgres():
     assert options.port == '5432'
     assert options.user == 'postgres'
     assert options.password == 'postgres'
+    assert options.compression == 'zlib'
+    assert options.compression_level is None
+
+    env['BAG_DUMP_COMPRESSION'] = 'zstd'
+    env['BAG_DUMP_COMPRESSION_LEVEL'] = '19'
+    env['BAG_DUMP_COMPRESSION_THREADS'] = '0'
+    try:
+        options = conf.database_options()
+        assert options.compression == 'zstd'
+        assert options.compression_level == 19
+        assert options.compression_threads == 0
+        env['BAG_DUMP_COMPRESSION'] = 'bzip2'
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.database_options()
+    finally:
+        env.pop('BAG_DUMP_COMPRESSION')
+        env.pop('BAG_DUMP_COMPRESSION_LEVEL')
+        env.pop('BAG_DUMP_COMPRESSION_THREADS')
+
+
+def test_database_options_standbys():
+    env['BAG_DB_KIND'] = 'postgres'
+    env['BAG_DB_HOST'] = 'postgres'
+    env['BAG_DB_USER'] = 'postgres'
+    conf = config.DumpBagConfig()
+    assert conf.database_options().standbys == []
+    env['BAG_DB_STANDBY_HOSTS'] = 'standby1, standby2:5433'
+    try:
+        assert conf.database_options().standbys == [
+            ('standby1', '5432'), ('standby2', '5433'),
+        ]
+        env['BAG_DB_STANDBY_HOSTS'] = 'standby1:foo'
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.database_options()
+    finally:
+        env.pop('BAG_DB_STANDBY_HOSTS')
+
+
+def test_database_options_validation_server():
+    env['BAG_DB_KIND'] = 'postgres'
+    env['BAG_DB_HOST'] = 'postgres'
+    env['BAG_DB_USER'] = 'postgres'
+    conf = config.DumpBagConfig()
+    assert conf.database_options().validation_server is None
+    env['BAG_DUMP_VALIDATION'] = 'restore'
+    try:
+        # the scratch databases are never created on the primary
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.database_options()
+        env['BAG_DUMP_VALIDATION_HOST'] = 'scratch'
+        assert conf.database_options().validation_server == (
+            'scratch', '5432'
+        )
+        env['BAG_DUMP_VALIDATION_HOST'] = 'scratch:5433'
+        assert conf.database_options().validation_server == (
+            'scratch', '5433'
+        )
+        env['BAG_DUMP_VALIDATION_HOST'] = 'scratch:foo'
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.database_options()
+    finally:
+        env.pop('BAG_DUMP_VALIDATION')
+        env.pop('BAG_DUMP_VALIDATION_HOST', None)
 
 
 def test_database_options_wrong_kind():
@@ -74,6 +139,51 @@ def test_storage_options_s3():
     assert options.secret_access_key == 'baz'
 
 
+def test_storage_options_s3_client():
+    env['BAG_STORAGE_KIND'] = 's3-client'
+    conf = config.DumpBagConfig()
+    env['BAG_S3_BUCKET_NAME'] = 'foo'
+    env['BAG_S3_ACCESS_KEY'] = 'bar'
+    env['BAG_S3_SECRET_ACCESS_KEY'] = 'baz'
+    env['BAG_S3_ENDPOINT_URL'] = 'http://localhost:9000'
+    env['BAG_S3_PART_SIZE_MB'] = '16'
+    options = conf.storage_options()
+    assert type(options) is storage.S3ClientOptions
+    assert options.bucket == 'foo'
+    assert options.endpoint_url == 'http://localhost:9000'
+    assert options.part_size == 16 * 1024 ** 2
+    assert options.max_concurrency == 8
+    env['BAG_S3_PART_SIZE_MB'] = '1'
+    with pytest.raises(exception.DumpConfigurationError):
+        conf.storage_options()
+    env.pop('BAG_S3_ENDPOINT_URL')
+    env.pop('BAG_S3_PART_SIZE_MB')
+
+
+def test_storage_options_dedup(tmpdir):
+    env['BAG_STORAGE_KIND'] = 'dedup'
+    env['BAG_STORAGE_LOCAL_DIR'] = tmpdir.strpath
+    env['BAG_ENCRYPTION_KIND'] = 'none'
+    conf = config.DumpBagConfig()
+    with pytest.raises(exception.DumpConfigurationError):
+        conf.storage_options()
+    env['BAG_DEDUP_PASSPHRASE_FILE'] = '/etc/dumpbag/passphrase'
+    env['BAG_DEDUP_CHUNK_SIZE_KB'] = '512'
+    try:
+        options = conf.storage_options()
+        assert type(options) is dedup.DedupOptions
+        assert type(options.store_options) is storage.LocalOptions
+        assert options.passphrase_file == '/etc/dumpbag/passphrase'
+        assert options.chunk_size == 512 * 1024
+        env['BAG_DEDUP_BACKEND'] = 's3'
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.storage_options()
+    finally:
+        env.pop('BAG_DEDUP_BACKEND', None)
+        env.pop('BAG_DEDUP_PASSPHRASE_FILE')
+        env.pop('BAG_DEDUP_CHUNK_SIZE_KB')
+
+
 def test_storage_options_wrong_kind():
     env['BAG_STORAGE_KIND'] = 'foo'
     conf = config.DumpBagConfig()
@@ -106,3 +216,82 @@ def test_encryption_options_wrong_kind():
     conf = config.DumpBagConfig()
     with pytest.raises(exception.DumpConfigurationError):
         conf.encryption_options()
+
+
+def test_dump_concurrency():
+    conf = config.DumpBagConfig()
+    env.pop('BAG_DUMP_CONCURRENCY', None)
+    assert conf.dump_concurrency == 1
+    env['BAG_DUMP_CONCURRENCY'] = '4'
+    assert conf.dump_concurrency == 4
+    for value in ('0', 'foo'):
+        env['BAG_DUMP_CONCURRENCY'] = value
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.dump_concurrency
+    env.pop('BAG_DUMP_CONCURRENCY')
+
+
+def test_schedules():
+    conf = config.DumpBagConfig()
+    env.pop('BAG_SCHEDULES', None)
+    assert conf.schedules == []
+    env['BAG_SCHEDULES'] = 'nightly: 0 3 * * * | prod_*, erp | 120'
+    schedule, = conf.schedules
+    assert schedule.name == 'nightly'
+    assert schedule.databases == ('prod_*', 'erp')
+    assert schedule.window == 7200
+    env['BAG_SCHEDULES'] = 'nightly: 0 3 * *'
+    with pytest.raises(exception.DumpConfigurationError):
+        conf.schedules
+    env.pop('BAG_SCHEDULES')
+
+
+def test_skip_unchanged():
+    conf = config.DumpBagConfig()
+    env.pop('BAG_SKIP_UNCHANGED', None)
+    assert not conf.skip_unchanged
+    env['BAG_SKIP_UNCHANGED'] = 'true'
+    assert conf.skip_unchanged
+    env.pop('BAG_SKIP_UNCHANGED')
+
+
+def test_metrics():
+    conf = config.DumpBagConfig()
+    env.pop('BAG_METRICS', None)
+    env.pop('BAG_METRICS_BYTES', None)
+    # the endpoint does not count the bytes of the streamed stages
+    assert conf.metrics
+    assert not conf.metrics_bytes
+    env['BAG_METRICS_BYTES'] = 'true'
+    assert conf.metrics_bytes
+    env.pop('BAG_METRICS_BYTES')
+
+
+def test_catalog():
+    conf = config.DumpBagConfig()
+    env.pop('BAG_STATE_DB', None)
+    assert not conf.catalog
+    env['BAG_STATE_DB'] = '/tmp/state.db'
+    try:
+        assert conf.catalog
+        env['BAG_CATALOG'] = 'false'
+        assert not conf.catalog
+    finally:
+        env.pop('BAG_STATE_DB')
+        env.pop('BAG_CATALOG', None)
+    assert conf.catalog_reconcile_interval == 600
+
+
+def test_dump_validation():
+    conf = config.DumpBagConfig()
+    assert conf.dump_validation is None
+    try:
+        env['BAG_DUMP_VALIDATION'] = 'Restore'
+        assert conf.dump_validation == 'restore'
+        env['BAG_DUMP_VALIDATION'] = 'none'
+        assert conf.dump_validation is None
+        env['BAG_DUMP_VALIDATION'] = 'vacuum'
+        with pytest.raises(exception.DumpConfigurationError):
+            conf.dump_validation
+    finally:
+        env.pop('BAG_DUMP_VALIDATION')
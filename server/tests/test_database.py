@@ -1,3 +1,9 @@
+import io
+import string
+import subprocess
+import tarfile
+import time
+
 import mock
 import pytest
 import os
@@ -13,7 +19,9 @@ def static_options():
 
 @pytest.fixture
 def postgres_options():
-    options = database.PostgresOptions('foo', 'bar', 'baz')
+    options = database.PostgresOptions(
+        'foo', 'bar', 'baz', metadata_connection=False, list_cache_ttl=0,
+    )
     return options
 
 
@@ -90,6 +98,18 @@ def test_dump(tmpdir, db_with_exclude):
     assert open(target, 'r').read() == 'test db1'
 
 
+def test_dump_stream(db_with_exclude):
+    with db_with_exclude.create_dump_stream('db1') as (name, stream):
+        assert name.startswith('db1-')
+        assert stream.read() == b'test db1'
+
+
+def test_dump_stream_db_not_exist(db_with_exclude):
+    with pytest.raises(exception.DumpingError):
+        with db_with_exclude.create_dump_stream('template0'):
+            pass
+
+
 @mock.patch('subprocess.Popen')
 def test_postgres_list_database(mock_popen, postgres_commander):
     process_mock = mock.Mock()
@@ -112,6 +132,172 @@ def test_postgres_list_database(mock_popen, postgres_commander):
                    "prod", "prod_template"]
 
 
+@mock.patch('subprocess.Popen')
+def test_postgres_database_sizes(mock_popen, postgres_commander):
+    process_mock = mock.Mock()
+    command_stdout = (
+        b"template0|7631663\n"
+        b"postgres|7918115\n"
+        b"prod|1073741824\n"
+        b"private|\n"
+    )
+    attrs = {'communicate.return_value': (command_stdout, b'')}
+    process_mock.configure_mock(**attrs)
+    mock_popen.return_value = process_mock
+    process_mock.returncode = 0
+
+    sizes = postgres_commander.database_sizes()
+    assert sizes == {'template0': 7631663, 'postgres': 7918115,
+                     'prod': 1073741824, 'private': None}
+    assert 'pg_database_size' in mock_popen.call_args[0][0][-1]
+
+
+def test_database_sizes_exclude(db_with_exclude):
+    db_with_exclude.exclude = ['postgres', 'template0', 'template1']
+    assert db_with_exclude.database_sizes() == {
+        'db1': None, 'db2': None, 'db3': None,
+    }
+
+
+@pytest.fixture
+def metadata_pool():
+    pytest.importorskip('psycopg2')
+    pool = mock.MagicMock(name='pool')
+    with mock.patch('psycopg2.pool.ThreadedConnectionPool',
+                    return_value=pool):
+        database._metadata_pools.clear()
+        database._database_lists.clear()
+        yield pool
+    database._metadata_pools.clear()
+    database._database_lists.clear()
+
+
+def set_rows(pool, *results):
+    cursor = pool.getconn().cursor().__enter__()
+    cursor.fetchall.side_effect = results
+
+
+@mock.patch('subprocess.Popen')
+def test_postgres_metadata_connection(mock_popen, metadata_pool):
+    options = database.PostgresOptions('foo', 'bar', 'baz')
+    set_rows(metadata_pool, [('db1',), ('db2',)],
+             [('db1', 1024), ('db2', None)], [('db3',)])
+    commander = database.PostgresDatabaseCommander(options)
+    assert commander.list_databases() == ['db1', 'db2']
+    # cached, shared by the commanders of the server
+    other = database.PostgresDatabaseCommander(options)
+    assert other.list_databases() == ['db1', 'db2']
+    assert commander.database_sizes() == {'db1': 1024, 'db2': None}
+    assert not mock_popen.called
+    assert metadata_pool.putconn.call_count == 2
+    with mock.patch('time.time', return_value=time.time() + 11):
+        assert commander.list_databases() == ['db3']
+
+
+def test_postgres_activity_markers(metadata_pool):
+    options = database.PostgresOptions('foo', 'bar', 'baz')
+    set_rows(metadata_pool, [('db1', 10, 2, 0, None)])
+    commander = database.PostgresDatabaseCommander(options)
+    assert commander.activity_markers() == {'db1': '10:2:0:None'}
+
+
+@pytest.fixture
+def standby_commander():
+    options = database.PostgresOptions(
+        'primary', 'bar', 'baz', metadata_connection=False, list_cache_ttl=0,
+        standbys=[('standby1', '5432'), ('standby2', '5433')],
+        standby_catchup_timeout=0,
+    )
+    return database.PostgresDatabaseCommander(options)
+
+
+def fake_servers(servers):
+    # rows of the queries by host
+    def query(sql, host=None, port=None):
+        rows = servers[host or 'primary']
+        if 'pg_current_wal_lsn' in sql:
+            return [(rows['lsn'],)]
+        if 'pg_is_in_recovery' in sql:
+            return [rows['state']] if 'state' in rows else []
+        return [(rows['caught_up'],)]
+    return query
+
+
+@pytest.mark.parametrize('servers, expected', [
+    # the most up to date standby
+    ({'primary': {'lsn': '0/3000060'},
+      'standby1': {'state': ('t', '4096', '0'), 'caught_up': 't'},
+      'standby2': {'state': ('t', '0', '5'), 'caught_up': 't'}},
+     ('standby2', '5433')),
+    # the least loaded of the up to date standbys
+    ({'primary': {'lsn': '0/3000060'},
+      'standby1': {'state': ('t', '0', '1'), 'caught_up': 't'},
+      'standby2': {'state': ('t', '0', '5'), 'caught_up': 't'}},
+     ('standby1', '5432')),
+    # a standby which does not catch up is not used
+    ({'primary': {'lsn': '0/3000060'},
+      'standby1': {'state': ('t', '4096', '0'), 'caught_up': 't'},
+      'standby2': {'state': ('t', '0', '5'), 'caught_up': 'f'}},
+     ('standby1', '5432')),
+    # promoted, not replicating or unreachable
+    ({'primary': {'lsn': '0/3000060'},
+      'standby1': {'state': ('f', '0', '0'), 'caught_up': 't'},
+      'standby2': {'state': ('t', None, '0'), 'caught_up': 't'}},
+     ('primary', '5432')),
+    ({'primary': {'lsn': '0/3000060'}, 'standby1': {}, 'standby2': {}},
+     ('primary', '5432')),
+])
+def test_postgres_dump_server(standby_commander, servers, expected):
+    with mock.patch.object(standby_commander, '_query',
+                           side_effect=fake_servers(servers)):
+        assert standby_commander._dump_server() == expected
+        command = standby_commander._dump_command('db1')
+    assert command[command.index('--host') + 1] == expected[0]
+    assert command[command.index('--port') + 1] == expected[1]
+
+
+def test_postgres_dump_server_wait_catch_up(standby_commander):
+    standby_commander.options.standby_catchup_timeout = 5
+    servers = {
+        'primary': {'lsn': '0/3000060'},
+        'standby1': {'state': ('t', '4096', '0')},
+        'standby2': {},
+    }
+    query = fake_servers(servers)
+    replayed = iter([[('f',)], [('t',)]])
+
+    def query_or_wait(sql, host=None, port=None):
+        if '>=' in sql:
+            return next(replayed)
+        return query(sql, host=host, port=port)
+
+    with mock.patch.object(standby_commander, '_query',
+                           side_effect=query_or_wait), \
+            mock.patch('time.sleep') as sleep:
+        assert standby_commander._dump_server() == ('standby1', '5432')
+    assert sleep.call_count == 1
+
+
+def test_postgres_metadata_reconnect(metadata_pool):
+    import psycopg2
+    options = database.PostgresOptions('foo', 'bar', 'baz')
+    set_rows(metadata_pool,
+             psycopg2.OperationalError('server closed the connection'),
+             [('db1',)])
+    commander = database.PostgresDatabaseCommander(options)
+    assert commander.list_databases() == ['db1']
+    conn = metadata_pool.getconn()
+    metadata_pool.putconn.assert_any_call(conn, close=True)
+
+
+def test_postgres_metadata_error(metadata_pool):
+    import psycopg2
+    options = database.PostgresOptions('foo', 'bar', 'baz')
+    metadata_pool.getconn.side_effect = psycopg2.pool.PoolError('error')
+    commander = database.PostgresDatabaseCommander(options)
+    assert commander.list_databases() == []
+
+
 @mock.patch('subprocess.Popen')
 def test_postgres_exec_dump(mock_popen, postgres_commander):
     process_mock = mock.Mock()
@@ -122,3 +308,238 @@ def test_postgres_exec_dump(mock_popen, postgres_commander):
 
     postgres_commander.exec_dump('db1', '/tmp/test')
     assert mock_popen.called
+
+
+@mock.patch('subprocess.Popen')
+def test_postgres_exec_dump_stream(mock_popen, postgres_commander):
+    process_mock = mock.Mock()
+    process_mock.stdout = io.BytesIO(b'dump content')
+    process_mock.wait.return_value = 0
+    mock_popen.return_value = process_mock
+
+    with postgres_commander.exec_dump_stream('db1') as stream:
+        assert stream.read() == b'dump content'
+    command = mock_popen.call_args[0][0]
+    # written on stdout instead of a file
+    assert '--file' not in command
+    assert command[-1] == 'db1'
+
+
+@mock.patch('subprocess.Popen')
+def test_postgres_exec_dump_stream_error(mock_popen, postgres_commander):
+    process_mock = mock.Mock()
+    process_mock.stdout = io.BytesIO(b'')
+    process_mock.wait.return_value = 1
+    mock_popen.return_value = process_mock
+
+    with pytest.raises(exception.DumpingError):
+        with postgres_commander.exec_dump_stream('db1') as stream:
+            stream.read()
+
+
+@pytest.fixture
+def parallel_commander():
+    options = database.PostgresOptions('foo', 'bar', 'baz', jobs=4)
+    return database.PostgresDatabaseCommander(options)
+
+
+def fake_directory_dump(command):
+    if command[0] != 'pg_dump':
+        return subprocess.check_call(command)
+    target = command[command.index('--file') + 1]
+    os.makedirs(target)
+    with open(os.path.join(target, 'toc.dat'), 'wb') as f:
+        f.write(b'toc')
+    with open(os.path.join(target, '3000.dat.gz'), 'wb') as f:
+        f.write(b'data')
+
+
+def test_postgres_dump_command_parallel(parallel_commander):
+    command = parallel_commander._dump_command('db1', target='/tmp/db1')
+    assert command[:5] == ['pg_dump', '--format', 'd', '--jobs', '4']
+    assert parallel_commander.dump_extension() == '.pg.tar'
+
+
+def test_postgres_exec_dump_parallel(tmpdir, parallel_commander):
+    target = tmpdir.join('db1.pg.tar').strpath
+    with mock.patch.object(parallel_commander, '_exec',
+                           side_effect=fake_directory_dump):
+        parallel_commander.exec_dump('db1', target)
+    with tarfile.open(target) as tar:
+        assert sorted(tar.getnames()) == ['.', './3000.dat.gz', './toc.dat']
+
+
+def test_postgres_exec_dump_stream_parallel(parallel_commander):
+    with mock.patch.object(parallel_commander, '_exec',
+                           side_effect=fake_directory_dump):
+        with parallel_commander.exec_dump_stream('db1') as stream:
+            content = stream.read()
+    with tarfile.open(fileobj=io.BytesIO(content)) as tar:
+        assert tar.extractfile('./toc.dat').read() == b'toc'
+
+
+def test_postgres_download_commands_parallel(parallel_commander):
+    lines, params = parallel_commander.download_commands(
+        'db1', 'db1-20170904-092333.pg.tar.gpg'
+    )
+    assert params == {
+        'archive': 'db1-20170904-092333.pg.tar',
+        'restore_dir': 'db1-20170904-092333.pg',
+    }
+    assert parallel_commander.download_commands(
+        'db1', 'db1-20170904-092333.pg.gpg'
+    ) == ([], {})
+
+
+@pytest.fixture
+def zstd_commander():
+    options = database.PostgresOptions(
+        'foo', 'bar', 'baz', compression='zstd', compression_level=3,
+        compression_threads=2,
+    )
+    return database.PostgresDatabaseCommander(options)
+
+
+def test_postgres_dump_command_compression(postgres_options, zstd_commander):
+    command = zstd_commander._dump_command('db1')
+    # pg_dump does not compress, zstd does
+    assert command[command.index('--compress') + 1] == '0'
+    assert zstd_commander._compressor == [
+        'zstd', '--stdout', '--quiet', '-T2', '-3'
+    ]
+    assert zstd_commander.dump_extension() == '.pg.zst'
+    postgres_options.compression_level = 9
+    zlib_commander = database.PostgresDatabaseCommander(postgres_options)
+    command = zlib_commander._dump_command('db1')
+    assert command[command.index('--compress') + 1] == '9'
+    assert zlib_commander._compressor is None
+    assert zlib_commander.dump_extension() == '.pg'
+
+
+def test_postgres_exec_dump_stream_zstd(zstd_commander):
+    with mock.patch.object(zstd_commander, '_dump_command',
+                           return_value=['printf', 'dump content']):
+        with zstd_commander.exec_dump_stream('db1') as stream:
+            content = stream.read()
+    assert subprocess.check_output(
+        ['zstd', '-d', '--stdout'], input=content
+    ) == b'dump content'
+
+
+def test_postgres_exec_dump_zstd(tmpdir, zstd_commander):
+    target = tmpdir.join('db1.pg.zst').strpath
+    with mock.patch.object(zstd_commander, '_dump_command',
+                           return_value=['printf', 'dump content']):
+        zstd_commander.exec_dump('db1', target)
+    assert subprocess.check_output(
+        ['zstd', '-d', '--stdout', target]
+    ) == b'dump content'
+
+
+def test_postgres_download_commands_compression():
+    options = database.PostgresOptions(
+        'foo', 'bar', 'baz', jobs=4, compression='lz4'
+    )
+    commander = database.PostgresDatabaseCommander(options)
+    lines, params = commander.download_commands(
+        'db1', 'db1-20170904-092333.pg.tar.lz4.gpg'
+    )
+    assert '$$ lz4 -d $compressed $decompressed' in lines
+    assert params == {
+        'compressed': 'db1-20170904-092333.pg.tar.lz4',
+        'decompressed': 'db1-20170904-092333.pg.tar',
+        'archive': 'db1-20170904-092333.pg.tar',
+        'restore_dir': 'db1-20170904-092333.pg',
+    }
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4'])
+def test_postgres_download_commands_decompress(tmpdir, codec):
+    options = database.PostgresOptions('foo', 'bar', 'baz', compression=codec)
+    commander = database.PostgresDatabaseCommander(options)
+    filename = 'db1-20170904-092333' + commander.dump_extension()
+    dump = tmpdir.join('db1-20170904-092333.pg')
+    dump.write('dump content')
+    subprocess.check_call(
+        [codec, '-q', dump.strpath, tmpdir.join(filename).strpath]
+        if codec == 'lz4' else
+        [codec, '-q', dump.strpath, '-o', tmpdir.join(filename).strpath]
+    )
+    dump.remove()
+    lines, params = commander.download_commands('db1', filename + '.gpg')
+    command = string.Template(
+        [line for line in lines if line.startswith('$$')][0][3:]
+    ).substitute(**params)
+    subprocess.check_call(command.split(), cwd=tmpdir.strpath)
+    assert dump.read() == 'dump content'
+
+
+def test_postgres_validation_list(postgres_commander, zstd_commander,
+                                  parallel_commander):
+    with postgres_commander.validation_pipeline('db1', 'list') as pipeline:
+        commands, env = pipeline
+    assert commands == [['pg_restore', '--list']]
+    assert env['PGPASSWORD'] == 'baz'
+    with zstd_commander.validation_pipeline('db1', 'list') as pipeline:
+        assert pipeline[0] == [
+            ['zstd', '-d', '--stdout', '--quiet'], ['pg_restore', '--list'],
+        ]
+    with parallel_commander.validation_pipeline('db1', 'list') as pipeline:
+        assert pipeline is None
+
+
+def test_postgres_validation_restore(postgres_commander):
+    postgres_commander.options.validation_server = ('scratch', '5433')
+    with mock.patch.object(postgres_commander, '_exec') as execute:
+        with postgres_commander.validation_pipeline(
+                'db1', 'restore') as (commands, env):
+            create = execute.call_args[0][0]
+            restore = commands[-1]
+        drop = execute.call_args[0][0]
+    scratch = restore[restore.index('--dbname') + 1]
+    assert scratch.startswith('dumpbag_check_db1_')
+    assert create[-1] == 'CREATE DATABASE "%s"' % (scratch,)
+    assert drop[-1] == 'DROP DATABASE IF EXISTS "%s"' % (scratch,)
+    # created, restored and dropped on the validation server
+    for command in (create, restore, drop):
+        assert command[command.index('--host') + 1] == 'scratch'
+        assert command[command.index('--port') + 1] == '5433'
+    assert '--exit-on-error' in restore
+
+
+def test_postgres_validation_restore_no_server(postgres_commander):
+    # never restored on the primary
+    with mock.patch.object(postgres_commander, '_exec') as execute:
+        with pytest.raises(exception.DumpingError):
+            with postgres_commander.validation_pipeline('db1', 'restore'):
+                pass
+    assert not execute.called
+
+
+def test_postgres_validation_restore_error(postgres_commander):
+    postgres_commander.options.validation_server = ('scratch', '5433')
+    with mock.patch.object(postgres_commander, '_exec') as execute:
+        execute.side_effect = [None, exception.DumpingError('in use')]
+        with pytest.raises(ValueError):
+            with postgres_commander.validation_pipeline('db1', 'restore'):
+                raise ValueError
+    # dropped even if the dump failed, a failed drop is only logged
+    assert execute.call_count == 2
+
+
+def test_synthetic_dump_stream():
+    options = database.SyntheticOptions(100000, entropy=0.25)
+    commander = database.DatabaseCommander.new_commander(options)
+    assert commander.list_databases() == ['db1', 'db2', 'db3']
+    with commander.exec_dump_stream('db1') as stream:
+        first = stream.read(1000) + stream.read()
+    assert len(first) == 100000
+    # the same dump at every call, another one for another database
+    with commander.exec_dump_stream('db1') as stream:
+        assert stream.read() == first
+    with commander.exec_dump_stream('db2') as stream:
+        assert stream.read() != first
+    page = database.SyntheticDumpStream.PAGE_SIZE
+    assert first[page // 4:page].startswith(database.SyntheticDumpStream.ROW)
+    text = database.SyntheticDumpStream(10000, entropy=0, seed=1)
+    assert text.read() == database.SyntheticDumpStream(10000, 0).read()
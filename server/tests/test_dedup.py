@@ -0,0 +1,273 @@
+import io
+import os
+import random
+import threading
+import time
+
+import mock
+import pytest
+
+from dumpbagserver import (
+    app, app_config, database, dedup, encryption, exception, storage,
+)
+from dumpbagserver.bagger import Bagger
+
+
+def random_content(size, seed=0):
+    rnd = random.Random(seed)
+    return bytes(rnd.getrandbits(8) for __ in range(size))
+
+
+CONTENT = random_content(600 * 1024)
+
+
+@pytest.fixture
+def passphrase_file(tmpdir):
+    path = tmpdir.join('passphrase').strpath
+    with open(path, 'w') as f:
+        f.write('secret')
+    return path
+
+
+def dedup_options(store_options, passphrase_file):
+    return dedup.DedupOptions(
+        store_options, encryption.NoOpEncryptionOptions(), passphrase_file,
+        chunk_size=16 * 1024, max_concurrency=2,
+    )
+
+
+@pytest.fixture
+def dedup_commander(tmpdir, passphrase_file):
+    options = dedup_options(
+        storage.LocalOptions(tmpdir.join('store').strpath), passphrase_file
+    )
+    return storage.StorageCommander.new_commander(options)
+
+
+def stored_chunks(commander):
+    return sorted(key for key, __ in commander.store.list('chunks/'))
+
+
+def test_content_chunks():
+    chunks = list(dedup.content_chunks(io.BytesIO(CONTENT), 16 * 1024))
+    assert b''.join(chunks) == CONTENT
+    assert all(4 * 1024 <= len(chunk) <= 64 * 1024 for chunk in chunks[:-1])
+    # an insertion changes only the chunks around it
+    modified = CONTENT[:300000] + b'inserted' + CONTENT[300000:]
+    others = list(dedup.content_chunks(io.BytesIO(modified), 16 * 1024))
+    assert len(set(chunks) - set(others)) <= 2
+
+
+def test_content_chunks_empty():
+    assert list(dedup.content_chunks(io.BytesIO(b''))) == []
+
+
+def test_push_read(dedup_commander):
+    assert dedup_commander.location().startswith('dedup+file://')
+    dedup_commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    assert dedup_commander.list_by_db() == {'db1': ['db1-1.pg']}
+    assert b''.join(dedup_commander.read_dump('db1', 'db1-1.pg')) == CONTENT
+    assert b''.join(dedup_commander.read_dump(
+        'db1', 'db1-1.pg', offset=100000, length=50000
+    )) == CONTENT[100000:150000]
+    with dedup_commander.read_from_storage('db1', 'db1-1.pg') as f:
+        assert f.read() == CONTENT
+    stat = dedup_commander.stat_dump('db1', 'db1-1.pg')
+    assert stat.size == len(CONTENT)
+
+
+def test_chunks_encrypted(dedup_commander):
+    dedup_commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    for key in stored_chunks(dedup_commander):
+        data = dedup_commander.store.get(key)
+        assert data[:1000] not in CONTENT
+
+
+def test_push_deduplicated(dedup_commander):
+    dedup_commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    first = stored_chunks(dedup_commander)
+    modified = CONTENT[:300000] + b'inserted' + CONTENT[300000:]
+    with mock.patch.object(dedup_commander, '_upload_chunk',
+                           wraps=dedup_commander._upload_chunk) as upload:
+        dedup_commander.push_stream('db1', io.BytesIO(modified), 'db1-2.pg')
+    assert 0 < upload.call_count <= 2
+    assert len(stored_chunks(dedup_commander)) <= len(first) + 2
+    assert b''.join(dedup_commander.read_dump('db1', 'db1-2.pg')) == modified
+
+
+def test_local_store_concurrent_put(tmpdir):
+    store = dedup.LocalObjectStore(tmpdir.strpath)
+    data = b'chunk' * 100000
+    errors = []
+
+    def put():
+        try:
+            for __ in range(20):
+                store.put('chunks/ab/abc', data)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=put) for __ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert store.get('chunks/ab/abc') == data
+    # no partial file left
+    assert tmpdir.join('chunks', 'ab').listdir() == [
+        tmpdir.join('chunks', 'ab', 'abc')
+    ]
+
+
+def test_not_exist(dedup_commander):
+    with pytest.raises(exception.DumpNotExistError):
+        dedup_commander.stat_dump('db1', 'foo.pg')
+    with pytest.raises(exception.DumpNotExistError):
+        list(dedup_commander.read_dump('db1', 'foo.pg'))
+
+
+def test_delete_dumps(dedup_commander):
+    for filename in ('db1-1.pg', 'db1-2.pg', 'db1-3.pg'):
+        dedup_commander.push_stream('db1', io.BytesIO(CONTENT), filename)
+    chunks = stored_chunks(dedup_commander)
+    dedup_commander.delete_dumps([('db1', 'db1-1.pg'), ('db1', 'db1-2.pg')])
+    assert dedup_commander.list_by_db() == {'db1': ['db1-3.pg']}
+    # the chunks are removed by the garbage collection
+    assert stored_chunks(dedup_commander) == chunks
+
+
+def test_collect_garbage(dedup_commander):
+    dedup_commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    other = random_content(100 * 1024, seed=1)
+    dedup_commander.push_stream('db1', io.BytesIO(other), 'db1-2.pg')
+    chunks = stored_chunks(dedup_commander)
+    dedup_commander.delete_dump('db1', 'db1-1.pg')
+    # too recent, could be used by a dump being pushed
+    assert dedup_commander.collect_garbage()['removed'] == 0
+    report = dedup_commander.collect_garbage(grace=0, dry_run=True)
+    assert report['removed'] > 0
+    assert stored_chunks(dedup_commander) == chunks
+    report = dedup_commander.collect_garbage(grace=0)
+    assert len(stored_chunks(dedup_commander)) == report['kept']
+    assert b''.join(dedup_commander.read_dump('db1', 'db1-2.pg')) == other
+
+
+def backdate(tmpdir, seconds):
+    for path in tmpdir.visit(fil=lambda p: p.isfile()):
+        os.utime(path.strpath, (time.time() - seconds, time.time() - seconds))
+
+
+def test_collect_garbage_during_push(tmpdir, dedup_commander):
+    dedup_commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    backdate(tmpdir.join('store', 'chunks'), 120)
+    reports = []
+
+    class RacingStream(io.BytesIO):
+        """ The last dump is removed and the chunks collected once the
+        push has chosen the chunks it reuses """
+
+        def read(self, size=-1):
+            if not reports:
+                dedup_commander.delete_dump('db1', 'db1-1.pg')
+                reports.append(dedup_commander.collect_garbage(grace=60))
+            return super().read(size)
+
+    dedup_commander.push_stream('db1', RacingStream(CONTENT), 'db1-2.pg')
+    # the chunks reused by the push are protected by its marker
+    assert reports[0]['removed'] == 0
+    assert b''.join(dedup_commander.read_dump('db1', 'db1-2.pg')) == CONTENT
+    # the markers are removed once older than the grace period
+    backdate(tmpdir.join('store', 'pushes'), 120)
+    dedup_commander.collect_garbage(grace=60)
+    assert not dedup_commander.store.exists('pushes/db1/db1-2.pg')
+    assert b''.join(dedup_commander.read_dump('db1', 'db1-2.pg')) == CONTENT
+
+
+def test_known_chunks_removed_meanwhile(dedup_commander):
+    dedup_commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    with mock.patch.object(dedup_commander.store, 'exists',
+                           return_value=False):
+        # the last dump was removed before the marker was written
+        assert dedup_commander._known_chunks('db1', 'db1-2.pg') == set()
+
+
+def test_s3_backend(passphrase_file):
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        s3_options = storage.S3ClientOptions(
+            'foo', 'bar', 'baz', region='us-east-1',
+        )
+        commander = storage.StorageCommander.new_commander(
+            dedup_options(s3_options, passphrase_file)
+        )
+        storage._s3_client(s3_options).create_bucket(Bucket='foo')
+        commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+        assert commander.list_by_db(dbname='db1') == {'db1': ['db1-1.pg']}
+        assert b''.join(commander.read_dump('db1', 'db1-1.pg')) == CONTENT
+        assert commander.store.exists('manifests/db1/db1-1.pg')
+        assert not commander.store.exists('manifests/db1/db1-2.pg')
+        commander.delete_dump('db1', 'db1-1.pg')
+        commander.collect_garbage(grace=-60)
+        assert stored_chunks(commander) == []
+
+
+def test_collect_chunks_route(tmpdir, passphrase_file, monkeypatch):
+    monkeypatch.setenv('BAG_DB_KIND', 'static')
+    monkeypatch.setenv('BAG_STORAGE_KIND', 'dedup')
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_DIR', tmpdir.join('store').strpath)
+    monkeypatch.setenv('BAG_DEDUP_PASSPHRASE_FILE', passphrase_file)
+    monkeypatch.setenv('BAG_DEDUP_GC_GRACE', '60')
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'none')
+    commander = Bagger(app_config).storage
+    commander.push_stream('db1', io.BytesIO(CONTENT), 'db1-1.pg')
+    commander.delete_dump('db1', 'db1-1.pg')
+    chunks = stored_chunks(commander)
+    # the chunks are older than the grace period
+    backdate(tmpdir.join('store'), 120)
+    client = app.test_client()
+    # a GET only counts the chunks to remove
+    assert client.get('/collect-chunks').get_json()['dry_run'] is True
+    assert stored_chunks(commander) == chunks
+    report = client.post('/collect-chunks').get_json()
+    assert report['removed'] == len(chunks)
+    assert stored_chunks(commander) == []
+    assert client.get('/collect-chunks?dry_run=0').get_json() == {
+        'kept': 0, 'removed': 0, 'dry_run': False,
+    }
+
+
+def test_s3_backend_delete_errors():
+    client = mock.Mock(name='client')
+    client.delete_objects.return_value = {'Errors': [
+        {'Key': 'chunks/ab/abcd', 'Code': 'AccessDenied',
+         'Message': 'Access Denied'},
+    ]}
+    store = dedup.S3ObjectStore(
+        storage.S3ClientOptions('foo', 'bar', 'baz', region='us-east-1')
+    )
+    with mock.patch.object(dedup, '_s3_client', return_value=client):
+        with pytest.raises(exception.DumpStorageError) as err:
+            store.delete(['chunks/ab/abcd', 'chunks/ef/efgh'])
+    assert 'chunks/ab/abcd (Access Denied)' in str(err.value)
+
+
+def test_bagger_dedup(tmpdir, passphrase_file):
+    config = mock.Mock(name='config')
+    config.only_databases = []
+    config.exclude_databases = []
+    config.streaming = False
+    config.listing_cache_ttl = 0
+    config.catalog = False
+    config.dump_validation = None
+    config.database_options.return_value = database.StaticOptions()
+    config.storage_options.return_value = dedup_options(
+        storage.LocalOptions(tmpdir.strpath), passphrase_file
+    )
+    config.encryption_options.return_value = (
+        encryption.NoOpEncryptionOptions()
+    )
+    bagger = Bagger(config)
+    filename = bagger.bag_one_database('db1')
+    assert os.path.exists(tmpdir.join('manifests', 'db1', filename).strpath)
+    assert b''.join(bagger.read_dump('db1', filename)) == b'test db1'
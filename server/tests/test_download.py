@@ -0,0 +1,146 @@
+import hashlib
+import os
+
+import pytest
+
+from dumpbagserver import app, exception
+
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def client(tmpdir, monkeypatch):
+    monkeypatch.setenv('BAG_DB_KIND', 'static')
+    monkeypatch.setenv('BAG_STORAGE_KIND', 'local')
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_DIR', tmpdir.strpath)
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'none')
+    os.makedirs(tmpdir.join('db1').strpath)
+    with open(tmpdir.join('db1', 'db1.pg').strpath, 'wb') as f:
+        f.write(CONTENT)
+    return app.test_client()
+
+
+URL = '/download/db1/db1.pg'
+
+
+def test_download(client):
+    response = client.get(URL)
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers['Content-Length'] == str(len(CONTENT))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified']
+
+
+def test_download_not_exist(client):
+    assert client.get('/download/db1/foo.pg').status_code == 404
+
+
+def test_download_not_modified(client):
+    etag = client.get(URL).headers['ETag']
+    response = client.get(URL, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_download_range(client):
+    response = client.get(URL, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[100:200]
+    assert response.headers['Content-Range'] == (
+        'bytes 100-199/%d' % (len(CONTENT),)
+    )
+    assert response.headers['Content-Length'] == '100'
+
+
+def test_download_range_suffix(client):
+    response = client.get(URL, headers={'Range': 'bytes=-10'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[-10:]
+
+
+def test_download_range_open(client):
+    response = client.get(URL, headers={'Range': 'bytes=10000-'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[10000:]
+
+
+def test_download_range_not_satisfiable(client):
+    response = client.get(URL, headers={'Range': 'bytes=20000-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */%d' % (
+        len(CONTENT),
+    )
+
+
+def test_download_multi_range(client):
+    response = client.get(URL, headers={'Range': 'bytes=0-9,500-509'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary'].encode('ascii')
+    assert int(response.headers['Content-Length']) == len(response.data)
+    parts = response.data.split(b'--' + boundary)
+    # preamble, 2 parts, epilogue
+    assert len(parts) == 4
+    assert b'Content-Range: bytes 0-9/10240' in parts[1]
+    assert parts[1].endswith(b'\r\n\r\n' + CONTENT[0:10] + b'\r\n')
+    assert parts[2].endswith(b'\r\n\r\n' + CONTENT[500:510] + b'\r\n')
+
+
+def test_download_if_range(client):
+    etag = client.get(URL).headers['ETag']
+    headers = {'Range': 'bytes=0-9', 'If-Range': etag}
+    response = client.get(URL, headers=headers)
+    assert response.status_code == 206
+    assert response.data == CONTENT[:10]
+    # the dump changed, everything is sent again
+    headers['If-Range'] = '"outdated"'
+    response = client.get(URL, headers=headers)
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_download_accel_redirect(client, monkeypatch):
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_ACCEL_REDIRECT', '/protected/')
+    response = client.get(URL)
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.headers['X-Accel-Redirect'] == '/protected/db1/db1.pg'
+    assert 'attachment' in response.headers['Content-Disposition']
+
+
+def test_download_accel_redirect_not_exist(client, monkeypatch):
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_ACCEL_REDIRECT', '/protected/')
+    assert client.get('/download/db1/foo.pg').status_code == 404
+
+
+def test_download_verify(client, tmpdir):
+    assert client.get(URL + '?verify=1').status_code == 409
+    checksum = hashlib.sha256(CONTENT).hexdigest()
+    tmpdir.join('db1', 'db1.pg.sha256').write(
+        '%s  db1.pg\n' % (checksum,)
+    )
+    response = client.get(URL + '?verify=1')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers['Repr-Digest'].startswith('sha-256=:')
+
+
+def test_download_verify_mismatch(client, tmpdir):
+    # several chunks
+    content = CONTENT * 20
+    tmpdir.join('db1', 'big.pg').write(content, mode='wb')
+    tmpdir.join('db1', 'big.pg.sha256').write(
+        '%s  big.pg\n' % (hashlib.sha256(b'other').hexdigest(),)
+    )
+    response = client.get('/download/db1/big.pg?verify=1', buffered=False)
+    assert response.headers['Content-Length'] == str(len(content))
+    received = b''
+    # the transfer stops before the last chunk
+    with pytest.raises(exception.DumpChecksumError):
+        for chunk in response.iter_encoded():
+            received += chunk
+    assert received == content[:len(received)]
+    assert 0 < len(received) < len(content)
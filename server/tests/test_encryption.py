@@ -1,8 +1,10 @@
+import io
+
 import mock
 import pytest
 import os
 
-from dumpbagserver import encryption
+from dumpbagserver import encryption, exception
 
 
 @pytest.fixture
@@ -62,6 +64,13 @@ def test_noop_encrypt(test_file, noop_commander):
     assert content == new_content
 
 
+def test_noop_encrypt_stream(noop_commander):
+    source = io.BytesIO(b'some content')
+    with noop_commander.encrypt_stream(source) as encrypted:
+        assert encrypted.read() == b'some content'
+    assert noop_commander.encrypted_filename('test.pg') == 'test.pg'
+
+
 def test_noop_public_keys(noop_commander):
     assert noop_commander.public_keys() == []
 
@@ -74,8 +83,18 @@ def test_gpg_recipients(gpg_commander):
     assert gpg_commander.recipients() == gpg_commander.options.recipients
 
 
+@pytest.fixture
+def gpg_home(tmpdir, monkeypatch):
+    home = tmpdir.join('gnupg')
+    home.ensure(dir=True)
+    home.join('pubring.kbx').write('keys')
+    monkeypatch.setenv('GNUPGHOME', home.strpath)
+    encryption._exported_keys.clear()
+    return home
+
+
 @mock.patch('subprocess.Popen')
-def test_gpg_public_keys(mock_popen, gpg_commander):
+def test_gpg_public_keys(mock_popen, gpg_home, gpg_commander):
     keys = (
         '-----BEGIN PGP PUBLIC KEY BLOCK-----\n'
         'Version: GnuPG v1\n'
@@ -95,18 +114,32 @@ def test_gpg_public_keys(mock_popen, gpg_commander):
     process_mock.returncode = 0
 
     public_keys = gpg_commander.public_keys()
-    # as we have 2 recipients but the popen mock returns 2 times
-    # the same key, the test assume we should receive 2 times the same key
-    # in real world, each recipient will have the same key
-    assert public_keys == [keys, keys]
-    assert mock_popen.call_count == 2
+    # the keys of all the recipients are exported in a single block
+    assert public_keys == [keys]
+    assert mock_popen.call_count == 1
     # the list of recipients is defined in gpg_options()
-    assert mock_popen.call_args_list[0][0] == ([
-        'gpg', '--export', '-a', 'someone@example.com',
-    ],)
-    assert mock_popen.call_args_list[1][0] == ([
-        'gpg', '--export', '-a', 'another@example.com',
+    assert mock_popen.call_args[0] == ([
+        'gpg', '--batch', '--export', '-a',
+        'someone@example.com', 'another@example.com',
     ],)
+    # cached until the keyring changes
+    assert gpg_commander.public_keys() == [keys]
+    assert mock_popen.call_count == 1
+    gpg_home.join('pubring.kbx').write('more keys')
+    assert gpg_commander.public_keys() == [keys]
+    assert mock_popen.call_count == 2
+
+
+@mock.patch('subprocess.Popen')
+def test_gpg_public_keys_error(mock_popen, gpg_home, gpg_commander):
+    process_mock = mock.Mock()
+    process_mock.communicate.return_value = (b'', b'keyring locked')
+    mock_popen.return_value = process_mock
+    process_mock.returncode = 2
+    assert gpg_commander.public_keys() == []
+    # a failed export is not cached
+    assert gpg_commander.public_keys() == []
+    assert mock_popen.call_count == 2
 
 
 @mock.patch('subprocess.Popen')
@@ -131,3 +164,35 @@ def test_gpg_encrypt(mock_popen, test_file, gpg_commander):
     # no encryption, should not have changed
     assert new_filename == target_filename
     assert new_content == b'this is my encrypted content'
+
+
+@mock.patch('subprocess.Popen')
+def test_gpg_encrypt_stream(mock_popen, gpg_commander):
+    process_mock = mock.Mock()
+    process_mock.stdout = io.BytesIO(b'this is my encrypted content')
+    process_mock.wait.return_value = 0
+    mock_popen.return_value = process_mock
+
+    source = io.BytesIO(b'some content')
+    with gpg_commander.encrypt_stream(source) as encrypted:
+        assert encrypted.read() == b'this is my encrypted content'
+    assert mock_popen.call_args[0] == ([
+        'gpg', '--encrypt', '--always-trust',
+        '--compress-algo', 'none',
+        '--recipient', 'someone@example.com',
+        '--recipient', 'another@example.com',
+        '--batch',
+    ],)
+    assert gpg_commander.encrypted_filename('test.pg') == 'test.pg.gpg'
+
+
+@mock.patch('subprocess.Popen')
+def test_gpg_encrypt_stream_error(mock_popen, gpg_commander):
+    process_mock = mock.Mock()
+    process_mock.stdout = io.BytesIO(b'')
+    process_mock.wait.return_value = 2
+    mock_popen.return_value = process_mock
+
+    with pytest.raises(exception.DumpEncryptionError):
+        with gpg_commander.encrypt_stream(io.BytesIO(b'')) as encrypted:
+            encrypted.read()
@@ -0,0 +1,169 @@
+import time
+
+import mock
+import pytest
+
+from dumpbagserver import bagger, changes, exception, jobs
+
+
+@pytest.fixture
+def queue(tmpdir):
+    return jobs.JobQueue(tmpdir.join('state.db').strpath)
+
+
+@pytest.fixture
+def runner(queue):
+    fake_bagger = mock.Mock(name='bagger')
+    return jobs.JobRunner(queue, lambda: fake_bagger)
+
+
+def test_enqueue_claim(queue):
+    job_id = queue.enqueue('dump', dbname='db1')
+    job = queue.get(job_id)
+    assert job['status'] == jobs.QUEUED
+    assert job['dbname'] == 'db1'
+    assert job['started_at'] is None
+
+    claimed = queue.claim('worker1')
+    assert claimed['id'] == job_id
+    assert claimed['status'] == jobs.RUNNING
+    assert claimed['attempts'] == 1
+    # nothing left for another worker
+    assert queue.claim('worker2') is None
+
+
+def test_claim_oldest_first(queue):
+    first = queue.enqueue('dump', dbname='db1')
+    second = queue.enqueue('dump', dbname='db2')
+    assert queue.claim('worker')['id'] == first
+    assert queue.claim('worker')['id'] == second
+
+
+def test_claim_abandoned(queue):
+    job_id = queue.enqueue('dump', dbname='db1', max_attempts=2)
+    queue.claim('dead worker')
+    assert queue.claim('worker') is None
+    # the worker did not give any sign of life for too long
+    later = time.time() + jobs.STALE_AFTER + 1
+    with mock.patch('time.time', return_value=later):
+        job = queue.claim('worker')
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+    # no attempts left, e.g. the job kills its worker
+    later += jobs.STALE_AFTER + 1
+    with mock.patch('time.time', return_value=later):
+        assert queue.claim('worker') is None
+    job = queue.get(job_id)
+    assert job['status'] == jobs.FAILED
+    assert job['error'] == 'the job was abandoned by its worker'
+
+
+def test_claim_abandoned_no_attempts_left(queue):
+    job_id = queue.enqueue('dump', dbname='db1')
+    other = queue.enqueue('dump', dbname='db2')
+    queue.claim('dead worker')
+    later = time.time() + jobs.STALE_AFTER + 1
+    with mock.patch('time.time', return_value=later):
+        assert queue.claim('worker')['id'] == other
+    assert queue.get(job_id)['status'] == jobs.FAILED
+
+
+def test_finish(queue):
+    job_id = queue.enqueue('dump', dbname='db1')
+    queue.claim('worker')
+    queue.finish(job_id, {'filename': 'db1.pg'})
+    job = queue.get(job_id)
+    assert job['status'] == jobs.DONE
+    assert job['result'] == {'filename': 'db1.pg'}
+    assert job['duration'] >= 0
+
+
+def test_get_unknown(queue):
+    assert queue.get('foo') is None
+
+
+def test_run_dump_job(queue, runner):
+    runner.bagger_factory().bag_one_database.return_value = 'db1.pg'
+    job_id = queue.enqueue('dump', dbname='db1')
+    runner.run_job(queue.claim(runner.name))
+    job = queue.get(job_id)
+    assert job['status'] == jobs.DONE
+    assert job['result'] == {'filename': 'db1.pg'}
+
+
+def test_run_dump_job_failure(queue, runner):
+    runner.bagger_factory().bag_one_database.side_effect = (
+        exception.DumpingError('could not dump')
+    )
+    job_id = queue.enqueue('dump', dbname='db1')
+    runner.run_job(queue.claim(runner.name))
+    job = queue.get(job_id)
+    assert job['status'] == jobs.FAILED
+    assert job['error'] == 'DumpingError: could not dump'
+
+
+def test_run_dumpall_job_failure(queue, runner):
+    report = bagger.BagReport()
+    report.add_success('db1', 'db1.pg', 1.)
+    report.add_failure('db2', exception.DumpingError('could not dump'), 1.)
+    runner.bagger_factory().bag_all_databases.return_value = report
+    job_id = queue.enqueue('dumpall')
+    runner.run_job(queue.claim(runner.name))
+    job = queue.get(job_id)
+    assert job['status'] == jobs.FAILED
+    assert job['result']['succeeded'] == {'db1': 'db1.pg'}
+    assert job['result']['failed'] == {'db2': 'DumpingError: could not dump'}
+
+
+def test_runner_threads(queue, runner):
+    runner.bagger_factory().bag_one_database.return_value = 'db1.pg'
+    runner.start()
+    try:
+        job_id = queue.enqueue('dump', dbname='db1')
+        runner.notify()
+        for __ in range(50):
+            if queue.get(job_id)['status'] == jobs.DONE:
+                break
+            time.sleep(0.1)
+        assert queue.get(job_id)['status'] == jobs.DONE
+    finally:
+        runner.stop()
+
+
+def test_dump_durations(queue, runner):
+    report = bagger.BagReport()
+    report.add_success('db1', 'db1.pg', 10.)
+    report.add_failure('db2', exception.DumpingError('could not dump'), 1.)
+    job_id = queue.enqueue('dumpall')
+    queue.claim('worker')
+    queue.fail(job_id, 'dump failed for db2', result=report.to_dict())
+    job_id = queue.enqueue('dump', dbname='db1')
+    queue.claim('worker')
+    queue.finish(job_id, {'filename': 'db1.pg'})
+    durations = queue.dump_durations()
+    # the last dump of db1, no successful dump of db2
+    assert list(durations) == ['db1']
+    assert durations['db1'] < 10.
+
+    # the longest dumps are started first by the next dumpall
+    runner.bagger_factory().bag_all_databases.return_value = report
+    queue.enqueue('dumpall')
+    runner.run_job(queue.claim(runner.name))
+    runner.bagger_factory().bag_all_databases.assert_called_with(
+        durations=durations, markers=None
+    )
+
+
+def test_run_scheduled_dump_skipped(queue, runner, tmpdir):
+    runner.markers = changes.ActivityMarkers(tmpdir.join('state.db').strpath)
+    runner.bagger_factory().bag_if_changed.return_value = ('db1.pg', True)
+    run_id = queue.create_run('nightly', time.time(), time.time() + 60,
+                              [{'kind': 'dump', 'dbname': 'db1'}])
+    runner.run_job(queue.claim(runner.name))
+    runner.bagger_factory().bag_if_changed.assert_called_with(
+        'db1', runner.markers
+    )
+    run = queue.get_run(run_id)
+    assert (run['succeeded'], run['skipped']) == (1, 1)
+    # the duration of a skipped dump is not the one of a dump
+    assert queue.dump_durations() == {}
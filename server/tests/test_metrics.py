@@ -0,0 +1,126 @@
+import io
+
+from contextlib import contextmanager
+
+import mock
+import pytest
+
+from prometheus_client import REGISTRY
+
+import dumpbagserver.bagger
+from dumpbagserver import app, database, encryption, exception, storage
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def local_bagger(tmpdir):
+    config = mock.Mock(name='config')
+    config.only_databases = []
+    config.exclude_databases = []
+    config.streaming = True
+    config.metrics = True
+    config.metrics_bytes = True
+    config.listing_cache_ttl = 0
+    config.catalog = False
+    config.dump_validation = None
+    config.database_options.return_value = database.StaticOptions()
+    config.storage_options.return_value = storage.LocalOptions(
+        tmpdir.strpath
+    )
+    config.encryption_options.return_value = (
+        encryption.NoOpEncryptionOptions()
+    )
+    return dumpbagserver.bagger.Bagger(config)
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_bag_metrics(local_bagger, streaming):
+    local_bagger.config.streaming = streaming
+    labels = {'dbname': 'db1', 'stage': 'dump'}
+    bytes_before = sample('dumpbag_stage_bytes_total', **labels)
+    totals = sample('dumpbag_stage_duration_seconds_count',
+                    dbname='db1', stage='total')
+    pushes = sample('dumpbag_stage_duration_seconds_count',
+                    dbname='db1', stage='push')
+    local_bagger.bag_one_database('db1')
+    assert sample('dumpbag_stage_bytes_total', **labels) == (
+        bytes_before + len(b'test db1')
+    )
+    assert sample('dumpbag_stage_duration_seconds_count',
+                  dbname='db1', stage='total') == totals + 1
+    assert sample('dumpbag_stage_duration_seconds_count',
+                  dbname='db1', stage='push') == pushes + 1
+    assert sample('dumpbag_dumps_in_progress') == 0
+
+
+def test_bag_metrics_no_bytes(local_bagger):
+    # the streamed stages are connected directly, not counted
+    local_bagger.config.metrics_bytes = False
+    labels = {'dbname': 'db1', 'stage': 'dump'}
+    bytes_before = sample('dumpbag_stage_bytes_total', **labels)
+    pushes = sample('dumpbag_stage_duration_seconds_count',
+                    dbname='db1', stage='push')
+    with mock.patch.object(local_bagger.encrypter, 'encrypt_stream',
+                           wraps=local_bagger.encrypter.encrypt_stream) as enc:
+        local_bagger.bag_one_database('db1')
+    assert not isinstance(enc.call_args[0][0],
+                          dumpbagserver.metrics.MeteredStream)
+    assert sample('dumpbag_stage_bytes_total', **labels) == bytes_before
+    assert sample('dumpbag_stage_duration_seconds_count',
+                  dbname='db1', stage='push') == pushes + 1
+
+
+def test_bag_failure_metrics(local_bagger):
+    @contextmanager
+    def failing_dump(dbname):
+        yield io.BytesIO(b'truncated')
+        raise exception.DumpingError('connection lost')
+
+    labels = {'dbname': 'db1', 'error': 'DumpingError'}
+    failures = sample('dumpbag_dump_failures_total', **labels)
+    commander = local_bagger.db.commander
+    with mock.patch.object(commander, 'exec_dump_stream', failing_dump):
+        with pytest.raises(exception.DumpingError):
+            local_bagger.bag_one_database('db1')
+    assert sample('dumpbag_dump_failures_total', **labels) == failures + 1
+    assert sample('dumpbag_dumps_in_progress') == 0
+
+
+def test_listing_metrics(local_bagger):
+    listings = sample('dumpbag_listing_duration_seconds_count')
+    local_bagger.list_dumps()
+    assert sample('dumpbag_listing_duration_seconds_count') == listings + 1
+
+
+@pytest.fixture
+def client(tmpdir, monkeypatch):
+    monkeypatch.setenv('BAG_DB_KIND', 'static')
+    monkeypatch.setenv('BAG_STORAGE_KIND', 'local')
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_DIR', tmpdir.strpath)
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'none')
+    tmpdir.join('db1').ensure(dir=True)
+    tmpdir.join('db1', 'db1.pg').write(b'dump content', mode='wb')
+    return app.test_client()
+
+
+def test_metrics_endpoint(client, monkeypatch):
+    downloads = sample('dumpbag_download_duration_seconds_count')
+    response = client.get('/download/db1/db1.pg')
+    assert response.data == b'dump content'
+    assert sample('dumpbag_download_duration_seconds_count') == downloads + 1
+    response = client.get('/download/db1/db1.pg',
+                          headers={'Range': 'bytes=0-3'})
+    assert response.data == b'dump'
+    response.close()
+    assert sample('dumpbag_download_duration_seconds_count') == downloads + 2
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert b'dumpbag_download_duration_seconds_count' in response.data
+
+    monkeypatch.setenv('BAG_METRICS', '0')
+    assert client.get('/metrics').status_code == 404
@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta
+
+import mock
+import pytest
+
+import dumpbagserver.bagger
+from dumpbagserver import (
+    app, database, encryption, exception, retention, storage,
+)
+
+
+def dumps_every(days, count, start=datetime(2017, 12, 31, 23, 0)):
+    # names of the daily dumps of db1, the newest first
+    return [
+        'db1-%s.pg' % (start - timedelta(days=idx * days)).strftime(
+            '%Y%m%d-%H%M%S'
+        )
+        for idx in range(count)
+    ]
+
+
+def test_policy_daily():
+    dumps = dumps_every(1, 30)
+    policy = retention.RetentionPolicy(daily=7)
+    assert policy.keep(dumps) == set(dumps[:7])
+    # no dump for several days: the last 7 days having dumps are kept
+    assert policy.keep(dumps[::3]) == set(dumps[::3][:7])
+
+
+def test_policy_last_of_period():
+    dumps = [
+        'db1-20171231-030000.pg', 'db1-20171231-150000.pg',
+        'db1-20171230-030000.pg',
+    ]
+    policy = retention.RetentionPolicy(daily=2)
+    assert policy.keep(dumps) == {
+        'db1-20171231-150000.pg', 'db1-20171230-030000.pg',
+    }
+
+
+def test_policy_gfs():
+    dumps = dumps_every(1, 400)
+    policy = retention.RetentionPolicy(daily=7, weekly=4, monthly=6)
+    # the last dumps of the ISO weeks are on sunday, the ones of the months
+    # on their last day
+    weekly = ['db1-%s-230000.pg' % day
+              for day in ('20171231', '20171224', '20171217', '20171210')]
+    monthly = ['db1-%s-230000.pg' % day
+               for day in ('20171231', '20171130', '20171031', '20170930',
+                           '20170831', '20170731')]
+    assert policy.keep(dumps) == set(dumps[:7]) | set(weekly) | set(monthly)
+
+
+def test_policy_keeps_last_and_undated():
+    policy = retention.RetentionPolicy()
+    dumps = dumps_every(1, 3) + ['db1.pg']
+    assert policy.keep(dumps) == {dumps[0], 'db1.pg'}
+
+
+def test_parse_retention():
+    policies = retention.parse_retention(
+        'prod_*, live: daily=7 weekly=4 monthly=12;\n'
+        '# comment\n'
+        '*: daily=3'
+    )
+    assert [patterns for patterns, __ in policies] == [
+        ['prod_*', 'live'], ['*'],
+    ]
+    assert policies[0][1].to_dict() == {
+        'daily': 7, 'weekly': 4, 'monthly': 12,
+    }
+    assert policies[1][1].to_dict() == {'daily': 3, 'weekly': 0, 'monthly': 0}
+    assert retention.parse_retention('') == []
+
+
+@pytest.mark.parametrize('text', [
+    'daily=7', ': daily=7', 'db1: daily=x', 'db1: hourly=3',
+    'db1: daily=3 daily=4', 'db1:',
+])
+def test_parse_retention_invalid(text):
+    with pytest.raises(exception.DumpConfigurationError):
+        retention.parse_retention(text)
+
+
+def test_plan():
+    rotation = retention.Retention(
+        retention.parse_retention('db1: daily=2; db2*: daily=1')
+    )
+    assert rotation.policy('db1').daily == 2
+    assert rotation.policy('db3') is None
+    dumps = dumps_every(1, 3)
+    plan = rotation.plan({
+        'db1': dumps,
+        'db2': [dump.replace('db1', 'db2') for dump in dumps],
+        'db3': [dump.replace('db1', 'db3') for dump in dumps],
+    })
+    assert plan == {
+        'db1': {'keep': sorted(dumps[:2]), 'delete': [dumps[2]]},
+        'db2': {
+            'keep': [dumps[0].replace('db1', 'db2')],
+            'delete': sorted(dump.replace('db1', 'db2')
+                             for dump in dumps[1:]),
+        },
+    }
+
+
+@pytest.fixture
+def local_bagger(tmpdir):
+    storage_dir = tmpdir.join('storage')
+    for dbname in ('db1', 'db2'):
+        storage_dir.join(dbname).ensure(dir=True)
+        for dump in dumps_every(1, 5):
+            storage_dir.join(dbname, dump.replace('db1', dbname)).write('')
+    config = mock.Mock(name='config')
+    config.only_databases = []
+    config.exclude_databases = []
+    config.listing_cache_ttl = 60
+    config.catalog = True
+    config.dump_validation = None
+    config.state_db = tmpdir.join('state.db').strpath
+    config.catalog_reconcile_interval = 0
+    config.database_options.return_value = database.StaticOptions()
+    config.storage_options.return_value = storage.LocalOptions(
+        storage_dir.strpath
+    )
+    config.encryption_options.return_value = (
+        encryption.NoOpEncryptionOptions()
+    )
+    return dumpbagserver.bagger.Bagger(config)
+
+
+@pytest.mark.parametrize('with_catalog', [True, False])
+def test_apply_retention(local_bagger, with_catalog):
+    if with_catalog:
+        local_bagger.catalog.reconcile(local_bagger.storage)
+    else:
+        local_bagger.catalog = None
+    rotation = retention.Retention(retention.parse_retention('db1: daily=2'))
+    before = local_bagger.list_dumps()
+    report = local_bagger.apply_retention(rotation, dry_run=True)
+    assert report['removed'] == 3
+    assert report['kept'] == 2
+    assert report['databases']['db1']['policy']['daily'] == 2
+    assert 'db2' not in report['databases']
+    assert local_bagger.list_dumps() == before
+
+    with mock.patch.object(local_bagger.storage, 'delete_dumps',
+                           wraps=local_bagger.storage.delete_dumps) as delete:
+        report = local_bagger.apply_retention(rotation)
+    # removed at once
+    assert delete.call_count == 1
+    assert sorted(local_bagger.list_dumps()['db1']) == sorted(
+        dumps_every(1, 2)
+    )
+    assert len(local_bagger.storage.list_by_db()['db1']) == 2
+    assert len(local_bagger.list_dumps()['db2']) == 5
+
+
+def test_retention_view(tmpdir, monkeypatch):
+    monkeypatch.setenv('BAG_DB_KIND', 'static')
+    monkeypatch.setenv('BAG_STORAGE_KIND', 'local')
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_DIR', tmpdir.strpath)
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'none')
+    tmpdir.join('db1').ensure(dir=True)
+    for dump in dumps_every(1, 3):
+        tmpdir.join('db1', dump).write('')
+    client = app.test_client()
+    monkeypatch.delenv('BAG_RETENTION', raising=False)
+    assert client.get('/retention').status_code == 404
+    monkeypatch.setenv('BAG_RETENTION', '*: daily=1')
+    report = client.get('/retention?dry_run=1').get_json()
+    assert report['dry_run'] is True
+    assert report['removed'] == 2
+    assert len(tmpdir.join('db1').listdir()) == 3
+    # a plain GET never removes anything
+    assert client.get('/retention').get_json()['dry_run'] is True
+    assert len(tmpdir.join('db1').listdir()) == 3
+    report = client.post('/retention').get_json()
+    assert report['dry_run'] is False
+    assert [dump.basename for dump in tmpdir.join('db1').listdir()] == [
+        dumps_every(1, 1)[0],
+    ]
@@ -0,0 +1,191 @@
+import time
+
+from datetime import datetime
+
+import mock
+import pytest
+
+from dumpbagserver import exception, jobs, scheduler
+
+
+def at(*args):
+    return datetime(*args).timestamp()
+
+
+@pytest.fixture
+def queue(tmpdir):
+    return jobs.JobQueue(tmpdir.join('state.db').strpath)
+
+
+@pytest.fixture
+def nightly(queue):
+    fake_bagger = mock.Mock(name='bagger')
+    fake_bagger.dump_order.return_value = ['db1', 'db2', 'other']
+    schedule = scheduler.Schedule(
+        'nightly', '0 3 * * *', databases=['db*'], window=3600
+    )
+    return scheduler.Scheduler(
+        queue, [schedule], lambda: fake_bagger, stagger=60, retries=1,
+        retry_delay=600,
+    )
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+    ('0 3 * * *', (2017, 9, 4, 3, 0), (2017, 9, 5, 3, 0)),
+    ('*/15 * * * *', (2017, 9, 4, 3, 7), (2017, 9, 4, 3, 15)),
+    ('30 1 * * 0', (2017, 9, 4, 0, 0), (2017, 9, 10, 1, 30)),
+    ('0 0 1,15 * *', (2017, 9, 4, 0, 0), (2017, 9, 15, 0, 0)),
+    ('0 0 1 * 1', (2017, 9, 5, 0, 0), (2017, 9, 11, 0, 0)),
+    ('0 22 * 1-3 *', (2017, 9, 4, 0, 0), (2018, 1, 1, 22, 0)),
+    ('@daily', (2017, 12, 31, 23, 59), (2018, 1, 1, 0, 0)),
+])
+def test_cron_next_after(expression, after, expected):
+    cron = scheduler.CronExpression(expression)
+    assert cron.next_after(datetime(*after)) == datetime(*expected)
+
+
+@pytest.mark.parametrize('expression', [
+    '0 3 * *', '60 * * * *', '* 5-2 * * *', '*/0 * * * *', 'a * * * *',
+])
+def test_cron_invalid(expression):
+    with pytest.raises(exception.DumpConfigurationError):
+        scheduler.CronExpression(expression)
+
+
+def test_parse_schedules():
+    schedules = scheduler.parse_schedules(
+        '# comment\n'
+        'nightly: 0 3 * * *\n'
+        'prod: 30 1 * * 1-5 | prod_* | 60; weekly: @weekly | | 30'
+    )
+    assert [s.name for s in schedules] == ['nightly', 'prod', 'weekly']
+    assert schedules[0].databases == ('*',)
+    assert schedules[0].window == 4 * 3600
+    assert schedules[1].databases == ('prod_*',)
+    assert schedules[2].window == 1800
+    for text in ('0 3 * * *', 'a: 0 3 * * * | * | 0', 'a: @daily; a: @daily'):
+        with pytest.raises(exception.DumpConfigurationError):
+            scheduler.parse_schedules(text)
+
+
+def test_current_run():
+    schedule = scheduler.Schedule('nightly', '0 3 * * *', window=3600)
+    assert schedule.current_run(at(2017, 9, 4, 2, 59)) is None
+    assert schedule.current_run(at(2017, 9, 4, 3, 0)) == at(2017, 9, 4, 3)
+    assert schedule.current_run(at(2017, 9, 4, 3, 59)) == at(2017, 9, 4, 3)
+    assert schedule.current_run(at(2017, 9, 4, 4, 1)) is None
+    assert schedule.next_run(at(2017, 9, 4, 3, 0)) == at(2017, 9, 5, 3)
+
+
+def test_tick_queues_run_once(queue, nightly):
+    now = at(2017, 9, 4, 3, 0, 20)
+    assert nightly.tick(now=now - 60) == []
+    run_id, = nightly.tick(now=now)
+    assert nightly.tick(now=now + 30) == []
+    # another process sharing the queue
+    schedule = nightly.schedules[0]
+    assert nightly.queue_run(schedule, at(2017, 9, 4, 3)) is None
+
+    run = queue.get_run(run_id)
+    assert run['schedule'] == 'nightly'
+    assert run['status'] == jobs.RUNNING
+    assert [job['dbname'] for job in run['jobs']] == ['db1', 'db2']
+    # the starts are spread
+    assert [job['not_before'] for job in run['jobs']] == [
+        jobs._isoformat(at(2017, 9, 4, 3, 0)),
+        jobs._isoformat(at(2017, 9, 4, 3, 1)),
+    ]
+
+
+def test_tick_retries_empty_listing(queue, nightly):
+    bagger = nightly.bagger_factory()
+    bagger.dump_order.return_value = []
+    now = at(2017, 9, 4, 3, 0, 20)
+    assert nightly.tick(now=now) == []
+    assert not queue.has_run('nightly', at(2017, 9, 4, 3))
+    # the databases are listed again at the next tick
+    bagger.dump_order.return_value = ['db1', 'db2']
+    assert len(nightly.tick(now=now + 60)) == 1
+
+
+def test_stagger_fits_window(queue, nightly):
+    nightly.stagger = 3600
+    run_id = nightly.queue_run(nightly.schedules[0], at(2017, 9, 4, 3))
+    starts = [job['not_before'] for job in queue.get_run(run_id)['jobs']]
+    assert starts[1] == jobs._isoformat(at(2017, 9, 4, 3, 15))
+
+
+def test_staggered_claim(queue, nightly):
+    now = at(2017, 9, 4, 3, 0, 20)
+    nightly.tick(now=now)
+    with mock.patch('time.time', return_value=now):
+        assert queue.claim('worker')['dbname'] == 'db1'
+        assert queue.claim('worker') is None
+    with mock.patch('time.time', return_value=now + 60):
+        assert queue.claim('worker')['dbname'] == 'db2'
+
+
+def test_retry_in_window(queue, nightly):
+    now = at(2017, 9, 4, 3, 0, 20)
+    run_id, = nightly.tick(now=now)
+    with mock.patch('time.time', return_value=now):
+        job = queue.claim('worker')
+        assert queue.fail(job['id'], 'DumpingError: could not dump')
+    assert queue.get(job['id'])['status'] == jobs.QUEUED
+    with mock.patch('time.time', return_value=now + 600):
+        assert queue.claim('worker')['dbname'] == 'db2'
+        retried = queue.claim('worker')
+        assert retried['id'] == job['id']
+        assert retried['attempts'] == 2
+        # no retry left
+        assert not queue.fail(job['id'], 'DumpingError: could not dump')
+    assert queue.get(job['id'])['status'] == jobs.FAILED
+
+
+def test_window_ended(queue, nightly):
+    now = at(2017, 9, 4, 3, 50)
+    run_id, = nightly.tick(now=now)
+    with mock.patch('time.time', return_value=now):
+        job = queue.claim('worker')
+        # the retry would start after the end of the window
+        assert not queue.fail(job['id'], 'DumpingError: could not dump')
+        queue.finish(queue.claim('worker')['id'], {'filename': 'db2.pg'})
+    run = queue.get_run(run_id)
+    assert run['status'] == jobs.FAILED
+    assert (run['succeeded'], run['failed']) == (1, 1)
+    assert run['finished_at']
+
+
+def test_window_ended_before_start(queue, nightly):
+    run_id, = nightly.tick(now=at(2017, 9, 4, 3, 0))
+    with mock.patch('time.time', return_value=at(2017, 9, 4, 4, 1)):
+        assert queue.claim('worker') is None
+    run = queue.get_run(run_id)
+    assert run['failed'] == 2
+    assert run['jobs'][0]['error'] == 'the window of the run has ended'
+
+
+def test_history(queue, nightly):
+    for day in (4, 5, 6):
+        nightly.tick(now=at(2017, 9, day, 3, 0))
+    runs = queue.runs(schedule='nightly', limit=2)
+    assert [run['planned_at'] for run in runs] == [
+        jobs._isoformat(at(2017, 9, 6, 3)), jobs._isoformat(at(2017, 9, 5, 3)),
+    ]
+    schedule, = nightly.to_dict(now=at(2017, 9, 6, 3, 30))
+    assert schedule['next_run'] == jobs._isoformat(at(2017, 9, 7, 3))
+    assert len(schedule['runs']) == 3
+
+
+def test_scheduler_thread(queue, nightly):
+    nightly.schedules[0] = scheduler.Schedule('minutely', '* * * * *')
+    nightly.interval = 0.05
+    nightly.start()
+    try:
+        for __ in range(50):
+            if queue.runs():
+                break
+            time.sleep(0.1)
+        assert queue.runs()[0]['schedule'] == 'minutely'
+    finally:
+        nightly.stop()
@@ -1,8 +1,11 @@
+import io
+import json
+
 import mock
 import pytest
 import os
 
-from dumpbagserver import storage
+from dumpbagserver import exception, storage
 
 
 @pytest.fixture
@@ -17,6 +20,19 @@ def s3_options():
     return options
 
 
+@pytest.fixture
+def s3_client_commander():
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        options = storage.S3ClientOptions(
+            'foo', 'bar', 'baz', region='us-east-1',
+            part_size=5 * 1024 ** 2, max_concurrency=2,
+        )
+        commander = storage.StorageCommander.new_commander(options)
+        commander._client().create_bucket(Bucket='foo')
+        yield commander
+
+
 @pytest.fixture
 def local_commander(local_options):
     return storage.StorageCommander.new_commander(local_options)
@@ -62,6 +78,10 @@ def test_commander_factory(local_options, s3_options):
     assert type(cmd) is storage.LocalStorageCommander
     cmd = storage.StorageCommander.new_commander(s3_options)
     assert type(cmd) is storage.S3StorageCommander
+    cmd = storage.StorageCommander.new_commander(
+        storage.S3ClientOptions('foo', 'bar', 'baz')
+    )
+    assert type(cmd) is storage.S3ClientStorageCommander
     with pytest.raises(TypeError):
         cmd = storage.StorageCommander.new_commander(
             storage.StorageOptions()
@@ -87,6 +107,40 @@ def test_local_read(tmpdir, local_commander):
         assert content.read() == b'line1\nline2\nline3'
 
 
+def test_local_push_stream(tmpdir, local_commander):
+    local_commander.push_stream('db1', io.BytesIO(b'some content'), 'test')
+    target = os.path.join(tmpdir.strpath, 'db1', 'test')
+    assert open(target, 'rb').read() == b'some content'
+    assert os.listdir(os.path.join(tmpdir.strpath, 'db1')) == ['test']
+
+
+def test_local_delete_dump(tmpdir, local_commander):
+    local_commander.push_stream('db1', io.BytesIO(b'some content'), 'test')
+    local_commander.delete_dump('db1', 'test')
+    assert not os.path.exists(os.path.join(tmpdir.strpath, 'db1', 'test'))
+    # does not fail if the dump does not exist
+    local_commander.delete_dump('db1', 'test')
+
+
+def test_local_checksum(tmpdir, local_commander):
+    local_commander.push_stream('db1', io.BytesIO(b'foo'), 'test.pg')
+    assert local_commander.read_checksum('db1', 'test.pg') is None
+    local_commander.push_checksum('db1', 'test.pg', 'abc123')
+    assert local_commander.read_checksum('db1', 'test.pg') == 'abc123'
+    assert local_commander.list_by_db() == {'db1': {'test.pg'}}
+    assert local_commander.list_page().dumps == [('db1', 'test.pg')]
+
+
+def test_local_delete_dumps(tmpdir, local_commander):
+    for dbname in ('db1', 'db2'):
+        for filename in ('a.pg', 'b.pg'):
+            local_commander.push_stream(dbname, io.BytesIO(b'foo'), filename)
+    local_commander.delete_dumps([
+        ('db1', 'a.pg'), ('db1', 'b.pg'), ('db2', 'a.pg'), ('db2', 'c.pg'),
+    ])
+    assert local_commander.list_by_db() == {'db2': {'b.pg'}}
+
+
 def _create_empty_files(tmpdir, local_commander):
     # create empty files so we can check if the tree is returned correctly
     for db in ('db1', 'db2', 'db3'):
@@ -148,6 +202,80 @@ def test_s3_push_object(mock_popen, test_file, s3_commander):
     assert_s3_env_access(mock_popen, s3_commander)
 
 
+@mock.patch('subprocess.Popen')
+def test_s3_push_stream(mock_popen, s3_commander):
+    mock_popen = configure_mock_popen(
+        mock_popen,
+        {'communicate.return_value': (b'', b''), 'wait.return_value': 0},
+        0
+    )
+
+    source = io.BytesIO(b'some content')
+    s3_commander.push_stream('db1', source, 'test.pg')
+    url = 's3://%s/%s/%s' % (s3_commander.options.bucket, 'db1', 'test.pg')
+    # the first call is the upload, the second the expire tag
+    assert mock_popen.call_count == 2
+    assert mock_popen.call_args_list[0][0] == ([
+        'aws', 's3', 'cp', '-', url
+    ],)
+    assert_s3_env_access(mock_popen, s3_commander)
+    # the size of the stream when it is known
+    s3_commander.push_stream('db1', source, 'test.pg', size=12)
+    assert mock_popen.call_args_list[2][0] == ([
+        'aws', 's3', 'cp', '-', url, '--expected-size', '12'
+    ],)
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_delete_dumps(mock_popen, s3_commander):
+    requests = []
+
+    def communicate():
+        # the keys are given in a file removed after the command
+        path = mock_popen.call_args[0][0][-1][len('file://'):]
+        with open(path) as f:
+            requests.append(json.load(f))
+        return (b'', b'')
+
+    mock_popen = configure_mock_popen(
+        mock_popen, {'communicate.side_effect': communicate}, 0
+    )
+    with mock.patch.object(s3_commander, 'DELETE_BATCH', 3):
+        s3_commander.delete_dumps([('db1', 'a.pg'), ('db2', 'a.pg')])
+    assert mock_popen.call_count == 2
+    assert mock_popen.call_args[0][0][:5] == [
+        'aws', 's3api', 'delete-objects', '--bucket', 'foo',
+    ]
+    # the checksums are removed with the dumps
+    assert requests == [
+        {'Objects': [{'Key': 'db1/a.pg'}, {'Key': 'db1/a.pg.sha256'},
+                     {'Key': 'db2/a.pg'}],
+         'Quiet': True},
+        {'Objects': [{'Key': 'db2/a.pg.sha256'}], 'Quiet': True},
+    ]
+    assert_s3_env_access(mock_popen, s3_commander)
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_read_checksum(mock_popen, s3_commander):
+    mock_popen = configure_mock_popen(
+        mock_popen,
+        {'communicate.return_value': (b'abc123  test.pg\n', b'')},
+        0
+    )
+    assert s3_commander.read_checksum('db1', 'test.pg') == 'abc123'
+    assert mock_popen.call_args[0][0] == [
+        'aws', 's3', 'cp', 's3://foo/db1/test.pg.sha256', '-',
+    ]
+    process = mock_popen.return_value
+    process.returncode = 1
+    process.communicate.return_value = (
+        b'', b'fatal error: An error occurred (404) when calling the '
+        b'HeadObject operation: Key "db1/test.pg.sha256" does not exist'
+    )
+    assert s3_commander.read_checksum('db1', 'test.pg') is None
+
+
 @mock.patch('subprocess.Popen')
 def test_s3_add_expire_tag(mock_popen, test_file, s3_commander):
     mock_popen = configure_mock_popen(
@@ -168,27 +296,13 @@ def test_s3_add_expire_tag(mock_popen, test_file, s3_commander):
 
 
 @mock.patch('subprocess.Popen')
-@mock.patch('tempfile.mkdtemp')
-def test_s3_read_from_storage(mock_mkdtemp, mock_popen, tmpdir, s3_commander):
-    # force mkdtemp to use our test tmp directory so we can fake the
-    # download of a file from S3
-    mock_mkdtemp.return_value = tmpdir.strpath
-
+def test_s3_read_from_storage(mock_popen, s3_commander):
     filename = 'test.pg'
-
-    # tmpfile is the file copied by S3 in the directory created by mkdtemp
-    # and is later read
-    tmpfile = os.path.join(tmpdir.strpath, filename)
-
-    def cp_file():
-        with open(tmpfile, 'wb') as f:
-            f.write(b'line1\nline2\nline3')
-        return (b'', b'')
-
     process_mock = mock.Mock()
     mock_popen.return_value = process_mock
-    process_mock.returncode = 0
-    process_mock.communicate.side_effect = cp_file
+    # aws writes the object on its stdout
+    process_mock.stdout = io.BytesIO(b'line1\nline2\nline3')
+    process_mock.wait.return_value = 0
 
     with s3_commander.read_from_storage('db1', filename) as f:
         assert f.read() == b'line1\nline2\nline3'
@@ -196,11 +310,38 @@ def test_s3_read_from_storage(mock_mkdtemp, mock_popen, tmpdir, s3_commander):
     url = 's3://%s/%s/%s' % (s3_commander.options.bucket, 'db1', filename)
     assert mock_popen.call_count == 1
     assert mock_popen.call_args[0] == ([
-        'aws', 's3', 'cp', url, tmpfile
+        'aws', 's3', 'cp', url, '-'
     ],)
     assert_s3_env_access(mock_popen, s3_commander)
 
 
+@mock.patch('subprocess.Popen')
+def test_s3_read_from_storage_error(mock_popen, s3_commander):
+    process_mock = mock.Mock()
+    mock_popen.return_value = process_mock
+    process_mock.stdout = io.BytesIO(b'')
+    process_mock.wait.return_value = 1
+
+    with pytest.raises(exception.DumpStorageError):
+        with s3_commander.read_from_storage('db1', 'test.pg') as f:
+            f.read()
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_read_dump_interrupted(mock_popen, s3_commander):
+    process_mock = mock.Mock()
+    mock_popen.return_value = process_mock
+    process_mock.stdout = io.BytesIO(b'x' * 1024 ** 2)
+    process_mock.poll.return_value = None
+    process_mock.wait.return_value = -9
+
+    dump = s3_commander.read_dump('db1', 'test.pg')
+    next(dump)
+    # the client went away, aws is stopped
+    dump.close()
+    assert process_mock.kill.called
+
+
 @mock.patch('subprocess.Popen')
 def test_s3_list_by_db(mock_popen, s3_commander):
     communicate_return = (
@@ -271,3 +412,247 @@ def test_s3_list_by_db_filter(mock_popen, s3_commander):
         '--prefix', 'db2/'
     ],)
     assert_s3_env_access(mock_popen, s3_commander)
+
+
+def test_location(tmpdir, local_commander, s3_commander):
+    assert local_commander.location() == 'file://%s' % (tmpdir.strpath,)
+    assert s3_commander.location() == 's3://foo'
+
+
+def test_s3_client_push_stream(s3_client_commander):
+    # bigger than a part so the upload is multipart
+    content = os.urandom(12 * 1024 ** 2)
+    s3_client_commander.push_stream('db1', io.BytesIO(content), 'test.pg')
+    client = s3_client_commander._client()
+    obj = client.get_object(Bucket='foo', Key='db1/test.pg')
+    assert obj['Body'].read() == content
+    tagging = client.get_object_tagging(Bucket='foo', Key='db1/test.pg')
+    assert tagging['TagSet'] == [{'Key': 'Expire', 'Value': 'True'}]
+
+
+def test_s3_client_push_to_storage(test_file, s3_client_commander):
+    tmpdir, filename = test_file
+    s3_client_commander.push_to_storage('db1', tmpdir, filename)
+    with s3_client_commander.read_from_storage('db1', filename) as f:
+        assert f.read() == b'some content'
+
+
+def test_s3_client_read_not_exist(s3_client_commander):
+    with pytest.raises(exception.DumpNotExistError):
+        with s3_client_commander.read_from_storage('db1', 'test.pg'):
+            pass
+
+
+def test_s3_client_list_by_db(s3_client_commander):
+    for key in ('README', 'db1/db1-20170904-092333.pg',
+                'db2/db2-20170904-110917.pg', 'db2/db2-20170905-110917.pg'):
+        s3_client_commander._client().put_object(
+            Bucket='foo', Key=key, Body=b''
+        )
+    assert s3_client_commander.list_by_db() == {
+        'db1': ['db1-20170904-092333.pg'],
+        'db2': ['db2-20170904-110917.pg', 'db2-20170905-110917.pg'],
+    }
+    assert s3_client_commander.list_by_db(dbname='db1') == {
+        'db1': ['db1-20170904-092333.pg'],
+    }
+
+
+def test_s3_client_delete_dump(s3_client_commander):
+    s3_client_commander.push_stream('db1', io.BytesIO(b'foo'), 'test.pg')
+    s3_client_commander.delete_dump('db1', 'test.pg')
+    assert s3_client_commander.list_by_db() == {}
+
+
+def test_s3_client_delete_dumps(s3_client_commander):
+    dumps = [('db%d' % (idx % 3), 'test%d.pg' % idx) for idx in range(5)]
+    for dbname, filename in dumps:
+        s3_client_commander.push_stream(dbname, io.BytesIO(b'foo'), filename)
+    client = s3_client_commander._client()
+    with mock.patch.object(s3_client_commander, 'DELETE_BATCH', 4), \
+            mock.patch.object(client, 'delete_objects',
+                              wraps=client.delete_objects) as delete:
+        s3_client_commander.delete_dumps(dumps[:4])
+    assert delete.call_count == 2
+    assert s3_client_commander.list_by_db() == {'db1': ['test4.pg']}
+
+
+def test_s3_client_delete_dumps_errors(s3_client_commander):
+    client = s3_client_commander._client()
+    errors = {'Errors': [{'Key': 'db1/test.pg', 'Code': 'AccessDenied'}]}
+    with mock.patch.object(client, 'delete_objects', return_value=errors):
+        with pytest.raises(exception.DumpStorageError) as err:
+            s3_client_commander.delete_dumps([('db1', 'test.pg')])
+    assert 'db1/test.pg (AccessDenied)' in str(err.value)
+
+
+def test_s3_client_checksum(s3_client_commander):
+    s3_client_commander.push_stream('db1', io.BytesIO(b'foo'), 'test.pg')
+    assert s3_client_commander.read_checksum('db1', 'test.pg') is None
+    s3_client_commander.push_checksum('db1', 'test.pg', 'ABC123')
+    assert s3_client_commander.read_checksum('db1', 'test.pg') == 'abc123'
+    assert s3_client_commander.list_by_db() == {'db1': ['test.pg']}
+    assert s3_client_commander.list_page().dumps == [('db1', 'test.pg')]
+    s3_client_commander.delete_dump('db1', 'test.pg')
+    assert s3_client_commander._client().list_objects_v2(
+        Bucket='foo')['KeyCount'] == 0
+
+
+def test_s3_client_shared(s3_client_commander):
+    options = storage.S3ClientOptions(
+        'foo', 'bar', 'baz', region='us-east-1',
+        part_size=5 * 1024 ** 2, max_concurrency=2,
+    )
+    other = storage.StorageCommander.new_commander(options)
+    assert other._client() is s3_client_commander._client()
+
+
+def test_local_stat_dump(tmpdir, local_commander):
+    local_commander.push_stream('db1', io.BytesIO(b'some content'), 'test')
+    stat = local_commander.stat_dump('db1', 'test')
+    assert stat.size == 12
+    assert stat.etag
+    with pytest.raises(exception.DumpNotExistError):
+        local_commander.stat_dump('db1', 'foo')
+
+
+def test_local_read_dump_range(tmpdir, local_commander):
+    local_commander.push_stream('db1', io.BytesIO(b'some content'), 'test')
+    chunks = local_commander.read_dump('db1', 'test', offset=5, length=3)
+    assert b''.join(chunks) == b'con'
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_stat_dump(mock_popen, s3_commander):
+    head = (
+        b'{"ContentLength": 12, "ETag": "\\"abc\\"",'
+        b' "LastModified": "2017-09-04T09:23:33+00:00"}'
+    )
+    mock_popen = configure_mock_popen(
+        mock_popen, {'communicate.return_value': (head, b'')}, 0
+    )
+    stat = s3_commander.stat_dump('db1', 'test.pg')
+    assert stat.size == 12
+    assert stat.etag == 'abc'
+    assert stat.last_modified.isoformat() == '2017-09-04T09:23:33+00:00'
+    assert mock_popen.call_args[0] == ([
+        'aws', 's3api', 'head-object', '--bucket', 'foo',
+        '--key', 'db1/test.pg',
+    ],)
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_read_dump_range(mock_popen, s3_commander):
+    def get_object(command, **kwargs):
+        # write the range in the file given to get-object
+        with open(command[-1], 'wb') as f:
+            f.write(b'con')
+        process_mock = mock.Mock()
+        process_mock.wait.return_value = 0
+        return process_mock
+
+    mock_popen.side_effect = get_object
+    chunks = s3_commander.read_dump('db1', 'test.pg', offset=5, length=3)
+    assert b''.join(chunks) == b'con'
+    command = mock_popen.call_args[0][0]
+    assert command[:-1] == [
+        'aws', 's3api', 'get-object', '--bucket', 'foo',
+        '--key', 'db1/test.pg', '--range', 'bytes=5-7',
+    ]
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_read_dump_range_not_started(mock_popen, s3_commander):
+    mock_popen.side_effect = OSError(24, 'Too many open files')
+    fds = os.listdir('/proc/self/fd')
+    with pytest.raises(OSError):
+        list(s3_commander.read_dump('db1', 'test.pg', offset=5, length=3))
+    # the pipe of get-object is closed
+    assert os.listdir('/proc/self/fd') == fds
+
+
+def test_s3_client_stat_and_range(s3_client_commander):
+    s3_client_commander.push_stream(
+        'db1', io.BytesIO(b'some content'), 'test.pg'
+    )
+    stat = s3_client_commander.stat_dump('db1', 'test.pg')
+    assert stat.size == 12
+    chunks = s3_client_commander.read_dump(
+        'db1', 'test.pg', offset=5, length=3
+    )
+    assert b''.join(chunks) == b'con'
+    with pytest.raises(exception.DumpNotExistError):
+        s3_client_commander.stat_dump('db1', 'foo.pg')
+
+
+def all_pages(commander, limit, **kwargs):
+    pages = []
+    cursor = None
+    while True:
+        page = commander.list_page(cursor=cursor, limit=limit, **kwargs)
+        pages.append(page.dumps)
+        cursor = page.cursor
+        if not cursor:
+            return pages
+
+
+def test_local_list_page(tmpdir, local_commander):
+    for dbname in ('db2', 'db1'):
+        for idx in range(3):
+            local_commander.push_stream(
+                dbname, io.BytesIO(b''), '%s-%d.pg' % (dbname, idx)
+            )
+    assert all_pages(local_commander, 4) == [
+        [('db1', 'db1-0.pg'), ('db1', 'db1-1.pg'), ('db1', 'db1-2.pg'),
+         ('db2', 'db2-0.pg')],
+        [('db2', 'db2-1.pg'), ('db2', 'db2-2.pg')],
+    ]
+    assert all_pages(local_commander, 3) == [
+        [('db1', 'db1-0.pg'), ('db1', 'db1-1.pg'), ('db1', 'db1-2.pg')],
+        [('db2', 'db2-0.pg'), ('db2', 'db2-1.pg'), ('db2', 'db2-2.pg')],
+    ]
+    page = local_commander.list_page(dbname='db2', start_after='db2/db2-0.pg')
+    assert page.dumps == [('db2', 'db2-1.pg'), ('db2', 'db2-2.pg')]
+    # the pages of the storages have no details
+    assert page.details is None
+    assert page.cursor is None
+    # same result as the paging of the complete listing
+    base = storage.StorageCommander.list_page(local_commander, limit=4)
+    page = local_commander.list_page(limit=4)
+    assert (base.dumps, base.cursor) == (page.dumps, page.cursor)
+    assert page.sizes['db1/db1-0.pg'] == 0
+
+
+@mock.patch('subprocess.Popen')
+def test_s3_list_page(mock_popen, s3_commander):
+    output = {
+        'Contents': [{'Key': 'db1/db1-0.pg', 'Size': 10},
+                     {'Key': 'db1/db1-1.pg', 'Size': 20}],
+        'NextToken': 'token',
+    }
+    mock_popen = configure_mock_popen(
+        mock_popen,
+        {'communicate.return_value': (json.dumps(output).encode(), b'')},
+        0
+    )
+    page = s3_commander.list_page(cursor='previous', limit=2)
+    assert page == storage.DumpPage(
+        [('db1', 'db1-0.pg'), ('db1', 'db1-1.pg')], 'token',
+        {'db1/db1-0.pg': 10, 'db1/db1-1.pg': 20},
+    )
+    command = mock_popen.call_args[0][0]
+    assert command[command.index('--max-items') + 1] == '2'
+    assert command[command.index('--starting-token') + 1] == 'previous'
+
+
+def test_s3_client_list_page(s3_client_commander):
+    for idx in range(5):
+        s3_client_commander.push_stream(
+            'db1', io.BytesIO(b'dump'), 'db1-%d.pg' % (idx,)
+        )
+    pages = all_pages(s3_client_commander, 2)
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert pages[0][0] == ('db1', 'db1-0.pg')
+    page = s3_client_commander.list_page(start_after='db1/db1-3.pg')
+    assert page.dumps == [('db1', 'db1-4.pg')]
+    assert page.sizes == {'db1/db1-4.pg': 4}
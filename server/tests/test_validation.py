@@ -0,0 +1,117 @@
+import gzip
+import io
+import threading
+
+from dumpbagserver import validation
+
+
+# larger than the buffer of a pipe
+LARGE = 20 * 1024 ** 2
+
+
+def run_in_time(func, timeout=60):
+    """ Return the result of func, fail if it blocks """
+    results = []
+    thread = threading.Thread(target=lambda: results.append(func()))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'the pipeline is blocked'
+    return results[0]
+
+
+def read_all(stream):
+    content = b''
+    for chunk in iter(lambda: stream.read(1024), b''):
+        content += chunk
+    return content
+
+
+def test_validator_tee():
+    validator = validation.DumpValidator([['grep', '-q', 'dump']])
+    stream = validator.tee(io.BytesIO(b'dump content'))
+    assert read_all(stream) == b'dump content'
+    assert validator.result() == ('passed', None)
+
+
+def test_validator_failed():
+    validator = validation.DumpValidator(
+        [['sh', '-c', 'cat > /dev/null; echo truncated >&2; exit 1']]
+    )
+    read_all(validator.tee(io.BytesIO(b'dump content')))
+    assert validator.result() == ('failed', 'truncated')
+
+
+def test_validator_stops_reading():
+    content = b'x' * (1024 ** 2)
+    validator = validation.DumpValidator([['head', '-c', '1']])
+    # the stream is read entirely by the next stage
+    assert read_all(validator.tee(io.BytesIO(content))) == content
+    assert validator.result() == ('passed', None)
+
+
+def test_validator_pipeline(tmpdir):
+    path = tmpdir.join('dump.gz').strpath
+    with gzip.open(path, 'wb') as f:
+        f.write(b'dump content')
+    with open(path, 'rb') as source:
+        validator = validation.DumpValidator(
+            [['gzip', '-d', '--stdout'], ['grep', '-q', 'content']],
+            source=source,
+        )
+        assert validator.tee(source) is source
+        assert validator.result() == ('passed', None)
+
+
+def test_validator_pipeline_stops_reading():
+    validator = validation.DumpValidator([['cat'], ['head', '-c', '10']])
+    stream = validator.tee(io.BytesIO(b'x' * LARGE))
+
+    def validate():
+        # cat gets a broken pipe once head exited
+        size = 0
+        for chunk in iter(lambda: stream.read(64 * 1024), b''):
+            size += len(chunk)
+        assert size == LARGE
+        return validator.result()
+
+    assert run_in_time(validate) == ('passed', None)
+
+
+def test_validator_pipeline_stops_reading_file(tmpdir):
+    path = tmpdir.join('dump.gz').strpath
+    with gzip.open(path, 'wb') as f:
+        f.write(b'x' * LARGE)
+    with open(path, 'rb') as source:
+        validator = validation.DumpValidator(
+            [['gzip', '-d', '--stdout'], ['head', '-c', '10']],
+            source=source,
+        )
+        # gzip stops on a broken pipe, only the last command is checked
+        assert run_in_time(validator.result) == ('passed', None)
+
+
+def test_validator_missing_command():
+    validator = validation.DumpValidator([['dumpbag-missing-command']])
+    stream = io.BytesIO(b'dump content')
+    assert validator.tee(stream) is stream
+    status, error = validator.result()
+    assert status == 'failed'
+    assert error.startswith('could not run dumpbag-missing-command')
+
+
+def test_validator_skipped():
+    validator = validation.DumpValidator(None)
+    assert validator.result() == ('skipped', None)
+    validator = validation.DumpValidator(None, error='no scratch database')
+    assert validator.result() == ('failed', 'no scratch database')
+
+
+def test_validator_abort():
+    validator = validation.DumpValidator([['cat']])
+    validator.tee(io.BytesIO(b'dump')).read()
+    validator.close()
+    # nothing left running nor open
+    assert all(proc.proc.poll() is not None
+               for proc in validator._processes)
+    assert validator._sink is None
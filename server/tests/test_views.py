@@ -0,0 +1,171 @@
+import mock
+import pytest
+
+from dumpbagserver import app, app_config, bagger, catalog
+
+
+@pytest.fixture
+def client(tmpdir, monkeypatch):
+    monkeypatch.setenv('BAG_DB_KIND', 'static')
+    monkeypatch.setenv('BAG_STORAGE_KIND', 'local')
+    monkeypatch.setenv('BAG_STORAGE_LOCAL_DIR', tmpdir.strpath)
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'none')
+    for dbname in ('db1', 'db2'):
+        tmpdir.join(dbname).ensure(dir=True)
+        for date in ('20170904-092333', '20170905-092333'):
+            tmpdir.join(dbname, '%s-%s.pg' % (dbname, date)).write('')
+    return app.test_client()
+
+
+def test_dumps_page(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    # the dumps are loaded by the page
+    assert b'db1-20170904-092333.pg' not in response.data
+
+
+def test_api_dumps(client):
+    page = client.get('/api/dumps?limit=3').get_json()
+    assert [dump['filename'] for dump in page['dumps']] == [
+        'db1-20170904-092333.pg', 'db1-20170905-092333.pg',
+        'db2-20170904-092333.pg',
+    ]
+    dump = page['dumps'][0]
+    assert dump['dbname'] == 'db1'
+    assert dump['date'] == '2017-09-04 09:23:33'
+    assert dump['url'] == '/download/db1/db1-20170904-092333.pg'
+    assert dump['size'] == 0
+    assert 'commands' not in dump
+    assert page['cursor']
+
+    page = client.get(
+        '/api/dumps', query_string={'limit': 3, 'cursor': page['cursor']}
+    ).get_json()
+    assert [dump['filename'] for dump in page['dumps']] == [
+        'db2-20170905-092333.pg',
+    ]
+    assert page['cursor'] is None
+
+
+def test_api_dumps_filters(client):
+    page = client.get('/api/dumps?db=db2&search=0905').get_json()
+    assert [dump['filename'] for dump in page['dumps']] == [
+        'db2-20170905-092333.pg',
+    ]
+
+
+def test_api_dumps_date_size_filters(client, tmpdir):
+    tmpdir.join('db2', 'db2-20170905-092333.pg').write('dump')
+    page = client.get(
+        '/api/dumps?since=2017-09-05&min_size=1'
+    ).get_json()
+    assert [dump['filename'] for dump in page['dumps']] == [
+        'db2-20170905-092333.pg',
+    ]
+    page = client.get(
+        '/api/dumps?db=db1&until=2017-09-04T10:00:00'
+    ).get_json()
+    assert [dump['filename'] for dump in page['dumps']] == [
+        'db1-20170904-092333.pg',
+    ]
+    assert client.get('/api/dumps?until=yesterday').status_code == 400
+
+
+def test_api_dumps_validation(client, tmpdir_factory, monkeypatch):
+    state_db = tmpdir_factory.mktemp('state').join('state.db').strpath
+    monkeypatch.setenv('BAG_STATE_DB', state_db)
+    monkeypatch.setenv('BAG_CATALOG_RECONCILE_INTERVAL', '0')
+    storage = bagger.Bagger(app_config).storage
+    dump_catalog = catalog.DumpCatalog(state_db, storage.location())
+    dump_catalog.record('db1', 'db1-20170904-092333.pg', validation='failed',
+                        validation_error='unexpected end of file')
+    dump_catalog.reconcile(storage)
+    dumps = client.get('/api/dumps?db=db1').get_json()['dumps']
+    assert [(dump['validation'], dump['validation_error'])
+            for dump in dumps] == [
+        ('failed', 'unexpected end of file'), (None, None),
+    ]
+
+
+def test_dump_commands(client):
+    bagger._download_commands.clear()
+    url = '/api/dumps/db1/db1-20170904-092333.pg/commands'
+    commands = client.get(url).get_json()['commands']
+    assert 'wget http://localhost/download/db1/db1-20170904-092333.pg' in (
+        commands
+    )
+    # memoised for the configuration
+    render = bagger.Bagger._render_download_commands
+    with mock.patch.object(bagger.Bagger, '_render_download_commands',
+                           autospec=True, side_effect=render) as mock_render:
+        assert client.get(url).get_json()['commands'] == commands
+        assert not mock_render.called
+        client.get('/api/dumps/db2/db2-20170904-092333.pg/commands')
+        assert mock_render.call_count == 1
+
+
+def test_dump_commands_checksum(client, tmpdir):
+    url = '/api/dumps/db1/db1-20170904-092333.pg/commands'
+    assert client.get(url).get_json()['checksum'] is None
+    tmpdir.join('db1', 'db1-20170904-092333.pg.sha256').write(
+        'abc123  db1-20170904-092333.pg\n'
+    )
+    result = client.get(url).get_json()
+    assert result['checksum'] == 'abc123'
+    assert ("echo 'abc123  db1-20170904-092333.pg' | sha256sum -c"
+            in result['commands'])
+
+
+def test_schedules_without_state_db(client, monkeypatch):
+    monkeypatch.delenv('BAG_STATE_DB', raising=False)
+    assert client.get('/api/schedules').get_json() == []
+    assert client.get('/api/runs/foo').status_code == 404
+
+
+def test_databases(client):
+    response = client.get('/databases')
+    assert response.status_code == 200
+    assert b'Create dump for db1' in response.data
+    sizes = client.get('/api/databases').get_json()
+    assert sorted(sizes) == [
+        'db1', 'db2', 'db3', 'postgres', 'template0', 'template1',
+    ]
+    assert sizes['db1'] is None
+
+
+def test_recipients_etag(client, monkeypatch):
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'gpg')
+    monkeypatch.setenv('BAG_GPG_RECIPIENTS', 'alice@example.com,bob')
+    response = client.get('/recipients')
+    assert response.data == b'alice@example.com,bob'
+    assert response.mimetype == 'text/plain'
+    etag = response.headers['ETag']
+    response = client.get('/recipients', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    monkeypatch.setenv('BAG_GPG_RECIPIENTS', 'alice@example.com')
+    response = client.get('/recipients', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_public_keys_etag(client, monkeypatch):
+    monkeypatch.setenv('BAG_ENCRYPTION_KIND', 'gpg')
+    monkeypatch.setenv('BAG_GPG_RECIPIENTS', 'alice@example.com')
+    with mock.patch('dumpbagserver.encryption.GPGKeysCommander.public_keys',
+                    return_value=['-----BEGIN PGP PUBLIC KEY BLOCK-----']):
+        response = client.get('/keys')
+        assert response.data == b'-----BEGIN PGP PUBLIC KEY BLOCK-----'
+        response = client.get(
+            '/keys', headers={'If-None-Match': response.headers['ETag']}
+        )
+    assert response.status_code == 304
+
+
+@pytest.mark.parametrize('kind, expected', [
+    ('local', False), ('s3', True), ('s3-client', True),
+])
+def test_help_s3(client, monkeypatch, kind, expected):
+    monkeypatch.setenv('BAG_STORAGE_KIND', kind)
+    response = client.get('/help')
+    assert response.status_code == 200
+    assert (b'Push a dump manually on S3' in response.data) == expected